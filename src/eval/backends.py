@@ -0,0 +1,352 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def prompt_key(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+def per_prompt(sampling_params, count):
+    """sampling params of each of count prompts: a dict applies to all, a list holds one per prompt."""
+    if isinstance(sampling_params, list):
+        return sampling_params
+    return [sampling_params] * count
+
+
+class Completion:
+    """
+    one sampled continuation of a prompt, independent of the engine that produced it.
+    """
+    def __init__(self, text, num_tokens=None, finish_reason=None, num_cached_tokens=None):
+        self.text = text
+        self.num_tokens = num_tokens
+        self.finish_reason = finish_reason
+        self.num_cached_tokens = num_cached_tokens
+
+    def to_dict(self):
+        return {
+            'text': self.text,
+            'num_tokens': self.num_tokens,
+            'finish_reason': self.finish_reason,
+            'num_cached_tokens': self.num_cached_tokens,
+        }
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(
+            text=record['text'],
+            num_tokens=record.get('num_tokens'),
+            finish_reason=record.get('finish_reason'),
+            num_cached_tokens=record.get('num_cached_tokens'),
+        )
+
+
+class Backend:
+    """
+    generation engine behind Model.
+
+    generate takes a list of prompts and returns, per prompt, the list of Completions sampled
+    for it (n of them when sampling_params asks for n). sampling_params is the plain dict built
+    in eval.py, or a list of such dicts with one per prompt; each backend translates it for its
+    engine. time spent inside the engine is
+    accumulated in busy_s so harness overhead can be measured as wall time minus busy_s.
+    """
+    name = 'base'
+
+    def __init__(self):
+        self.calls = 0
+        self.busy_s = 0.0
+        self._lock = threading.Lock()
+
+    def load(self):
+        pass
+
+    def _generate(self, prompts, sampling_params):
+        raise NotImplementedError
+
+    async def _agenerate(self, prompt, sampling_params):
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(None, self._generate, [prompt], sampling_params)
+        return results[0]
+
+    def _account(self, start):
+        with self._lock:
+            self.calls += 1
+            self.busy_s += time.perf_counter() - start
+
+    def generate(self, prompts, sampling_params):
+        start = time.perf_counter()
+        try:
+            return self._generate(prompts, sampling_params)
+        finally:
+            self._account(start)
+
+    async def agenerate(self, prompt, sampling_params):
+        start = time.perf_counter()
+        try:
+            return await self._agenerate(prompt, sampling_params)
+        finally:
+            self._account(start)
+
+    def stats(self):
+        return {'backend': self.name, 'calls': self.calls, 'busy_s': self.busy_s}
+
+    def config(self):
+        """what besides the prompt and sampling params shapes the completions, for cache keys."""
+        detector = getattr(self, 'stop_detector', None)
+        return {'backend': self.name, 'stop_detector': type(detector).__name__ if detector else None}
+
+
+class VLLMBackend(Backend):
+    name = 'vllm'
+
+    def __init__(self, model_name, tokenizer, async_engine=False, stop_detector=None):
+        """
+        stop_detector: with the async engine, requests are streamed and aborted as soon as the
+        detector finds a complete statement in every output of the request.
+        """
+        super().__init__()
+        self.model_name = model_name
+        self.tokenizer = tokenizer
+        self.async_engine = async_engine
+        self.stop_detector = stop_detector
+        self.engine = None
+        self._request_ids = itertools.count()
+
+    def load(self):
+        if self.stop_detector and not self.async_engine:
+            logger.warning("Streaming early stop needs the async engine, it is ignored for offline generation.")
+        if self.async_engine:
+            from vllm import AsyncEngineArgs, AsyncLLMEngine
+            self.engine = AsyncLLMEngine.from_engine_args(
+                AsyncEngineArgs(model=self.model_name, tokenizer=self.tokenizer, enable_prefix_caching=True)
+            )
+        else:
+            from vllm import LLM
+            self.engine = LLM(model=self.model_name, tokenizer=self.tokenizer, enable_prefix_caching=True)
+
+    @staticmethod
+    def to_sampling_params(sampling_params):
+        from vllm import SamplingParams
+        if isinstance(sampling_params, list):
+            return [SamplingParams(**params) for params in sampling_params]
+        return SamplingParams(**sampling_params)
+
+    @staticmethod
+    def to_completions(request_output):
+        return [
+            Completion(
+                text=output.text,
+                num_tokens=len(output.token_ids),
+                finish_reason=output.finish_reason,
+                num_cached_tokens=getattr(request_output, 'num_cached_tokens', None),
+            )
+            for output in request_output.outputs
+        ]
+
+    def _generate(self, prompts, sampling_params):
+        if self.async_engine:
+            raise RuntimeError("vllm backend was loaded with the async engine, use agenerate.")
+        outputs = self.engine.generate(prompts=prompts, sampling_params=self.to_sampling_params(sampling_params))
+        return [self.to_completions(output) for output in outputs]
+
+    async def _agenerate(self, prompt, sampling_params):
+        if not self.async_engine:
+            return await super()._agenerate(prompt, sampling_params)
+        request_id = f"req-{next(self._request_ids)}"
+        final = None
+        async for output in self.engine.generate(prompt, self.to_sampling_params(sampling_params), request_id):
+            final = output
+            if self.stop_detector and not output.finished:
+                ends = [self.stop_detector.end(o.text) for o in output.outputs]
+                if all(end is not None for end in ends):
+                    await self.engine.abort(request_id)
+                    completions = self.to_completions(output)
+                    for completion, end in zip(completions, ends):
+                        completion.text = completion.text[:end]
+                        completion.finish_reason = 'statement_complete'
+                    return completions
+        return self.to_completions(final)
+
+
+class ReplayBackend(Backend):
+    """
+    serves completions recorded by RecordingBackend in a previous run.
+
+    completions are keyed by prompt hash and served in recorded order, so a harness that sends
+    the same prompts sees the same trajectories. on_miss decides what an unrecorded prompt gets:
+    'error' raises KeyError, 'empty' returns an empty completion.
+    """
+    name = 'replay'
+
+    def __init__(self, trajectory_file, on_miss='error'):
+        super().__init__()
+        self.trajectory_file = trajectory_file
+        self.on_miss = on_miss
+        self.recorded = {}
+        self.served = {}
+        self.misses = 0
+
+    def load(self):
+        with open(self.trajectory_file, 'r') as file:
+            for line in file:
+                record = json.loads(line)
+                self.recorded.setdefault(record['prompt_key'], []).append(
+                    [Completion.from_dict(c) for c in record['completions']]
+                )
+        logger.info("Replay: loaded %d recorded prompts from %s", len(self.recorded), self.trajectory_file)
+
+    def _replay(self, prompt):
+        key = prompt_key(prompt)
+        recorded = self.recorded.get(key)
+        if not recorded:
+            self.misses += 1
+            if self.on_miss == 'error':
+                raise KeyError(f"Replay: no recorded completion for prompt {key[:12]}")
+            return [Completion(text='', num_tokens=0, finish_reason='replay_miss')]
+        with self._lock:
+            i = self.served.get(key, 0)
+            self.served[key] = i + 1
+        return recorded[i % len(recorded)]
+
+    def _generate(self, prompts, sampling_params):
+        return [self._replay(prompt) for prompt in prompts]
+
+    async def _agenerate(self, prompt, sampling_params):
+        return self._replay(prompt)
+
+    def stats(self):
+        stats = super().stats()
+        stats['misses'] = self.misses
+        return stats
+
+
+class StubBackend(Backend):
+    """
+    scripted completions with simulated decode time, for load testing the harness without a GPU.
+
+    completions are taken round robin from script; each one costs per_token_latency seconds per
+    whitespace separated token. a batched call costs as much as its longest completion, like a
+    real engine decoding the batch in parallel. stop strings in sampling_params and a
+    stop_detector cut completions the way the engine would, and a prompt that already ends its
+    thinking is continued with the part of the script after </think>.
+    """
+    name = 'stub'
+
+    DEFAULT_SCRIPT = ["<think>\n</think>\nSELECT 1;"]
+
+    def __init__(self, script=None, per_token_latency=0.0, stop_detector=None):
+        super().__init__()
+        self.script = script or self.DEFAULT_SCRIPT
+        self.per_token_latency = per_token_latency
+        self.stop_detector = stop_detector
+        self._turns = itertools.count()
+
+    @classmethod
+    def from_file(cls, script_file, per_token_latency=0.0, stop_detector=None):
+        with open(script_file, 'r') as file:
+            script = json.load(file)
+        return cls(script=script, per_token_latency=per_token_latency, stop_detector=stop_detector)
+
+    def _cut(self, text, sampling_params):
+        finish_reason = 'stop'
+        for stop in sampling_params.get('stop') or []:
+            i = text.find(stop)
+            if i >= 0:
+                keep = len(stop) if sampling_params.get('include_stop_str_in_output') else 0
+                text = text[:i + keep]
+        if self.stop_detector:
+            end = self.stop_detector.end(text)
+            if end is not None:
+                text, finish_reason = text[:end], 'statement_complete'
+        max_tokens = sampling_params.get('max_tokens')
+        tokens = text.split()
+        if max_tokens and len(tokens) > max_tokens:
+            text, finish_reason = ' '.join(tokens[:max_tokens]), 'length'
+        return text, finish_reason
+
+    def _next(self, prompt, sampling_params):
+        n = sampling_params.get('n', 1)
+        completions = []
+        for _ in range(n):
+            text = self.script[next(self._turns) % len(self.script)]
+            if prompt.rstrip().endswith("</think>") and "</think>" in text:
+                text = text.split("</think>", 1)[1]
+            text, finish_reason = self._cut(text, sampling_params)
+            completions.append(Completion(text=text, num_tokens=len(text.split()), finish_reason=finish_reason))
+        return completions
+
+    def _latency(self, completions):
+        return self.per_token_latency * max(c.num_tokens for c in completions)
+
+    def _generate(self, prompts, sampling_params):
+        results = [
+            self._next(prompt, params) for prompt, params in zip(prompts, per_prompt(sampling_params, len(prompts)))
+        ]
+        if results:
+            time.sleep(max(self._latency(completions) for completions in results))
+        return results
+
+    async def _agenerate(self, prompt, sampling_params):
+        completions = self._next(prompt, sampling_params)
+        await asyncio.sleep(self._latency(completions))
+        return completions
+
+
+class RecordingBackend(Backend):
+    """
+    wraps another backend and appends every prompt and its completions to a trajectory file
+    that ReplayBackend can serve later.
+    """
+    def __init__(self, inner, trajectory_file):
+        super().__init__()
+        self.inner = inner
+        self.name = inner.name
+        self.trajectory_file = trajectory_file
+
+    def load(self):
+        self.inner.load()
+
+    def config(self):
+        return self.inner.config()
+
+    def _record(self, prompt, completions):
+        record = {
+            'prompt_key': prompt_key(prompt),
+            'prompt': prompt,
+            'completions': [c.to_dict() for c in completions],
+        }
+        with self._lock:
+            with open(self.trajectory_file, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+
+    def _generate(self, prompts, sampling_params):
+        results = self.inner.generate(prompts, sampling_params)
+        for prompt, completions in zip(prompts, results):
+            self._record(prompt, completions)
+        return results
+
+    async def _agenerate(self, prompt, sampling_params):
+        completions = await self.inner.agenerate(prompt, sampling_params)
+        self._record(prompt, completions)
+        return completions
+
+
+def get_backend(name, model_name=None, tokenizer=None, async_engine=False, replay_file=None,
+                stub_script=None, per_token_latency=0.0, stop_detector=None):
+    if name == 'vllm':
+        return VLLMBackend(model_name, tokenizer, async_engine=async_engine, stop_detector=stop_detector)
+    if name == 'replay':
+        return ReplayBackend(replay_file)
+    if name == 'stub':
+        if stub_script:
+            return StubBackend.from_file(stub_script, per_token_latency=per_token_latency, stop_detector=stop_detector)
+        return StubBackend(per_token_latency=per_token_latency, stop_detector=stop_detector)
+    raise ValueError(f"Unknown backend: {name}")
@@ -0,0 +1,198 @@
+import logging
+import threading
+
+from backends import Backend, Completion, per_prompt
+from early_stop import THINK_END
+
+logger = logging.getLogger(__name__)
+
+
+class BudgetScheduler:
+    """
+    decides max_tokens per instance and step instead of a flat --max_tokens.
+
+    think lengths and outcomes are tracked per issue_type. once a group has min_observations
+    successful attempts, its budget becomes headroom times the 90th percentile think length of
+    those successes. an instance whose last attempt ran out of tokens while thinking gets grow
+    times its previous budget. steps past the latest step at which its group ever succeeded get
+    late_step_shrink of the budget, since more thinking there rarely changes the outcome. with a
+    global_budget, each allocation is capped by a fair share of what is left across the
+    instances still running, and an instance gets 0 once the run budget is spent.
+    """
+    def __init__(self, base_budget=10000, global_budget=None, min_budget=1024, max_budget=32768, grow=1.5,
+                 headroom=1.25, min_observations=3, late_step_shrink=0.5):
+        self.base_budget = base_budget
+        self.global_budget = global_budget
+        self.min_budget = min_budget
+        self.max_budget = max_budget
+        self.grow = grow
+        self.headroom = headroom
+        self.min_observations = min_observations
+        self.late_step_shrink = late_step_shrink
+        self.groups = {}
+        self.instances = {}
+        self.running = set()
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def _group(self, issue_type):
+        return self.groups.setdefault(
+            issue_type, {'attempts': 0, 'successes': 0, 'truncated': 0, 'success_think': [], 'success_steps': []}
+        )
+
+    @staticmethod
+    def quantile(values, q):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    @staticmethod
+    def think_tokens(completion):
+        """tokens spent before </think>, apportioned from the completion's token count."""
+        end = completion.text.find(THINK_END)
+        tokens = completion.num_tokens or 0
+        if end < 0 or not completion.text:
+            return tokens
+        return int(tokens * end / len(completion.text))
+
+    @staticmethod
+    def ran_out(completion):
+        if completion.finish_reason == 'budget_forced':
+            return True
+        return completion.finish_reason == 'length' and THINK_END not in completion.text
+
+    def register(self, sample):
+        with self._lock:
+            self.running.add(sample['instance_id'])
+
+    def finish(self, sample):
+        with self._lock:
+            self.running.discard(sample['instance_id'])
+
+    def allocate(self, sample, step):
+        """:return: max_tokens for this step, 0 once the global budget is spent."""
+        with self._lock:
+            group = self._group(sample.get('issue_type'))
+            budget = self.base_budget
+            if len(group['success_think']) >= self.min_observations:
+                budget = int(self.quantile(group['success_think'], 0.9) * self.headroom)
+
+            state = self.instances.get(sample['instance_id'])
+            if state and state['truncated']:
+                budget = max(budget, int(state['budget'] * self.grow))
+
+            if group['attempts'] >= self.min_observations and group['success_steps']:
+                if step > max(group['success_steps']):
+                    budget = int(budget * self.late_step_shrink)
+
+            budget = max(self.min_budget, min(self.max_budget, budget))
+
+            if self.global_budget is not None:
+                remaining = self.global_budget - self.spent
+                if remaining <= 0:
+                    return 0
+                share = remaining // max(1, len(self.running))
+                budget = min(budget, max(self.min_budget, share), remaining)
+
+            self.instances[sample['instance_id']] = {'budget': budget, 'truncated': False}
+            return budget
+
+    def record(self, sample, step, completions, success):
+        with self._lock:
+            group = self._group(sample.get('issue_type'))
+            self.spent += sum(c.num_tokens or 0 for c in completions)
+            truncated = any(self.ran_out(c) for c in completions)
+            group['attempts'] += 1
+            group['truncated'] += truncated
+            state = self.instances.get(sample['instance_id'])
+            if state:
+                state['truncated'] = truncated
+            if success:
+                group['successes'] += 1
+                group['success_steps'].append(step)
+                group['success_think'].append(max(self.think_tokens(c) for c in completions))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'spent': self.spent,
+                'global_budget': self.global_budget,
+                'groups': {
+                    issue_type: {
+                        'attempts': group['attempts'],
+                        'success_rate': group['successes'] / group['attempts'] if group['attempts'] else 0.0,
+                        'truncated': group['truncated'],
+                    }
+                    for issue_type, group in self.groups.items()
+                },
+            }
+
+
+class BudgetForcingBackend(Backend):
+    """
+    budget forcing: a candidate that used up max_tokens while still thinking gets its thinking
+    closed with </think> and is asked for the answer with at most answer_max_tokens tokens.
+    forced completions are marked with finish_reason 'budget_forced'.
+    """
+    FORCE = "\n" + THINK_END + "\n\n"
+
+    def __init__(self, inner, answer_max_tokens=512):
+        super().__init__()
+        self.inner = inner
+        self.name = inner.name
+        self.answer_max_tokens = answer_max_tokens
+
+    def load(self):
+        self.inner.load()
+
+    @staticmethod
+    def cut_off(completion):
+        return completion.finish_reason == 'length' and THINK_END not in completion.text
+
+    def answer_params(self, sampling_params):
+        params = dict(sampling_params)
+        params['n'] = 1
+        params['max_tokens'] = self.answer_max_tokens
+        params['stop'] = [";"]
+        params['include_stop_str_in_output'] = True
+        return params
+
+    def join(self, thinking, answer):
+        return Completion(
+            text=thinking.text + self.FORCE + answer.text,
+            num_tokens=(thinking.num_tokens or 0) + (answer.num_tokens or 0),
+            finish_reason='budget_forced',
+            num_cached_tokens=thinking.num_cached_tokens,
+        )
+
+    def _generate(self, prompts, sampling_params):
+        params = per_prompt(sampling_params, len(prompts))
+        results = self.inner.generate(prompts, sampling_params)
+        pending = [
+            (i, j) for i, completions in enumerate(results)
+            for j, completion in enumerate(completions) if self.cut_off(completion)
+        ]
+        if pending:
+            logger.info("Budget forcing %d candidates that ran out of thinking tokens.", len(pending))
+            answers = self.inner.generate(
+                [prompts[i] + results[i][j].text + self.FORCE for i, j in pending],
+                [self.answer_params(params[i]) for i, _ in pending],
+            )
+            for (i, j), answer in zip(pending, answers):
+                results[i][j] = self.join(results[i][j], answer[0])
+        return results
+
+    async def _agenerate(self, prompt, sampling_params):
+        completions = await self.inner.agenerate(prompt, sampling_params)
+        for j, completion in enumerate(completions):
+            if self.cut_off(completion):
+                answer = await self.inner.agenerate(
+                    prompt + completion.text + self.FORCE, self.answer_params(sampling_params)
+                )
+                completions[j] = self.join(completion, answer[0])
+        return completions
+
+    def stats(self):
+        return self.inner.stats()
+
+    def config(self):
+        return {'budget_forcing': {'answer_max_tokens': self.answer_max_tokens}, 'inner': self.inner.config()}
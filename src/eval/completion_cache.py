@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from backends import Backend, Completion, per_prompt
+
+logger = logging.getLogger(__name__)
+
+
+class CompletionCache:
+    """
+    on-disk, content addressed store of completions, backed by sqlite.
+
+    keys hash (model name, tokenizer, sampling params, prompt, backend config), so a rerun with identical inputs
+    gets the completions of the first run back without touching the engine. the db runs in WAL
+    mode with a busy timeout so several eval processes can share one file; each thread holds its
+    own connection. once the stored payload exceeds max_bytes, least recently used entries are
+    evicted down to evict_to of the limit. read_only never writes, not even access times.
+    """
+    EVICT_EVERY = 64
+
+    def __init__(self, path, max_bytes=2 * 1024 ** 3, read_only=False, evict_to=0.9, busy_timeout_s=30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.evict_to = evict_to
+        self.busy_timeout_s = busy_timeout_s
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if read_only and not os.path.exists(path):
+            raise FileNotFoundError(f"Completion cache {path} does not exist, cannot open it read only.")
+        if not read_only:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._init_db()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.read_only:
+                conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=self.busy_timeout_s)
+            else:
+                conn = sqlite3.connect(self.path, timeout=self.busy_timeout_s)
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+        conn.commit()
+
+    @staticmethod
+    def key(model_name, tokenizer, sampling_params, prompt, backend=None):
+        """
+        :param backend: Backend.config of the backend behind the cache: engine, stop detection,
+            two phase stops and budget forcing all change what a prompt completes to.
+        """
+        material = json.dumps(
+            {
+                'model': model_name,
+                'tokenizer': tokenizer,
+                'sampling_params': sampling_params,
+                'prompt': prompt,
+                'backend': backend,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        row = self._connect().execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        if not self.read_only:
+            conn = self._connect()
+            conn.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        return [Completion.from_dict(c) for c in json.loads(row[0])]
+
+    def put(self, key, completions):
+        if self.read_only:
+            return
+        value = json.dumps([c.to_dict() for c in completions]).encode('utf-8')
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO completions (key, value, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), now, now),
+        )
+        conn.commit()
+        with self._lock:
+            self.writes += 1
+            check = self.writes % self.EVICT_EVERY == 0
+        if check:
+            self.evict()
+
+    def size(self):
+        return self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    def evict(self):
+        total = self.size()
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * self.evict_to
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        evicted = 0
+        for key, size in conn.execute("SELECT key, size FROM completions ORDER BY last_used").fetchall():
+            if total <= target:
+                break
+            conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        conn.commit()
+        with self._lock:
+            self.evictions += evicted
+        logger.info("Completion cache: evicted %d entries, %d bytes left.", evicted, total)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'writes': self.writes,
+            'evictions': self.evictions,
+        }
+
+
+class CachedBackend(Backend):
+    """
+    consults a CompletionCache before the wrapped backend; only prompts that miss reach the engine.
+
+    the k-th request of the same prompt within a run is cached as draw k, so a prompt that is
+    resent (e.g. after a step with no extractable SQL) gets a fresh sample instead of its
+    previous completion, and a rerun sees the same sequence of draws.
+    """
+    def __init__(self, inner, cache, model_name, tokenizer):
+        super().__init__()
+        self.inner = inner
+        self.name = inner.name
+        self.cache = cache
+        self.model_name = model_name
+        self.tokenizer = tokenizer
+        self.backend_config = inner.config()
+        self.draws = {}
+
+    def load(self):
+        self.inner.load()
+
+    def _key(self, prompt, sampling_params):
+        key = self.cache.key(self.model_name, self.tokenizer, sampling_params, prompt, self.backend_config)
+        with self._lock:
+            draw = self.draws.get(key, 0)
+            self.draws[key] = draw + 1
+        return key if draw == 0 else f"{key}:{draw}"
+
+    def _generate(self, prompts, sampling_params):
+        params = per_prompt(sampling_params, len(prompts))
+        keys = [self._key(prompt, p) for prompt, p in zip(prompts, params)]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            generated = self.inner.generate([prompts[i] for i in missing], [params[i] for i in missing])
+            for i, completions in zip(missing, generated):
+                self.cache.put(keys[i], completions)
+                results[i] = completions
+        return results
+
+    async def _agenerate(self, prompt, sampling_params):
+        key = self._key(prompt, sampling_params)
+        completions = self.cache.get(key)
+        if completions is None:
+            completions = await self.inner.agenerate(prompt, sampling_params)
+            self.cache.put(key, completions)
+        return completions
+
+    def stats(self):
+        stats = self.inner.stats()
+        stats['cache'] = self.cache.stats()
+        return stats
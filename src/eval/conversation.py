@@ -0,0 +1,136 @@
+import threading
+
+
+class Turn:
+    """
+    one attempt in a Conversation: the SQL the model wrote and the feedback it got back.
+    """
+    def __init__(self, step, sql, feedback, candidate=None, summary=None):
+        self.step = step
+        self.sql = sql
+        self.feedback = feedback
+        self.candidate = candidate
+        self.summary = summary
+        self.collapsed = False
+
+    def to_dict(self):
+        return {
+            'step': self.step,
+            'sql': self.sql,
+            'feedback': self.feedback,
+            'candidate': self.candidate,
+            'summary': self.summary,
+        }
+
+    @property
+    def label(self):
+        return f"step {self.step}" if self.candidate is None else f"step {self.step}, candidate {self.candidate}"
+
+    def render(self):
+        if self.collapsed:
+            return f"\nEarlier attempt at {self.label}: {self.summary}\n"
+        attempt = self.sql if self.sql else "(no SQL query found in the response)"
+        return (
+            f"\nCorrection attempt at {self.label}:\n{attempt}\n"
+            f"Results from previous correction attempt at {self.label}:\n{self.feedback}\n"
+        )
+
+
+class Conversation:
+    """
+    append-only layout of a correction episode: system instruction, then the task, then one turn
+    per attempt.
+
+    every rendered piece is frozen once appended, so the prompt of step k is a byte-exact prefix
+    of the prompt of step k + 1 and vllm's automatic prefix caching can reuse the kv cache of all
+    earlier turns instead of prefilling the whole history again. turns open with a newline so the
+    tokenizer does not merge across a turn boundary. the only rewrite is collapse, used when the
+    history outgrows its token budget; the prompt stays append-only again from there on.
+    """
+    SYSTEM = (
+        "Think step by step about how to correct the SQL query.\n\n"
+        "Only output the corrected SQL query. Do not include any explanations, reasoning, or extra text.\n\n"
+    )
+
+    def __init__(self, task, system=SYSTEM):
+        self.system = system
+        self.task = task
+        self.turns = []
+        self.seen_errors = {}
+        self._rendered = system + task
+
+    def add_turn(self, step, sql, feedback, candidate=None, summary=None):
+        turn = Turn(step, sql, feedback, candidate, summary)
+        self.turns.append(turn)
+        self._rendered += turn.render()
+
+    def collapse(self, count):
+        """replace the oldest count full turns with their one line summaries."""
+        collapsed = 0
+        for turn in self.turns:
+            if collapsed == count:
+                break
+            if not turn.collapsed and turn.summary:
+                turn.collapsed = True
+                collapsed += 1
+        if collapsed:
+            self._rendered = self.system + self.task + "".join(turn.render() for turn in self.turns)
+        return collapsed
+
+    def render(self):
+        return self._rendered
+
+
+class PrefixStats:
+    """
+    per-step prefix cache hit ratio: the share of each prompt's tokens that an engine with
+    automatic prefix caching can serve from the kv cache of the same episode's previous step.
+
+    reusable tokens are the common token prefix with the previous prompt, rounded down to whole
+    kv blocks. when the engine reports num_cached_tokens it is aggregated alongside, so the
+    estimate can be checked against what the engine actually reused.
+    """
+    def __init__(self, token_counter, block_size=16):
+        self.token_counter = token_counter
+        self.block_size = block_size
+        self.steps = {}
+        self._lock = threading.Lock()
+
+    def reusable_tokens(self, previous, prompt):
+        prompt_ids = self.token_counter.encode(prompt)
+        if prompt_ids is None:
+            common = len(previous) if prompt.startswith(previous) else 0
+            common = common // self.token_counter.chars_per_token
+            total = self.token_counter.count(prompt)
+        else:
+            previous_ids = self.token_counter.encode(previous) if previous else []
+            common = 0
+            for a, b in zip(previous_ids, prompt_ids):
+                if a != b:
+                    break
+                common += 1
+            total = len(prompt_ids)
+        return total, common - common % self.block_size
+
+    def record(self, step, previous, prompt, engine_cached_tokens=None):
+        total, reusable = self.reusable_tokens(previous or '', prompt)
+        with self._lock:
+            entry = self.steps.setdefault(
+                step, {'requests': 0, 'prompt_tokens': 0, 'reusable_tokens': 0, 'engine_cached_tokens': None}
+            )
+            entry['requests'] += 1
+            entry['prompt_tokens'] += total
+            entry['reusable_tokens'] += reusable
+            if engine_cached_tokens is not None:
+                entry['engine_cached_tokens'] = (entry['engine_cached_tokens'] or 0) + engine_cached_tokens
+
+    def report(self):
+        report = {}
+        with self._lock:
+            for step in sorted(self.steps):
+                entry = dict(self.steps[step])
+                entry['hit_ratio'] = entry['reusable_tokens'] / entry['prompt_tokens'] if entry['prompt_tokens'] else 0.0
+                if entry['engine_cached_tokens'] is not None:
+                    entry['engine_hit_ratio'] = entry['engine_cached_tokens'] / entry['prompt_tokens']
+                report[step] = entry
+        return report
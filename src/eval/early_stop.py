@@ -0,0 +1,132 @@
+import logging
+import re
+import threading
+
+from backends import Backend, Completion, per_prompt
+
+logger = logging.getLogger(__name__)
+
+THINK_END = "</think>"
+
+
+class StatementDetector:
+    """
+    finds the point where a completion holds a complete statement after the end-of-thinking
+    marker: a SELECT closed by a semicolon or a blank line, the same span ExecSQL.extract_sql takes.
+    """
+    PATTERN = re.compile(r"</think>\s*(SELECT\s.*?)(;|\n\s*\n)", re.IGNORECASE | re.DOTALL)
+
+    def end(self, text):
+        """:return: index just past the complete statement, or None while it is still open."""
+        start = text.rfind(THINK_END)
+        if start < 0:
+            return None
+        match = self.PATTERN.search(text, start)
+        return match.end() if match else None
+
+
+class StopStringBackend(Backend):
+    """
+    ends sequences once the answer is written, using only stop strings.
+
+    phase one decodes the thinking with </think> as stop string. every candidate that closed its
+    thinking is continued in phase two with ; as stop string and at most answer_max_tokens tokens,
+    all continuations in one call. a blank line cannot be a stop string because models often put
+    one between </think> and the SELECT, so the cap bounds statements missing their semicolon.
+    candidates that ran out of tokens while thinking are returned as they are.
+    """
+    def __init__(self, inner, answer_max_tokens=512):
+        super().__init__()
+        self.inner = inner
+        self.name = inner.name
+        self.answer_max_tokens = answer_max_tokens
+
+    def load(self):
+        self.inner.load()
+
+    @staticmethod
+    def think_params(sampling_params):
+        params = dict(sampling_params)
+        params['stop'] = list(params.get('stop') or []) + [THINK_END]
+        params['include_stop_str_in_output'] = True
+        return params
+
+    def answer_params(self, sampling_params, used_tokens):
+        params = dict(sampling_params)
+        params['n'] = 1
+        params['stop'] = [";"]
+        params['include_stop_str_in_output'] = True
+        budget = params.get('max_tokens', self.answer_max_tokens) - (used_tokens or 0)
+        params['max_tokens'] = max(1, min(self.answer_max_tokens, budget))
+        return params
+
+    @staticmethod
+    def closed_thinking(completion):
+        return completion.finish_reason == 'stop' and completion.text.rstrip().endswith(THINK_END)
+
+    @staticmethod
+    def join(thinking, answer):
+        return Completion(
+            text=thinking.text + answer.text,
+            num_tokens=(thinking.num_tokens or 0) + (answer.num_tokens or 0),
+            finish_reason=answer.finish_reason,
+            num_cached_tokens=thinking.num_cached_tokens,
+        )
+
+    def _continuations(self, prompts, results):
+        return [
+            (i, j, prompts[i] + completion.text)
+            for i, completions in enumerate(results)
+            for j, completion in enumerate(completions)
+            if self.closed_thinking(completion)
+        ]
+
+    def _generate(self, prompts, sampling_params):
+        params = per_prompt(sampling_params, len(prompts))
+        results = self.inner.generate(prompts, [self.think_params(p) for p in params])
+        pending = self._continuations(prompts, results)
+        if pending:
+            answers = self.inner.generate(
+                [prompt for _, _, prompt in pending],
+                [self.answer_params(params[i], results[i][j].num_tokens) for i, j, _ in pending],
+            )
+            for (i, j, _), answer in zip(pending, answers):
+                results[i][j] = self.join(results[i][j], answer[0])
+        return results
+
+    async def _agenerate(self, prompt, sampling_params):
+        completions = await self.inner.agenerate(prompt, self.think_params(sampling_params))
+        for j, completion in enumerate(completions):
+            if self.closed_thinking(completion):
+                params = self.answer_params(sampling_params, completion.num_tokens)
+                answer = await self.inner.agenerate(prompt + completion.text, params)
+                completions[j] = self.join(completion, answer[0])
+        return completions
+
+    def stats(self):
+        return self.inner.stats()
+
+    def config(self):
+        return {'stop_strings': {'answer_max_tokens': self.answer_max_tokens}, 'inner': self.inner.config()}
+
+
+class DecodeStats:
+    """
+    decoded tokens per correction step, summed over instances and candidates.
+    """
+    def __init__(self):
+        self.steps = {}
+        self._lock = threading.Lock()
+
+    def record(self, step, completions):
+        tokens = sum(c.num_tokens or 0 for c in completions)
+        with self._lock:
+            entry = self.steps.setdefault(step, {'requests': 0, 'completions': 0, 'decoded_tokens': 0})
+            entry['requests'] += 1
+            entry['completions'] += len(completions)
+            entry['decoded_tokens'] += tokens
+        return tokens
+
+    def report(self):
+        with self._lock:
+            return {step: dict(self.steps[step]) for step in sorted(self.steps)}
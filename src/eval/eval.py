@@ -4,9 +4,27 @@ import json
 import sys
 import os
 import csv
+import asyncio
+import time
+import signal
 
-from model import Model
+from model import Model, ExecSQL
 from data_utils import load_dataset
+from pipeline import AsyncPipeline
+from backends import get_backend, RecordingBackend
+from completion_cache import CompletionCache, CachedBackend
+from early_stop import StatementDetector, StopStringBackend
+from budget import BudgetScheduler, BudgetForcingBackend
+from journal import RunJournal
+from guard import ExecutionGuard
+from result_cache import ResultCache
+from plan_screen import PlanScreen
+from schedule import ConflictScheduler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util_scripts.db_pool import DatabasePools
+from util_scripts.clone_pool import ClonePool
+from util_scripts.result_stream import ResultReader
 
 logging.basicConfig(
         level = logging.INFO,
@@ -26,45 +44,221 @@ parser.add_argument('--tokenizer', type=str, required=True)
 parser.add_argument('--temperature', type=float, default = .7)
 parser.add_argument('--top_p', type=float, default = .9)
 parser.add_argument('--max_tokens', type=int, default = 10000)
+parser.add_argument('--backend', type=str, default = 'vllm', choices = ['vllm', 'replay', 'stub'])
+parser.add_argument('--replay_file', type=str, default = None, help='trajectory file served by --backend replay')
+parser.add_argument('--stub_script', type=str, default = None, help='json list of completions served by --backend stub')
+parser.add_argument('--stub_token_latency', type=float, default = 0.0, help='seconds per token simulated by --backend stub')
+parser.add_argument('--record_trajectories', type=str, default = None, help='append every prompt and completion to this file for replay')
+parser.add_argument('--completion_cache', type=str, default = None, help='sqlite file caching completions across runs')
+parser.add_argument('--cache_max_mb', type=int, default = 2048, help='evict least recently used completions beyond this size')
+parser.add_argument('--cache_read_only', action='store_true', help='serve cached completions but never write the cache')
+parser.add_argument('--candidates', type=int, default = 1, help='completions sampled per step, executed concurrently')
+parser.add_argument('--step_feedback_tokens', type=int, default = 1024, help='token budget of the feedback of one attempt')
+parser.add_argument('--total_feedback_tokens', type=int, default = 8192, help='token budget of the whole prompt before old attempts are summarized')
+parser.add_argument('--early_stop', type=str, default = 'off', choices = ['off', 'stop_strings', 'stream'], help='end sequences once a complete statement follows </think>')
+parser.add_argument('--answer_max_tokens', type=int, default = 512, help='max tokens after </think> with --early_stop stop_strings')
+parser.add_argument('--adaptive_budget', action='store_true', help='schedule max_tokens per instance and step from observed think lengths per issue_type')
+parser.add_argument('--global_token_budget', type=int, default = None, help='decoded tokens allowed for the whole run, with --adaptive_budget')
+parser.add_argument('--budget_forcing', action='store_true', help='close thinking that hit max_tokens and ask for the answer')
+parser.add_argument('--run_dir', type=str, default = None, help='where the run journal goes, defaults to ../../runs/<timestamp>')
+parser.add_argument('--resume', type=str, default = None, help='run_dir of an interrupted run to continue')
+parser.add_argument('--pool_size', type=int, default = 16, help='max pooled postgres connections per database')
+parser.add_argument('--route_databases', action='store_true', help="connect each instance to its selected_database instead of the db_name in postgres_cred.json")
+parser.add_argument('--isolation', type=str, default = 'cleanup', choices = ['cleanup', 'savepoint', 'clone', 'auto'], help='undo instance state with clean_up_sql, run it in a transaction with a savepoint per candidate and roll it back, run it on a throwaway clone of the database, or pick per instance from what its SQL does')
+parser.add_argument('--clones', type=int, default = 4, help='clones kept ready per database with --isolation clone or auto')
+parser.add_argument('--statement_timeout_ms', type=int, default = 30000, help='statement_timeout of model written SQL, 0 to disable the guard')
+parser.add_argument('--lock_timeout_ms', type=int, default = 5000, help='lock_timeout of model written SQL')
+parser.add_argument('--idle_timeout_ms', type=int, default = 60000, help='idle_in_transaction_session_timeout of pooled candidate conns')
+parser.add_argument('--wall_timeout_s', type=float, default = None, help='cancel model written SQL still running after this long, defaults to statement_timeout + 10s')
+parser.add_argument('--statement_limits', type=str, default = None, help='json file of limits per issue_type, e.g. {"Management": {"statement_timeout_ms": 60000}}')
+parser.add_argument('--fetch_batch_rows', type=int, default = 2000, help='rows fetched per round trip from the server side cursor')
+parser.add_argument('--max_result_rows', type=int, default = 100000, help='stop reading a candidate result after this many rows')
+parser.add_argument('--max_result_mb', type=int, default = 64, help='stop reading a candidate result after this many MB')
+parser.add_argument('--result_cache_mb', type=int, default = 256, help='size of the cache of read-only candidate results, 0 to disable')
+parser.add_argument('--max_repeat_streak', type=int, default = 0, help='stop an instance after this many steps that only repeat queries it already tried, 0 never stops')
+parser.add_argument('--explain_max_cost', type=float, default = None, help='EXPLAIN candidates first and act on plans with a higher estimated total cost')
+parser.add_argument('--explain_max_rows', type=float, default = None, help='EXPLAIN candidates first and act on plans estimating more rows')
+parser.add_argument('--explain_action', type=str, default = 'reject', choices = ['reject', 'downgrade'], help='reject too expensive plans, or run them under --explain_timeout_ms')
+parser.add_argument('--explain_timeout_ms', type=int, default = 5000, help='statement_timeout of downgraded plans')
+parser.add_argument('--batch', action='store_true', help='generate for all unfinished instances in one call per step')
+parser.add_argument('--async_eval', action='store_true', help='run instances as coroutines, overlapping generation with SQL execution')
+parser.add_argument('--concurrency', type=int, default = 8, help='max instances in flight with --async_eval')
+parser.add_argument('--compare', type=str, default = 'exact', choices = ['exact', 'set', 'bag', 'ordered'], help='judge candidates by exact rows, or with tolerance comparing distinct rows (as ex_base), rows with duplicates, or rows in order')
+parser.add_argument('--compare_decimals', type=int, default = 2, help='decimal places numbers are rounded to before a tolerant comparison, -1 to not round')
+parser.add_argument('--compare_tolerance', type=float, default = 0.0, help='absolute tolerance of numbers after rounding, with --compare set, bag or ordered')
+parser.add_argument('--compare_respect_order', action='store_true', help='compare rows in order when the solution has a top level ORDER BY')
+parser.add_argument('--schedule', type=str, default = 'serial', choices = ['serial', 'conflict'], help='with --batch, run stateful instances after the stateless ones in waves of --stateful_batch_size, or run every instance whose tables no earlier one writes in the same wave')
+parser.add_argument('--run_tests', action='store_true', help='after the run, grade every final query with the test_cases of GTsql_filtered.jsonl')
+parser.add_argument('--test_workers', type=int, default = 4, help='worker processes running test cases with --run_tests')
+parser.add_argument('--test_timeout_s', type=float, default = 30.0, help='seconds a test case may run before its worker is killed')
+parser.add_argument('--stateful_batch_size', type=int, default = 1, help='max instances with preprocess / clean up SQL sharing a batch, or running at once with --async_eval')
 
 args = parser.parse_args()
 
 data = load_dataset('../../data/bc-1-fexp/data/input_filtered.jsonl') # NOTE: this is a list of dictionaries
 
+############## run journal ################
+
+run_dir = args.resume or args.run_dir or os.path.join('../../runs', time.strftime('%Y%m%d-%H%M%S'))
+resume_state = RunJournal.load(args.resume) if args.resume else {}
+
+all_data = data
+if resume_state:
+    finished = {instance_id for instance_id, entry in resume_state.items() if entry['finished']}
+    data = [sample for sample in data if sample['instance_id'] not in finished]
+    logger.info(f"Resuming {run_dir}: {len(finished)} instances finished, {len(data)} left")
+
+journal = RunJournal(run_dir)
+
+with open(os.path.join(run_dir, 'args.json'), 'w') as file:
+    json.dump(vars(args), file, indent = 2)
+
+class Interrupted(KeyboardInterrupt):
+    def __init__(self, signum):
+        super().__init__(signum)
+        self.signum = signum
+
+def shutdown(signum, frame):
+    # the main thread may be inside a journal write, so the journal is closed after the stack unwinds
+    raise Interrupted(signum)
+
+signal.signal(signal.SIGINT, shutdown)
+signal.signal(signal.SIGTERM, shutdown)
+
 ############## init model ################
 
+with open("../psql_db/postgres_cred.json", 'r') as file:
+    cred = json.load(file)
+
+pools = DatabasePools(cred['super_user'], cred['password'], max_per_db = args.pool_size)
+
+# clones are created before anything connects to the databases they copy
+clones = {}
+if args.isolation in ('clone', 'auto'):
+    needs_clone = ExecSQL.is_stateful if args.isolation == 'clone' else ExecSQL.needs_clone
+    try:
+        for sample in data:
+            db_name = sample['selected_database'] if args.route_databases else cred['db_name']
+            if needs_clone(sample) and db_name not in clones:
+                clones[db_name] = ClonePool(db_name, cred['super_user'], cred['password'], size = args.clones)
+                clones[db_name].start()
+    except Exception:
+        for clone_pool in clones.values():
+            clone_pool.close()
+        raise
+
 sampling_params = {
     'temperature': args.temperature,
     'top_p': args.top_p,
     'max_tokens': args.max_tokens
 }
 
+backend = get_backend(
+    args.backend,
+    model_name = args.model_name,
+    tokenizer = args.tokenizer,
+    async_engine = args.async_eval,
+    replay_file = args.replay_file,
+    stub_script = args.stub_script,
+    per_token_latency = args.stub_token_latency,
+    stop_detector = StatementDetector() if args.early_stop == 'stream' else None
+)
+
+if args.early_stop == 'stop_strings':
+    backend = StopStringBackend(backend, answer_max_tokens = args.answer_max_tokens)
+
+if args.budget_forcing:
+    backend = BudgetForcingBackend(backend, answer_max_tokens = args.answer_max_tokens)
+
+if args.completion_cache:
+    cache = CompletionCache(
+        args.completion_cache,
+        max_bytes = args.cache_max_mb * 1024 ** 2,
+        read_only = args.cache_read_only
+    )
+    backend = CachedBackend(backend, cache, model_name = args.model_name, tokenizer = args.tokenizer)
+
+if args.record_trajectories:
+    backend = RecordingBackend(backend, args.record_trajectories)
+
+guard_defaults = {
+    'statement_timeout_ms': args.statement_timeout_ms,
+    'lock_timeout_ms': args.lock_timeout_ms,
+    'idle_in_transaction_timeout_ms': args.idle_timeout_ms,
+    'wall_timeout_s': args.wall_timeout_s
+}
+if not args.statement_timeout_ms:
+    guard = None
+elif args.statement_limits:
+    guard = ExecutionGuard.from_file(args.statement_limits, defaults = guard_defaults)
+else:
+    guard = ExecutionGuard(guard_defaults)
+
+comparator = None
+if args.compare != 'exact':
+    # needs numpy, only imported when asked for
+    from util_scripts.result_compare import ResultComparator
+    comparator = ResultComparator(
+        semantics = args.compare,
+        decimal_places = args.compare_decimals if args.compare_decimals >= 0 else None,
+        abs_tol = args.compare_tolerance,
+        respect_order = args.compare_respect_order
+    )
+
 model = Model(
     model_name = args.model_name,
     tokenizer = args.tokenizer,
     sampling_params = sampling_params,
-    n = 15
+    n = 15,
+    backend = backend,
+    candidates = args.candidates,
+    step_feedback_tokens = args.step_feedback_tokens,
+    total_feedback_tokens = args.total_feedback_tokens,
+    budget = BudgetScheduler(
+        base_budget = args.max_tokens,
+        global_budget = args.global_token_budget
+    ) if args.adaptive_budget else None,
+    journal = journal,
+    resume_state = resume_state,
+    pools = pools,
+    route_databases = args.route_databases,
+    isolation = args.isolation,
+    clones = clones,
+    guard = guard,
+    reader = ResultReader(
+        itersize = args.fetch_batch_rows,
+        max_rows = args.max_result_rows,
+        max_bytes = args.max_result_mb * 1024 ** 2
+    ),
+    result_cache = ResultCache(max_bytes = args.result_cache_mb * 1024 ** 2) if args.result_cache_mb else None,
+    max_repeat_streak = args.max_repeat_streak,
+    plan_screen = PlanScreen(
+        max_cost = args.explain_max_cost,
+        max_rows = args.explain_max_rows,
+        action = args.explain_action,
+        downgrade_timeout_ms = args.explain_timeout_ms
+    ) if args.explain_max_cost is not None or args.explain_max_rows is not None else None,
+    scheduler = ConflictScheduler(
+        gt_sql = {entry['instance_id']: entry['sol_sql'] for entry in load_dataset('../../data/bc-1-fexp/data/GTsql_filtered.jsonl')},
+        max_held = max(args.stateful_batch_size, args.pool_size // 2),
+        max_isolated = args.clones if clones else None
+    ) if args.schedule == 'conflict' else None,
+    comparator = comparator
 )
 
 model.load_model()
 
 dataset = []
 
-with open("../psql_db/postgres_cred.json", 'r') as file:
-    cred = json.load(file) 
+warm_conns = max(args.concurrency if args.async_eval else 1, args.candidates)
+for db_name in sorted({model.context.route(sample, cred['db_name']) for sample in data}):
+    pools.warm(db_name, warm_conns)
 
 
-for sample in data:
-    
-    instance_id = sample['instance_id'] 
-    
-    status, response = model.generate(
-        sample,
-        db_name = cred['db_name'],
-        user = cred['super_user'],
-        password = cred['password']
-        )
+responses = {}
 
+def save_response(instance_id, status, response):
+    responses[instance_id] = response
     output_filename = f"../../data/bc-1-fexp/data/responses/response_{instance_id}.csv"
     
     os.makedirs(os.path.dirname(output_filename), exist_ok=True)
@@ -79,4 +273,144 @@ for sample in data:
             logger.info(f"Response for instance {instance_id} saved to {output_filename}")
         except Exception as e:
             logger.error(f"Error saving response for instance {instance_id}: {e}")
-            sys.exit(1)
\ No newline at end of file
+            sys.exit(1)
+
+
+interrupted = None
+try:
+    run_start = time.perf_counter()
+
+    if args.async_eval:
+        pipeline = AsyncPipeline(
+            backend = model.model,
+            n = model.n,
+            sampling_params = model.sampling_params,
+            db_name = cred['db_name'],
+            user = cred['super_user'],
+            password = cred['password'],
+            concurrency = args.concurrency,
+            context = model.context,
+            stateful_batch_size = args.stateful_batch_size
+            )
+        outcomes = asyncio.run(pipeline.run(data))
+        for sample, (status, response) in zip(data, outcomes):
+            save_response(sample['instance_id'], status, response)
+
+    elif args.batch:
+        outcomes = model.generate_batch(
+            data,
+            db_name = cred['db_name'],
+            user = cred['super_user'],
+            password = cred['password'],
+            stateful_batch_size = args.stateful_batch_size
+            )
+        for sample, (status, response) in zip(data, outcomes):
+            save_response(sample['instance_id'], status, response)
+
+    else:
+        for sample in data:
+        
+            instance_id = sample['instance_id'] 
+        
+            status, response = model.generate(
+                sample,
+                db_name = cred['db_name'],
+                user = cred['super_user'],
+                password = cred['password']
+                )
+
+            save_response(instance_id, status, response)
+
+except Interrupted as e:
+    interrupted = e.signum
+finally:
+    # pools and clone databases go on an interrupt or error too
+    try:
+        model.context.close()
+    finally:
+        journal.close()
+
+if interrupted is not None:
+    logger.info(f"Received signal {interrupted}, flushed run journal in {run_dir}")
+    sys.exit(128 + interrupted)
+
+if args.run_tests:
+    from util_scripts.test_cases import TestCaseRunner
+    gt_records = {entry['instance_id']: entry for entry in load_dataset('../../data/bc-1-fexp/data/GTsql_filtered.jsonl')}
+    test_runner = TestCaseRunner(
+        cred['super_user'],
+        cred['password'],
+        workers = args.test_workers,
+        timeout_s = args.test_timeout_s
+    )
+    # instances finished before a --resume keep their earlier grades; ones without a grade yet,
+    # and every instance of this run, are graded from their final response in the journal
+    results_path = os.path.join(run_dir, 'test_results.jsonl')
+    graded = {}
+    if os.path.exists(results_path):
+        for record in load_dataset(results_path):
+            graded[record['instance_id']] = record
+    final_responses = {
+        instance_id: entry['response'] for instance_id, entry in RunJournal.load(run_dir).items() if entry['finished']
+    }
+    final_responses.update(responses)
+    jobs = []
+    for sample in all_data:
+        instance_id = sample['instance_id']
+        if instance_id in graded and instance_id not in responses:
+            continue
+        pred_sql = ExecSQL.extract_sql(final_responses.get(instance_id) or '')
+        if pred_sql and instance_id in gt_records:
+            jobs.append(TestCaseRunner.job(
+                sample, gt_records[instance_id], [pred_sql], model.context.route(sample, cred['db_name'])
+            ))
+    test_results = test_runner.run(jobs)
+    for instance_id, outcomes in test_results.items():
+        graded[instance_id] = {
+            'instance_id': instance_id,
+            'passed': TestCaseRunner.passed(outcomes),
+            'tests': [outcome.to_dict() for outcome in outcomes]
+        }
+    with open(results_path, 'w') as file:
+        for instance_id in sorted(graded):
+            file.write(json.dumps(graded[instance_id]) + '\n')
+    passed = sum(record['passed'] for record in graded.values())
+    logger.info(
+        f"Test cases: {passed}/{len(all_data)} instances passed, {len(all_data) - len(graded)} without a query to test "
+        f"({len(test_results)} graded in this run)"
+    )
+
+run_wall = time.perf_counter() - run_start
+backend_stats = model.backend.stats()
+logger.info(
+    f"Run finished in {run_wall:.1f}s: {backend_stats['calls']} {backend_stats['backend']} calls, "
+    f"{backend_stats['busy_s']:.1f}s in the model, {run_wall - backend_stats['busy_s']:.1f}s harness overhead"
+)
+if 'cache' in backend_stats:
+    logger.info(f"Completion cache: {backend_stats['cache']}")
+for step, entry in model.context.prefix_stats.report().items():
+    logger.info(f"Prefix cache step {step}: {entry['requests']} requests, hit ratio {entry['hit_ratio']:.2f}")
+logger.info(f"Feedback compaction: {model.context.compactor.stats()}")
+for step, entry in model.context.decode_stats.report().items():
+    logger.info(f"Decoded tokens step {step}: {entry['decoded_tokens']} over {entry['completions']} completions")
+if model.context.budget:
+    logger.info(f"Token budget: {model.context.budget.stats()}")
+for db_name, entry in pools.stats().items():
+    logger.info(
+        f"Connection pool {db_name}: {entry['checkouts']} checkouts, {entry['connects']} connects, "
+        f"{entry['reconnects']} reconnects, {entry['wait_s']:.2f}s waiting"
+    )
+for db_name, clone_pool in clones.items():
+    logger.info(f"Clone pool {db_name}: {clone_pool.stats()}")
+if guard:
+    logger.info(f"Execution guard: {guard.stats()}")
+logger.info(f"Result reads: {model.context.reader.stats()}")
+if model.context.result_cache:
+    logger.info(f"Result cache: {model.context.result_cache.stats()}")
+logger.info(f"Repeated queries: {model.context.repeats.report()}")
+if model.context.plan_screen:
+    logger.info(f"Plan screen: {model.context.plan_screen.stats()}")
+if model.context.scheduler:
+    logger.info(f"Conflict schedule: {model.context.scheduler.report()}")
+if args.run_tests:
+    logger.info(f"Test case runner: {test_runner.stats()}")
@@ -0,0 +1,109 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class FeedbackCompactor:
+    """
+    renders execution feedback for the next turn within token budgets, using the run's --tokenizer.
+
+    result sets keep head_rows first and tail_rows last rows plus the row count, an error already
+    shown in this episode is referenced instead of repeated, and each turn's feedback is cut at
+    step_budget tokens. once a conversation passes total_budget tokens, its oldest turns collapse
+    into one line summaries, always keeping the keep_recent latest turns in full. tokens_saved
+    counts what the raw str(results) feedback would have cost on top of what was sent.
+    """
+    def __init__(self, token_counter, step_budget=1024, total_budget=8192, head_rows=5, tail_rows=2,
+                 keep_recent=2, sample_rows=20):
+        self.token_counter = token_counter
+        self.step_budget = step_budget
+        self.total_budget = total_budget
+        self.head_rows = head_rows
+        self.tail_rows = tail_rows
+        self.keep_recent = keep_recent
+        self.sample_rows = sample_rows
+        self.tokens_saved = 0
+        self.turns_collapsed = 0
+        self._lock = threading.Lock()
+
+    def raw_tokens(self, results):
+        """estimate the tokens of str(results) from a sample of rows, without rendering all of them."""
+        if not isinstance(results, list) or len(results) <= self.sample_rows:
+            return self.token_counter.count(str(results))
+        sample = results[:self.sample_rows]
+        per_row = self.token_counter.count(str(sample)) / len(sample)
+        return int(per_row * getattr(results, 'row_count', len(results)))
+
+    def render_rows(self, results):
+        count = getattr(results, 'row_count', len(results))
+        if count > len(results):
+            # only the first rows of the result were kept
+            lines = [str(row) for row in results[:self.head_rows]]
+            lines.append(f"... ({count - min(len(results), self.head_rows)} more rows) ...")
+        elif count <= self.head_rows + self.tail_rows:
+            lines = [str(row) for row in results]
+        else:
+            omitted = count - self.head_rows - self.tail_rows
+            lines = [str(row) for row in results[:self.head_rows]]
+            lines.append(f"... ({omitted} rows omitted) ...")
+            lines += [str(row) for row in results[count - self.tail_rows:]]
+        if getattr(results, 'oversized', False):
+            lines.append(f"(more than {count} rows, stopped reading: the result is too large)")
+        else:
+            lines.append(f"({count} rows)")
+        return "\n".join(lines)
+
+    @staticmethod
+    def summarize(sql, status, results):
+        sql = " ".join(sql.split()) if sql else "(no SQL)"
+        if len(sql) > 120:
+            sql = sql[:117] + "..."
+        if not status:
+            first_line = str(results).strip().splitlines()[0] if str(results).strip() else "error"
+            return f"{sql} -> error: {first_line}"
+        if not isinstance(results, list):
+            return f"{sql} -> incorrect"
+        return f"{sql} -> {getattr(results, 'row_count', len(results))} rows, incorrect"
+
+    def render(self, conversation, step, sql, status, results):
+        """
+        :return: (feedback, summary) for a turn of the conversation.
+        """
+        summary = self.summarize(sql, status, results)
+        if not status:
+            message = str(results).strip()
+            first_step = conversation.seen_errors.setdefault(message, step)
+            if first_step != step:
+                feedback = f"Same error as the attempt at step {first_step}."
+            else:
+                feedback = message
+        elif isinstance(results, list):
+            feedback = self.render_rows(results)
+        else:
+            feedback = str(results)
+
+        if self.token_counter.count(feedback) > self.step_budget:
+            feedback = self.token_counter.truncate(feedback, self.step_budget) + "\n... (truncated)"
+
+        saved = self.raw_tokens(results) - self.token_counter.count(feedback)
+        with self._lock:
+            self.tokens_saved += max(saved, 0)
+        return feedback, summary
+
+    def compact(self, conversation):
+        """collapse the oldest turns until the conversation fits total_budget."""
+        while self.token_counter.count(conversation.render()) > self.total_budget:
+            older = conversation.turns[:max(len(conversation.turns) - self.keep_recent, 0)]
+            collapsible = [turn for turn in older if not turn.collapsed and turn.summary]
+            if not collapsible:
+                break
+            before = self.token_counter.count(conversation.render())
+            if not conversation.collapse(1):
+                break
+            with self._lock:
+                self.tokens_saved += before - self.token_counter.count(conversation.render())
+                self.turns_collapsed += 1
+
+    def stats(self):
+        return {'tokens_saved': self.tokens_saved, 'turns_collapsed': self.turns_collapsed}
@@ -0,0 +1,189 @@
+import hashlib
+import re
+import threading
+from decimal import Decimal, InvalidOperation
+
+
+class SQLFingerprint:
+    """
+    fingerprints of SQL text that stay the same across whitespace, comments, keyword and
+    identifier case, number formatting (1.50, 1.5 and 15e-1 are one literal), alias names and
+    whether an alias is introduced with AS.
+
+    aliases (the name after AS, a bare name right after a table in FROM / JOIN or after a
+    parenthesized expression) are renamed a1, a2, ... in order of definition, together with the
+    uses an alias binds: a table alias where it qualifies a column, a column alias in ORDER BY /
+    GROUP BY. so queries that differ only in what they call their aliases share a fingerprint,
+    while a real column that happens to share an alias's name is never renamed. quoted
+    identifiers and string literals are kept verbatim.
+    """
+    TOKEN = re.compile(
+        r"""
+        (?P<comment>--[^\n]*|/\*.*?\*/)
+        |(?P<string>[EeBbXxNn]?'(?:[^']|'')*')
+        |(?P<quoted>"(?:[^"]|"")*")
+        |(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+        |(?P<word>[A-Za-z_][A-Za-z_0-9$]*)
+        |(?P<op>::|<=|>=|<>|!=|\|\||[^\sA-Za-z_0-9])
+        """,
+        re.VERBOSE | re.DOTALL,
+    )
+    # words that can follow a table in FROM / JOIN without being its alias
+    NOT_ALIAS = {
+        'where', 'join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'natural', 'on', 'using',
+        'group', 'order', 'having', 'limit', 'offset', 'union', 'intersect', 'except', 'window', 'as',
+        'lateral', 'fetch', 'for', 'returning', 'tablesample', 'only', 'select', 'with', 'and', 'or',
+    }
+
+    @classmethod
+    def tokens(cls, sql):
+        tokens = []
+        for match in cls.TOKEN.finditer(sql):
+            kind = match.lastgroup
+            text = match.group()
+            if kind == 'comment':
+                continue
+            if kind == 'word':
+                text = text.lower()
+            elif kind == 'number':
+                try:
+                    value = Decimal(text).normalize()
+                    text = format(value, 'f')
+                except InvalidOperation:
+                    pass
+            tokens.append((kind, text))
+        while tokens and tokens[-1] == ('op', ';'):
+            tokens.pop()
+        return tokens
+
+    @classmethod
+    def aliases(cls, tokens):
+        """:return: (position, name, 'table' or 'column') of every alias definition, in order."""
+        aliases = []
+        # outer holds in_from and the word before every open parenthesis, e.g. cast
+        in_from, outer = False, []
+        for i, (kind, text) in enumerate(tokens):
+            if (kind, text) == ('op', '('):
+                outer.append((in_from, tokens[i - 1][1] if i else None))
+            elif (kind, text) == ('op', ')'):
+                in_from = outer.pop()[0] if outer else False
+            if kind == 'word' and text in ('from', 'join'):
+                in_from = True
+            elif kind == 'word' and text in cls.NOT_ALIAS - {'as', 'join', 'only', 'lateral'}:
+                in_from = False
+            following = tokens[i + 1] if i + 1 < len(tokens) else None
+            if following is None or following[0] != 'word':
+                continue
+            scope = 'table' if in_from else 'column'
+            if kind == 'word' and text == 'as':
+                # the type of CAST(x AS type) is not an alias
+                if not (outer and outer[-1][1] == 'cast') and following[1] not in cls.NOT_ALIAS:
+                    aliases.append((i + 1, following[1], scope))
+            elif (kind, text) == ('op', ')') and following[1] not in cls.NOT_ALIAS:
+                # a bare alias after an expression or subquery, e.g. MAX(amount) max_amount
+                after = tokens[i + 2] if i + 2 < len(tokens) else None
+                if in_from or after is None or after[1] in (',', 'from'):
+                    aliases.append((i + 1, following[1], scope))
+            elif in_from and kind in ('word', 'quoted') and text not in cls.NOT_ALIAS and following[1] not in cls.NOT_ALIAS:
+                previous = tokens[i - 1] if i else None
+                if previous and previous[1] in ('from', 'join', ','):
+                    aliases.append((i + 1, following[1], 'table'))
+        return aliases
+
+    @classmethod
+    def alias_uses(cls, tokens, aliases):
+        """
+        positions of the tokens naming an alias: its definition, a table alias qualifying a column
+        (alias.column) and a column alias in ORDER BY / GROUP BY. a column alias whose name is also
+        used as a plain column reference is left alone, since that use may be a real column.
+        """
+        definitions = {i for i, _, _ in aliases}
+        tables = {name for _, name, scope in aliases if scope == 'table'}
+        columns = {name for _, name, scope in aliases if scope == 'column'}
+        sorting, depth, sort_depth = False, 0, None
+        qualifiers, sorted_uses, plain = set(), {}, set()
+        for i, (kind, text) in enumerate(tokens):
+            if (kind, text) == ('op', '('):
+                depth += 1
+            elif (kind, text) == ('op', ')'):
+                depth -= 1
+                if sort_depth is not None and depth < sort_depth:
+                    sorting, sort_depth = False, None
+            if kind != 'word':
+                continue
+            previous = tokens[i - 1] if i else None
+            following = tokens[i + 1] if i + 1 < len(tokens) else None
+            if text == 'by' and previous in (('word', 'order'), ('word', 'group')):
+                sorting, sort_depth = True, depth
+            elif text in cls.NOT_ALIAS - {'as', 'and', 'or'} and sort_depth == depth:
+                sorting, sort_depth = False, None
+            if i in definitions or previous == ('op', '.'):
+                continue
+            if following == ('op', '.'):
+                if text in tables:
+                    qualifiers.add(i)
+            elif following == ('op', '('):
+                continue
+            elif text in columns and sorting:
+                sorted_uses.setdefault(text, []).append(i)
+            else:
+                plain.add(text)
+        kept = {name for name in columns if name not in plain}
+        uses = {i for i, name, scope in aliases if scope == 'table' or name in kept}
+        uses |= qualifiers
+        uses |= {i for name in kept for i in sorted_uses.get(name, [])}
+        return uses
+
+    @classmethod
+    def canonical(cls, sql):
+        tokens = cls.tokens(sql)
+        aliases = cls.aliases(tokens)
+        uses = cls.alias_uses(tokens, aliases)
+        definitions = {i for i, _, _ in aliases}
+        names = {}
+        for i, name, _ in aliases:
+            if i in uses and name not in names:
+                names[name] = f"a{len(names) + 1}"
+        words = []
+        for i, (kind, text) in enumerate(tokens):
+            # AS before an alias is optional
+            if (kind, text) == ('word', 'as') and i + 1 in definitions:
+                continue
+            words.append(names[text] if i in uses and kind == 'word' else text)
+        return " ".join(words)
+
+    @classmethod
+    def of(cls, sql):
+        return hashlib.sha1(cls.canonical(sql).encode('utf-8')).hexdigest()
+
+
+class RepeatStats:
+    """
+    per instance count of candidates whose fingerprint the instance already submitted, the
+    signal behind --max_repeat_streak.
+    """
+    def __init__(self):
+        self.instances = {}
+        self._lock = threading.Lock()
+
+    def record(self, instance_id, candidates, repeats):
+        with self._lock:
+            entry = self.instances.setdefault(instance_id, {'candidates': 0, 'repeats': 0})
+            entry['candidates'] += candidates
+            entry['repeats'] += repeats
+
+    def report(self):
+        with self._lock:
+            candidates = sum(entry['candidates'] for entry in self.instances.values())
+            repeats = sum(entry['repeats'] for entry in self.instances.values())
+            worst = sorted(
+                ((entry['repeats'] / entry['candidates'], instance_id) for instance_id, entry in self.instances.items()
+                 if entry['candidates']),
+                reverse=True,
+            )[:5]
+        return {
+            'candidates': candidates,
+            'repeats': repeats,
+            'repeat_rate': repeats / candidates if candidates else 0.0,
+            'highest_repeat_rates': [(instance_id, round(rate, 2)) for rate, instance_id in worst],
+        }
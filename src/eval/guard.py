@@ -0,0 +1,188 @@
+import contextlib
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+
+import psycopg2.errors
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+
+class TimedOut(str):
+    """feedback of a query that ran into a limit; not a property of the query alone, so never cached."""
+
+
+class StatementLimits:
+    """
+    server side limits set on a conn before model written SQL runs on it, plus the wall clock
+    limit after which the Watchdog cancels the statement from another thread. a limit of 0 is off.
+
+    statement_timeout and lock_timeout are SET LOCAL and put back after the statement, so nothing
+    else in the transaction (preprocess and clean up SQL of held conns) nor the next user of a
+    pooled conn runs under them. idle_in_transaction_timeout_ms only matters between statements,
+    so it is set on the session of a conn checked out per candidate and reset when it goes back,
+    see idle_limit. conns an episode holds never get it: a stateful episode keeps its transaction
+    open while the model generates, and the server would end it.
+    """
+    SETTINGS = ('statement_timeout', 'lock_timeout')
+
+    def __init__(self, statement_timeout_ms=30000, lock_timeout_ms=5000, idle_in_transaction_timeout_ms=60000,
+                 wall_timeout_s=None):
+        self.statement_timeout_ms = statement_timeout_ms
+        self.lock_timeout_ms = lock_timeout_ms
+        self.idle_in_transaction_timeout_ms = idle_in_transaction_timeout_ms
+        self.wall_timeout_s = wall_timeout_s if wall_timeout_s is not None else statement_timeout_ms / 1000 + 10
+
+    def apply(self, cursor):
+        cursor.execute(
+            f"SET LOCAL statement_timeout = {int(self.statement_timeout_ms)}; "
+            f"SET LOCAL lock_timeout = {int(self.lock_timeout_ms)}"
+        )
+
+    def reset(self, cursor):
+        """put the conn's own settings back; an aborted or lost transaction drops them with its rollback."""
+        if cursor.connection.closed or (
+            cursor.connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        ):
+            return
+        cursor.execute("; ".join(f"SET LOCAL {setting} TO DEFAULT" for setting in self.SETTINGS))
+
+    @contextlib.contextmanager
+    def idle_limit(self, conn):
+        """idle_in_transaction_session_timeout on the session of a pooled conn while the with block has it checked out."""
+        with conn.cursor() as cursor:
+            cursor.execute(f"SET idle_in_transaction_session_timeout = {int(self.idle_in_transaction_timeout_ms)}")
+        conn.commit()
+        try:
+            yield
+        finally:
+            try:
+                if not conn.closed:
+                    conn.rollback()
+                    with conn.cursor() as cursor:
+                        cursor.execute("RESET idle_in_transaction_session_timeout")
+                    conn.commit()
+            except psycopg2.Error as e:
+                # e.g. the server ended the session for idling; the pool replaces a closed conn
+                logger.warning("Could not reset idle_in_transaction_session_timeout, closing the conn: %s", e)
+                conn.close()
+
+
+class Watchdog:
+    """
+    one thread that cancels statements still running past their deadline, with conn.cancel.
+    """
+    def __init__(self):
+        self.cancelled = 0
+        self._heap = []
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sql-watchdog', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        with self._cond:
+            while True:
+                while self._heap and not self._heap[0][2]['active']:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, _, entry = self._heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                logger.warning("Watchdog: cancelling a statement past its %.0fs wall clock limit.", entry['seconds'])
+                try:
+                    entry['conn'].cancel()
+                    self.cancelled += 1
+                except Exception as e:
+                    logger.error("Watchdog: cancel failed: %s", e)
+
+    @contextlib.contextmanager
+    def watch(self, conn, seconds):
+        if not seconds:
+            yield
+            return
+        entry = {'conn': conn, 'seconds': seconds, 'active': True}
+        with self._cond:
+            self._start()
+            heapq.heappush(self._heap, (time.monotonic() + seconds, next(self._ids), entry))
+            self._cond.notify()
+        try:
+            yield
+        finally:
+            with self._cond:
+                entry['active'] = False
+
+
+class ExecutionGuard:
+    """
+    StatementLimits per issue_type, the Watchdog enforcing their wall clock limits, and counts of
+    the statements that ran into one. overrides maps an issue_type to the limits that differ from
+    the defaults, e.g. {"Management": {"statement_timeout_ms": 60000}}.
+    """
+    TIMEOUTS = (psycopg2.extensions.QueryCanceledError, psycopg2.errors.LockNotAvailable)
+
+    def __init__(self, defaults=None, overrides=None):
+        self.defaults = dict(defaults or {})
+        self.overrides = overrides or {}
+        self.watchdog = Watchdog()
+        self.timeouts = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path, defaults=None):
+        with open(path, 'r') as file:
+            return cls(defaults, json.load(file))
+
+    def limits(self, issue_type):
+        with self._lock:
+            if issue_type not in self._limits:
+                self._limits[issue_type] = StatementLimits(**dict(self.defaults, **self.overrides.get(issue_type, {})))
+            return self._limits[issue_type]
+
+    @contextlib.contextmanager
+    def guarded(self, cursor, issue_type):
+        """apply the limits of issue_type to the cursor's conn and watch the statement run in the with block."""
+        limits = self.limits(issue_type)
+        limits.apply(cursor)
+        try:
+            with self.watchdog.watch(cursor.connection, limits.wall_timeout_s):
+                yield limits
+        except self.TIMEOUTS:
+            with self._lock:
+                self.timeouts[issue_type] = self.timeouts.get(issue_type, 0) + 1
+            raise
+        finally:
+            limits.reset(cursor)
+
+    def feedback(self, error, limits, statement_timeout_ms=None):
+        """
+        a short message telling the model its query ran out of time.
+
+        :param statement_timeout_ms: The timeout the statement ran under when it is not the limit's,
+            e.g. the PlanScreen's downgrade timeout.
+        """
+        if statement_timeout_ms is None:
+            statement_timeout_ms = limits.statement_timeout_ms
+        return TimedOut(
+            f"Query cancelled: it ran longer than the {statement_timeout_ms / 1000:.0f}s limit "
+            f"or waited on a lock for over {limits.lock_timeout_ms / 1000:.0f}s ({str(error).strip()}). "
+            "Avoid unbounded joins and recursion."
+        )
+
+    def stats(self):
+        with self._lock:
+            return {'timeouts': dict(self.timeouts), 'watchdog_cancels': self.watchdog.cancelled}
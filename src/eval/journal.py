@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RunJournal:
+    """
+    append-only record of a run in <run_dir>/journal.jsonl.
+
+    one 'step' record per finished correction step (prompt hash, completions, extracted SQL,
+    execution status, verdict and the turns it added to the conversation) and one 'instance'
+    record when an instance finishes. records are written through to the OS right away and
+    fsynced every fsync_every records or fsync_interval_s seconds, whichever comes first; close
+    fsyncs whatever is left, so a SIGTERM loses nothing that was already journaled.
+    """
+    FILENAME = 'journal.jsonl'
+
+    def __init__(self, run_dir, fsync_every=32, fsync_interval_s=2.0):
+        self.run_dir = run_dir
+        self.fsync_every = fsync_every
+        self.fsync_interval_s = fsync_interval_s
+        os.makedirs(run_dir, exist_ok=True)
+        self.path = os.path.join(run_dir, self.FILENAME)
+        self._file = open(self.path, 'a')
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.RLock()
+        self.closed = False
+
+    def _write(self, record):
+        with self._lock:
+            if self.closed:
+                return
+            self._file.write(json.dumps(record, default=str) + '\n')
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval_s:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def log_step(self, instance_id, step, prompt_hash, completions, candidates, verdict, turns, seen_errors):
+        """
+        :param candidates: List of dicts with sql, status and, when it failed, the error.
+        :param turns: Dicts of the conversation turns added at this step, as Conversation.add_turn takes them.
+        """
+        self._write({
+            'type': 'step',
+            'instance_id': instance_id,
+            'step': step,
+            'prompt_hash': prompt_hash,
+            'completions': [c.to_dict() for c in completions],
+            'candidates': candidates,
+            'verdict': verdict,
+            'turns': turns,
+            'seen_errors': seen_errors,
+        })
+
+    def log_instance(self, instance_id, success, response):
+        self._write({'type': 'instance', 'instance_id': instance_id, 'success': success, 'response': response})
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self._file.flush()
+            self._sync()
+            self._file.close()
+            self.closed = True
+
+    @classmethod
+    def load(cls, run_dir):
+        """
+        :return: dict of instance_id -> {'finished', 'success', 'response', 'steps'} rebuilt from the journal.
+        """
+        path = os.path.join(run_dir, cls.FILENAME)
+        state = {}
+        if not os.path.exists(path):
+            return state
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a torn last line from a crash mid-write
+                    logger.warning("Journal %s: skipping unreadable record.", path)
+                    continue
+                entry = state.setdefault(
+                    record['instance_id'], {'finished': False, 'success': False, 'response': None, 'steps': []}
+                )
+                if record['type'] == 'step':
+                    entry['steps'].append(record)
+                elif record['type'] == 'instance':
+                    entry.update(finished=True, success=record['success'], response=record['response'])
+        return state
@@ -1,9 +1,26 @@
 import logging
+import os
 import re
-import traceback
-import psycopg2
 import sys
-from vllm import LLM, SamplingParams
+import traceback
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from backends import VLLMBackend, prompt_key
+from conversation import Conversation, PrefixStats
+from feedback import FeedbackCompactor
+from early_stop import DecodeStats
+from tokens import TokenCounter
+from guard import TimedOut
+from fingerprint import SQLFingerprint, RepeatStats
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util_scripts.db_pool import DatabasePools
+from util_scripts.result_stream import ResultReader
+from util_scripts.sql_classify import SQLClassifier
+from util_scripts.gt_store import GTStore
+from util_scripts.result_fingerprint import ResultFingerprint
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,6 +34,11 @@ logger = logging.getLogger(__name__)
 
 
 class ExecSQL:
+    SQL_PATTERN = re.compile(r"(?s).*<\/think>\s*(SELECT\s+.*?)(?:\n\s*\n|$)", re.IGNORECASE)
+    GT_STORE = '../../data/bc-1-fexp/data/gt_store.bin'
+    # rows of a candidate kept for feedback beyond what a comparison with the ground truth needs
+    PREVIEW_ROWS = 50
+
     @classmethod
     def execute_sql(cls, cursor, query, alter=False):
         """execute SQL using an existing cursor."""
@@ -32,131 +54,893 @@ class ExecSQL:
             return False, "None"
 
     @classmethod
-    def model_execute_sql(cls, cursor, query):
-        try:
+    def model_execute_sql(cls, cursor, query, guard=None, issue_type=None, reader=None, screen=None,
+                          fingerprint=False, keep=True):
+        """
+        :param guard: ExecutionGuard whose limits for issue_type bound the query; a query that runs
+            into one comes back as a short timeout message for the model.
+        :param reader: ResultReader streaming the rows through a server side cursor under its caps,
+            instead of fetchall.
+        :param screen: PlanScreen explaining the query first; a rejected plan is never run, a downgraded
+            one runs under a statement_timeout that is put back afterwards.
+        :param fingerprint: With a reader, fingerprint the rows as they arrive, see ResultFingerprint.
+        :param keep: With a reader, keep only this many rows (True keeps all of them).
+        """
+        # the statement_timeout of a candidate whose plan the screen downgraded
+        downgraded_ms = []
+
+        def run():
+            if screen is None:
+                return execute()
+            with screen.screening(cursor, query) as (rejected, timeout_ms):
+                if rejected is not None:
+                    return False, rejected
+                if timeout_ms is not None:
+                    downgraded_ms.append(timeout_ms)
+                return execute()
+
+        def execute():
+            if reader is not None:
+                sink = ResultFingerprint() if fingerprint else None
+                rows = reader.read(cursor.connection, query, sinks=(sink,) if sink else (), keep=keep)
+                rows.fingerprint = sink
+                return True, rows
             cursor.execute(query)
-            results = cursor.fetchall()
-            return True, results
+            return True, cursor.fetchall()
+
+        try:
+            if guard is None:
+                return run()
+            with guard.guarded(cursor, issue_type):
+                return run()
         except Exception as e:
             error_message = str(e)
             match = re.search(r"SyntaxError.*?(LINE .*)", error_message, re.DOTALL)
             sql_error = match.group(1) if match else error_message
+            if guard is not None and isinstance(e, guard.TIMEOUTS):
+                sql_error = guard.feedback(e, guard.limits(issue_type), downgraded_ms[0] if downgraded_ms else None)
             logger.error("Model SQL Execution Error: %s", sql_error)
             logger.error(traceback.format_exc())
             return False, sql_error
 
     @classmethod
-    def process_queries(cls, model, n, sample, db_name, user, password, sampling_params):
+    def execute_in_savepoint(cls, cursor, query, name='candidate', **options):
+        """execute a candidate under a savepoint and roll back to it once its results are captured."""
+        cursor.execute(f"SAVEPOINT {name}")
+        try:
+            return cls.model_execute_sql(cursor, query, **options)
+        finally:
+            cursor.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            cursor.execute(f"RELEASE SAVEPOINT {name}")
+
+    @classmethod
+    def execute_and_rollback(cls, conn, query, **options):
+        """execute a candidate in its own transaction and roll it back once its results are captured."""
+        with conn.cursor() as cursor:
+            status, results = cls.model_execute_sql(cursor, query, **options)
+        conn.rollback()
+        return status, results
+
+    @classmethod
+    def execute_candidate(cls, pools, db_name, query, **options):
+        """
+        execute a candidate on a pooled conn and roll it back so the conn goes back clean. with a
+        guard, the conn's session has the idle_in_transaction_session_timeout of issue_type while
+        it is checked out.
+        """
+        with pools.connection(db_name) as conn:
+            guard = options.get('guard')
+            if guard is None:
+                return cls.execute_and_rollback(conn, query, **options)
+            with guard.limits(options.get('issue_type')).idle_limit(conn):
+                return cls.execute_and_rollback(conn, query, **options)
+
+    @classmethod
+    def is_correct(cls, results, gt_out, comparator=None):
+        """
+        :param results: rows of a candidate, or its error message.
+        :param gt_out: GTEntry of the instance. row counts and, for fingerprinted results, the
+            fingerprints decide most comparisons; rows are only compared once both match. without
+            an ORDER BY in the solution, rows match in any order.
+        :param comparator: optional ResultComparator comparing rows with tolerance instead; a
+            matching fingerprint still decides without it.
+        """
+        if not isinstance(results, list) or getattr(results, 'oversized', False) or gt_out.oversized:
+            return False
+        row_count = getattr(results, 'row_count', len(results))
+        fingerprint = getattr(results, 'fingerprint', None)
+        fingerprinted = fingerprint is not None and gt_out.fingerprint is not None
+        if comparator is not None:
+            exact = fingerprinted and row_count == gt_out.row_count and fingerprint.value(gt_out.ordered) == gt_out.fingerprint
+            if exact and (row_count or comparator.empty_matches) and (gt_out.ordered or comparator.semantics != 'ordered'):
+                return True
+            if (comparator.counts_rows and row_count != gt_out.row_count) or len(results) < row_count:
+                return False
+            return comparator.equal(list(results), gt_out.rows, ordered=gt_out.ordered)
+        if row_count != gt_out.row_count:
+            return False
+        if fingerprinted and fingerprint.value(gt_out.ordered) != gt_out.fingerprint:
+            return False
+        if len(results) != gt_out.row_count:
+            return False
+        rows, gt_rows = [tuple(row) for row in results], gt_out.rows
+        if not gt_out.ordered:
+            rows = sorted(rows, key=ResultFingerprint.row_key)
+            gt_rows = sorted(gt_rows, key=ResultFingerprint.row_key)
+        return rows == gt_rows
+
+    @classmethod
+    def build_task(cls, sample):
+        return (
+            "Database: {}\n\nQuery: {}\n\nErroneous PSQL Query:\n{}\n"
+            .format(sample['selected_database'], sample['query'], "\n".join(sample['error_sql']))
+        )
+
+    @classmethod
+    def extract_sql(cls, response):
+        """pull the corrected SELECT out of a completion, or None if there is none."""
+        match = cls.SQL_PATTERN.search(response)
+        return match.group(1).strip() if match else None
+
+    @classmethod
+    def setup_sql(cls, sample):
+        return (sample.get('preprocess_sql') or []) + (sample.get('clean_up_sql') or [])
+
+    @classmethod
+    def is_stateful(cls, sample):
+        """True if the instance changes db state through preprocess or clean up SQL."""
+        return not SQLClassifier.read_only(cls.setup_sql(sample))
+
+    @classmethod
+    def needs_clone(cls, sample):
+        """True if the instance's preprocess or clean up SQL has statements a rollback cannot undo."""
+        return cls.is_stateful(sample) and not SQLClassifier.transactional(cls.setup_sql(sample))
+
+    @classmethod
+    def refusal(cls, query):
+        """
+        :return: feedback for a candidate that must not run outside a clone, as nothing could undo
+            it (VACUUM, nextval, CREATE DATABASE, COMMIT, ...), or None.
+        """
+        for statement in SQLClassifier.classify_all(query):
+            if not statement.transactional:
+                what = statement.verb if statement.kind != 'write' else 'Advancing a sequence'
+                return (f"{what} cannot be rolled back, the query was not run. "
+                        "Submit a query that runs inside a transaction.")
+        return None
+
+    @classmethod
+    def run_preprocess(cls, conn, cursor, sample, savepoints=False):
+        """
+        :param savepoints: Run each statement under a savepoint, so a failing one is undone on
+            its own instead of rolling back the whole transaction.
+        """
+        instance_id = sample['instance_id']
+        preprocess_sql = sample['preprocess_sql']
+        if not preprocess_sql:
+            return
+        if not isinstance(preprocess_sql, list):
+            raise ValueError(f"Instance {instance_id}: 'preprocess_sql' is not a list.")
+        for ppsql in preprocess_sql:
+            logger.info("Instance %s: Preprocessing SQL: %s", instance_id, ppsql)
+            if savepoints:
+                cursor.execute("SAVEPOINT preprocess")
+            status, _ = cls.execute_sql(cursor, ppsql, alter=True)
+            if status:
+                logger.info("Instance %s: Preprocessing succeeded.", instance_id)
+                if savepoints:
+                    cursor.execute("RELEASE SAVEPOINT preprocess")
+            elif savepoints:
+                logger.error("Instance %s: Preprocessing failed. Rolling back to savepoint.", instance_id)
+                cursor.execute("ROLLBACK TO SAVEPOINT preprocess")
+            else:
+                logger.error("Instance %s: Preprocessing failed. Rolling back.", instance_id)
+                conn.rollback()
+
+    @classmethod
+    def run_clean_up(cls, conn, cursor, sample):
+        instance_id = sample['instance_id']
+        clean_up_sql = sample['clean_up_sql']
+        if not clean_up_sql:
+            logger.info("Instance %s: No cleanup SQL provided.", instance_id)
+            return
+        for csql in clean_up_sql:
+            logger.info("Instance %s: Cleaning up SQL: %s", instance_id, csql)
+            status, _ = cls.execute_sql(cursor, csql, alter=True)
+            if status:
+                logger.info("Instance %s: Cleanup succeeded.", instance_id)
+            else:
+                logger.error("Instance %s: Cleanup failed. Rolling back.", instance_id)
+                conn.rollback()
+
+    @classmethod
+    def load_gt(cls, instance_id):
+        gt_out = GTStore.open(cls.GT_STORE).get(instance_id)
+        if gt_out is None:
+            raise KeyError(f"Instance {instance_id}: No ground truth in {cls.GT_STORE}.")
+        return gt_out
+
+    @classmethod
+    def process_queries(cls, model, n, sample, db_name, user, password, sampling_params, context=None):
         """
-        process queries in batch using a single db conn.
+        correction loop of a single instance as an Episode: up to n steps, each sampling the
+        context's candidates and executing them on pooled conns (or the episode's own conn for
+        stateful instances) until one is correct.
 
         :param n: Number of steps for the LLM.
         :param sample: Dictionary containing instance_id, query, etc.
+        :param context: EpisodeContext shared by all instances of the run.
+        :return: (False if the episode failed with an error, else True, its last response).
         """
+        episode = Episode(sample, context)
         try:
-            conn = psycopg2.connect(dbname=db_name, user=user, password=password)
-            cursor = conn.cursor()
-
-            instance_id = sample['instance_id']
-            selected_database = sample['selected_database']
-            query = sample['query']
-            error_sql = sample['error_sql']
-            preprocess_sql = sample['preprocess_sql']
-            clean_up_sql = sample['clean_up_sql']
-
-            payload = (
-                "Think step by step about how to correct the SQL query.\n\n"
-                "Only output the corrected SQL query. Do not include any explanations, reasoning, or extra text.\n\n"
-                "Database: {}\n\nQuery: {}\n\nErroneous PSQL Query:\n{}\n"
-                .format(selected_database, query, "\n".join(error_sql))
+            episode.open(db_name, user, password)
+            while not episode.done and episode.next_step < n:
+                params = episode.step_params(episode.next_step, sampling_params)
+                if params is None:
+                    break
+                logger.info(f"Input to LLM: {episode.payload}")
+                completions = model.generate(prompts=[episode.payload], sampling_params=params)[0]
+                episode.observe(episode.next_step, completions)
+            episode.close()
+            return True, episode.response
+
+        except Exception as e:
+            episode.abort(e)
+            return False, episode.response
+
+    @classmethod
+    def process_batch(cls, model, n, samples, db_name, user, password, sampling_params, stateful_batch_size=1,
+                      context=None):
+        """
+        step-synchronous correction loop over many instances.
+
+        every unfinished instance contributes its payload to a single model.generate call per step,
+        instances leave the batch once they are correct or out of steps. stateful instances keep an
+        open transaction holding locks on the tables they alter, so they only share a batch with at
+        most stateful_batch_size - 1 other stateful instances, after all stateless ones are done.
+        stateful instances on a clone of their own lock nothing shared; they run last, in waves of
+        at most as many instances of a database as its clone pool holds, so none waits for a clone
+        the rest of its wave keeps leased. with a ConflictScheduler on the context, waves instead hold every instance whose tables no
+        earlier instance of the wave writes, stateless or not.
+
+        :param samples: List of dictionaries containing instance_id, query, etc.
+        :return: List of (success, response) tuples, in the order of samples.
+        """
+        stateless = [s for s in samples if not cls.is_stateful(s)]
+        stateful = [s for s in samples if cls.is_stateful(s)]
+        logger.info("Batching %d stateless and %d stateful instances.", len(stateless), len(stateful))
+
+        def cloned(sample):
+            return bool(context) and cls.is_stateful(sample) and (
+                context.isolation_of(sample, context.route(sample, db_name)) == 'clone'
             )
 
-            if preprocess_sql:
-                if not isinstance(preprocess_sql, list):
-                    raise ValueError(f"Instance {instance_id}: 'preprocess_sql' is not a list.")
-                for ppsql in preprocess_sql:
-                    logger.info("Instance %s: Preprocessing SQL: %s", instance_id, ppsql)
-                    status, _ = cls.execute_sql(cursor, ppsql, alter=True)
-                    if status:
-                        logger.info("Instance %s: Preprocessing succeeded.", instance_id)
-                    else:
-                        logger.error("Instance %s: Preprocessing failed. Rolling back.", instance_id)
-                        conn.rollback()
-
-            gt_file = f'../../data/bc-1-fexp/data/gtout/query_{instance_id}_output.csv'
-            with open(gt_file, 'r') as f:
-                gt_out = f.read()
-
-            for step in range(n):
-                logger.info(f"Input to LLM: {payload}")
-                response = model.generate(prompts=payload, sampling_params=sampling_params)
-                if not isinstance(response, str):
-                    response = response[0].outputs[0].text
-                    logger.info(f"Response from LLM: {response}")
-                    if not isinstance(response, str):
-                        raise ValueError(f"Instance {instance_id}: LLM response is not a string.")
-
-                pattern = re.compile(r"(?s).*<\/think>\s*(SELECT\s+.*?)(?:\n\s*\n|$)", re.IGNORECASE)
-                match = pattern.search(response)
-                if match:
-                    response_sql = match.group(1).strip()
-                    logger.info("Instance %s: Extracted SQL: %s", instance_id, response_sql)
-                else:
-                    logger.error("Instance %s: No SQL query found in LLM response.", instance_id)
+        scheduler = context.scheduler if context else None
+        if scheduler is None:
+            waves = [stateless] if stateless else []
+            shared = [s for s in stateful if not cloned(s)]
+            waves += [shared[i:i + stateful_batch_size] for i in range(0, len(shared), stateful_batch_size)]
+            by_db = {}
+            for sample in stateful:
+                if cloned(sample):
+                    by_db.setdefault(context.route(sample, db_name), []).append(sample)
+            for clone_db, samples_of_db in by_db.items():
+                size = context.clone_pool(clone_db).size
+                waves += [samples_of_db[i:i + size] for i in range(0, len(samples_of_db), size)]
+        else:
+            waves = scheduler.waves(
+                stateless + stateful,
+                db_of=lambda sample: context.route(sample, db_name),
+                held=cls.is_stateful,
+                isolated=cloned,
+            )
+
+        outcomes = {}
+        for wave in waves:
+            episodes = [Episode(sample, context) for sample in wave]
+            wave_start = time.perf_counter()
+            # an episode that fails is aborted on its own, the rest of the wave goes on without it
+            for episode in episodes:
+                try:
+                    episode.open(db_name, user, password)
+                except Exception as e:
+                    episode.abort(e)
+            try:
+                cls.run_lockstep(model, n, [episode for episode in episodes if not episode.closed], sampling_params)
+            except Exception as e:
+                for episode in episodes:
+                    if not episode.closed:
+                        episode.abort(e)
+            for episode in episodes:
+                if episode.closed:
+                    outcomes[episode.instance_id] = (False, episode.response)
                     continue
+                try:
+                    episode.close()
+                    outcomes[episode.instance_id] = (True, episode.response)
+                except Exception as e:
+                    episode.abort(e)
+                    outcomes[episode.instance_id] = (False, episode.response)
+            if scheduler is not None:
+                scheduler.record_wave(time.perf_counter() - wave_start)
+                for episode in episodes:
+                    scheduler.record(episode.instance_id, episode.elapsed)
+
+        return [outcomes.get(sample['instance_id'], (False, None)) for sample in samples]
+
+    @classmethod
+    def run_lockstep(cls, model, n, episodes, sampling_params):
+        """one generate call per round for every episode still running; resumed episodes may be at different steps."""
+        while True:
+            active = [episode for episode in episodes if not episode.closed and not episode.done and episode.next_step < n]
+            if not active:
+                break
+            requests = [(episode, episode.step_params(episode.next_step, sampling_params)) for episode in active]
+            requests = [(episode, params) for episode, params in requests if params is not None]
+            if not requests:
+                break
+            logger.info("Generating for %d instances.", len(requests))
+            results = model.generate(
+                prompts=[episode.payload for episode, _ in requests],
+                sampling_params=[params for _, params in requests]
+            )
+            for (episode, _), completions in zip(requests, results):
+                try:
+                    episode.observe(episode.next_step, completions)
+                except Exception as e:
+                    episode.abort(e)
+        for episode in episodes:
+            episode.done = True
 
-                logger.info("Instance %s: Executing generated SQL.", instance_id)
-                status, results = cls.model_execute_sql(cursor, response_sql)
-                if status:
-                    logger.info("Instance %s: SQL executed successfully.", instance_id)
-                else:
-                    logger.error("Instance %s: SQL execution failed.", instance_id)
 
-                if results == gt_out:
-                    logger.info("Instance %s: Correct output achieved.", instance_id)
-                    return True, response
+class EpisodeContext:
+    """
+    run-wide collaborators shared by every Episode.
+
+    candidates: completions sampled per step. when above 1, candidates of stateless instances run
+    concurrently on pooled conns (candidate_workers at a time); feedback_candidates of them,
+    successful executions first, go into the next turn, rendered by the compactor.
+    pools: DatabasePools every conn is checked out from, built on first use with pool_size conns
+    per database if not given. route_databases sends each instance to its selected_database
+    instead of the db_name the run was started with.
+    isolation: 'cleanup' undoes a stateful instance by running its clean_up_sql and committing.
+    'savepoint' runs its preprocess_sql in a transaction, executes every candidate under a
+    savepoint that is rolled back once the results are captured, and
+    rolls back the whole transaction when the instance finishes, so no state outlives it.
+    'clone' leases each stateful instance a copy of its database from clones (a dict of source
+    database to ClonePool), runs its preprocess_sql in autocommit so non-transactional
+    statements work too, rolls back every candidate, and hands the copy back to be recycled.
+    'auto' picks per instance with the SQLClassifier: 'savepoint' when a rollback undoes all of
+    its preprocess and clean up SQL, else 'clone' if its database has a clone pool and 'cleanup'
+    if not. instances whose preprocess and clean up SQL only read are stateless in every mode.
+    candidates a rollback cannot undo are refused everywhere but on a clone, and mutating
+    candidates of stateless instances run one at a time after the concurrent read-only ones.
+    guard: optional ExecutionGuard with the time limits every candidate runs under.
+    reader: ResultReader candidates' rows are streamed through, capped in rows and bytes.
+    result_cache: optional ResultCache of read-only candidates' outcomes.
+    plan_screen: optional PlanScreen explaining every candidate before it runs.
+    scheduler: optional ConflictScheduler forming the waves of process_batch from the tables
+    instances read and write.
+    comparator: optional ResultComparator judging candidates with tolerance, instead of exact rows.
+    max_repeat_streak: stop an episode once this many steps in a row brought only queries it
+    had already tried (by SQLFingerprint); 0 never stops. repeats tracks the rates per instance.
+    budget: optional BudgetScheduler handing out max_tokens per instance and step.
+    journal: optional RunJournal every step and finished instance is written to.
+    resume_state: journal state of a previous run, see RunJournal.load; episodes pick up after
+    their last journaled step.
+    """
+    def __init__(self, token_counter=None, candidates=1, feedback_candidates=2, candidate_workers=8, compactor=None,
+                 budget=None, journal=None, resume_state=None, pools=None, pool_size=16, route_databases=False,
+                 isolation='cleanup', clones=None, guard=None, reader=None, result_cache=None, max_repeat_streak=0,
+                 plan_screen=None, scheduler=None, comparator=None):
+        self.token_counter = token_counter or TokenCounter()
+        self.prefix_stats = PrefixStats(self.token_counter)
+        self.compactor = compactor or FeedbackCompactor(self.token_counter)
+        self.decode_stats = DecodeStats()
+        self.budget = budget
+        self.journal = journal
+        self.resume_state = resume_state or {}
+        self.candidates = candidates
+        self.feedback_candidates = feedback_candidates
+        self.candidate_workers = candidate_workers
+        self.pools = pools
+        self.pool_size = pool_size
+        self.route_databases = route_databases
+        self.isolation = isolation
+        self.clones = clones or {}
+        self.guard = guard
+        self.reader = reader or ResultReader()
+        self.result_cache = result_cache
+        self.max_repeat_streak = max_repeat_streak
+        self.plan_screen = plan_screen
+        self.scheduler = scheduler
+        self.comparator = comparator
+        self.repeats = RepeatStats()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def connections(self, user, password):
+        with self._lock:
+            if self.pools is None:
+                self.pools = DatabasePools(user, password, max_per_db=self.pool_size)
+            return self.pools
+
+    def route(self, sample, db_name):
+        return sample['selected_database'] if self.route_databases else db_name
+
+    def isolation_of(self, sample, db_name):
+        if self.isolation != 'auto':
+            return self.isolation
+        if not ExecSQL.needs_clone(sample):
+            return 'savepoint'
+        return 'clone' if db_name in self.clones else 'cleanup'
+
+    def clone_pool(self, db_name):
+        if db_name not in self.clones:
+            raise ValueError(f"No clone pool of database {db_name} for --isolation clone.")
+        return self.clones[db_name]
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.candidate_workers)
+            return self._executor
+
+    def close(self):
+        """stop the executor, close the pools and drop the clones; safe to call more than once, and after a failed start."""
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+        if self.pools is not None:
+            self.pools.closeall()
+        for db_name, clone_pool in self.clones.items():
+            try:
+                clone_pool.close()
+            except Exception as e:
+                logger.error("Could not drop the clones of %s: %s", db_name, e)
+
+
+class Episode:
+    """
+    correction loop state of a single instance: its conversation, last response and, for stateful
+    instances, the pooled conn holding its preprocess state for the whole episode. stateless
+    instances check a conn out per execution.
+    """
+    def __init__(self, sample, context=None):
+        self.sample = sample
+        self.context = context or EpisodeContext()
+        self.instance_id = sample['instance_id']
+        self.conversation = Conversation(ExecSQL.build_task(sample))
+        self.previous_payload = None
+        self.response = None
+        self.success = False
+        self.done = False
+        self.closed = False
+        self.next_step = 0
+        self.attempts = {}
+        self.repeat_streak = 0
+        self.conn = None
+        self.cursor = None
+        self.pools = None
+        self.db_name = None
+        self.clone = None
+        self.isolation = None
+        self.started = None
+        self.last_step_at = None
+        if self.context.budget:
+            self.context.budget.register(sample)
+        if self.instance_id in self.context.resume_state:
+            self.restore(self.context.resume_state[self.instance_id]['steps'])
+
+    def restore(self, steps):
+        """
+        rebuild the conversation, the queries already tried and the repeat streak from journaled
+        steps and continue after the last one; an instance whose last step was correct is done.
+        rows of successful attempts are not journaled, a repeat of one is told it was incorrect.
+        """
+        for record in steps:
+            for turn in record['turns']:
+                self.conversation.add_turn(**turn)
+            self.conversation.seen_errors = dict(record['seen_errors'])
+            self.response = record['completions'][0]['text'] if record['completions'] else None
+            self.next_step = record['step'] + 1
+            candidates = record.get('candidates') or []
+            for candidate in candidates:
+                results = candidate['error'] if not candidate['status'] else (
+                    f"(rows of the attempt at step {record['step']}, not kept across the resume)"
+                )
+                self.attempts.setdefault(SQLFingerprint.of(candidate['sql']), (record['step'], candidate['status'], results))
+            if candidates:
+                fresh = any(candidate.get('repeat_of') is None for candidate in candidates)
+                self.repeat_streak = 0 if fresh else self.repeat_streak + 1
+            if record['verdict'] == 'correct':
+                correct_sql = candidates[-1]['sql']
+                self.response = next(
+                    (c['text'] for c in record['completions'] if ExecSQL.extract_sql(c['text']) == correct_sql),
+                    self.response,
+                )
+                self.success = True
+                self.done = True
+        if steps:
+            self.context.compactor.compact(self.conversation)
+            self.previous_payload = self.payload
+            logger.info("Instance %s: Resuming at step %d.", self.instance_id, self.next_step)
+
+    @property
+    def payload(self):
+        return self.conversation.render()
+
+    def step_params(self, step, sampling_params):
+        """
+        sampling params of this step, with max_tokens from the budget scheduler if there is one.
+
+        :return: None once the run's token budget is spent, which finishes the episode.
+        """
+        budget = self.context.budget
+        if budget is None:
+            return sampling_params
+        max_tokens = budget.allocate(self.sample, step)
+        if max_tokens <= 0:
+            logger.info("Instance %s: Token budget exhausted at step %d.", self.instance_id, step)
+            self.done = True
+            return None
+        return dict(sampling_params, max_tokens=max_tokens)
+
+    @property
+    def sandboxed(self):
+        return self.isolation == 'savepoint'
+
+    @property
+    def elapsed(self):
+        """seconds from open to the last observed step."""
+        if self.started is None or self.last_step_at is None:
+            return 0.0
+        return self.last_step_at - self.started
+
+    def open(self, db_name, user, password):
+        self.started = time.perf_counter()
+        self.pools = self.context.connections(user, password)
+        self.db_name = self.context.route(self.sample, db_name)
+        if ExecSQL.is_stateful(self.sample):
+            self.isolation = self.context.isolation_of(self.sample, self.db_name)
+            if self.isolation == 'clone':
+                self.clone = self.context.clone_pool(self.db_name).lease()
+                logger.info("Instance %s: Leased clone %s.", self.instance_id, self.clone)
+            self.conn = self.pools.getconn(self.clone or self.db_name)
+            self.cursor = self.conn.cursor()
+            if self.clone:
+                self.conn.autocommit = True
+                ExecSQL.run_preprocess(self.conn, self.cursor, self.sample)
+                self.conn.autocommit = False
+            elif self.sandboxed:
+                ExecSQL.run_preprocess(self.conn, self.cursor, self.sample, savepoints=True)
+            else:
+                ExecSQL.run_preprocess(self.conn, self.cursor, self.sample)
+        self.gt_out = ExecSQL.load_gt(self.instance_id)
+
+    def observe(self, step, completions):
+        """
+        check a step's completions against the ground truth and add turns to the conversation on failure.
+
+        :param completions: Completions the backend sampled for the current payload.
+        :return: True once the instance is finished.
+        """
+        instance_id = self.instance_id
+        self.context.prefix_stats.record(
+            step, self.previous_payload, self.payload, engine_cached_tokens=completions[0].num_cached_tokens
+        )
+        prompt_hash = prompt_key(self.payload)
+        self.previous_payload = self.payload
+        self.response = completions[0].text
+        self.next_step = step + 1
+        decoded = self.context.decode_stats.record(step, completions)
+        logger.info("Instance %s: Decoded %d tokens at step %d.", instance_id, decoded, step)
+
+        turns_before = len(self.conversation.turns)
+        verdict, candidates = self.judge(step, completions)
+        self.last_step_at = time.perf_counter()
+
+        if self.context.budget:
+            self.context.budget.record(self.sample, step, completions, verdict == 'correct')
+        if self.context.journal:
+            self.context.journal.log_step(
+                instance_id, step, prompt_hash, completions, candidates, verdict,
+                turns=[turn.to_dict() for turn in self.conversation.turns[turns_before:]],
+                seen_errors=self.conversation.seen_errors
+            )
+        return verdict == 'correct'
+
+    def judge(self, step, completions):
+        """
+        :return: verdict ('correct', 'incorrect' or 'no_sql') and a summary of every executed candidate.
+        """
+        instance_id = self.instance_id
+        responses, fingerprints = {}, {}
+        for completion in completions:
+            response = completion.text
+            logger.info(f"Response from LLM: {response}")
+            if not isinstance(response, str):
+                raise ValueError(f"Instance {instance_id}: LLM response is not a string.")
+            response_sql = ExecSQL.extract_sql(response)
+            if response_sql:
+                logger.info("Instance %s: Extracted SQL: %s", instance_id, response_sql)
+                fingerprint = SQLFingerprint.of(response_sql)
+                if fingerprint not in fingerprints.values():
+                    responses[response_sql] = response
+                    fingerprints[response_sql] = fingerprint
+            else:
+                logger.error("Instance %s: No SQL query found in LLM response.", instance_id)
+
+        if not responses:
+            self.conversation.add_turn(
+                step, None, "No SQL query found in the response.", summary="no SQL query found in the response"
+            )
+            self.context.compactor.compact(self.conversation)
+            return 'no_sql', []
+
+        repeated = [sql for sql in responses if fingerprints[sql] in self.attempts]
+        fresh = [sql for sql in responses if fingerprints[sql] not in self.attempts]
+        self.context.repeats.record(instance_id, len(responses), len(repeated))
+        self.repeat_streak = 0 if fresh else self.repeat_streak + 1
+
+        outcomes, candidates = [], []
+        for response_sql, status, results in self.attempt(repeated, fresh, fingerprints):
+            if status:
+                logger.info("Instance %s: SQL executed successfully.", instance_id)
+            else:
+                logger.error("Instance %s: SQL execution failed.", instance_id)
+            first_step = self.attempts.setdefault(fingerprints[response_sql], (step, status, results))[0]
+            candidates.append({
+                'sql': response_sql, 'status': status, 'error': None if status else results,
+                'repeat_of': first_step if first_step != step else None,
+            })
+
+            if ExecSQL.is_correct(results, self.gt_out, self.context.comparator):
+                logger.info("Instance %s: Correct output achieved.", instance_id)
+                self.response = responses[response_sql]
+                self.success = True
+                self.done = True
+                return 'correct', candidates
+            outcomes.append((response_sql, status, results))
+
+        logger.info("Instance %s: Incorrect output at step %d.", instance_id, step)
+        compactor = self.context.compactor
+        for candidate, (response_sql, status, results) in enumerate(self.rank_feedback(outcomes)):
+            feedback, summary = compactor.render(self.conversation, step, response_sql, status, results)
+            first_step = self.attempts[fingerprints[response_sql]][0]
+            if first_step != step:
+                feedback = f"Same query as the attempt at step {first_step}, with the same outcome."
+            self.conversation.add_turn(
+                step, response_sql, feedback, candidate=candidate if len(outcomes) > 1 else None, summary=summary
+            )
+        compactor.compact(self.conversation)
+
+        max_streak = self.context.max_repeat_streak
+        if max_streak and self.repeat_streak >= max_streak:
+            logger.info("Instance %s: Only repeated queries for %d steps, stopping.", instance_id, self.repeat_streak)
+            self.done = True
+        return 'incorrect', candidates
+
+    def attempt(self, repeated, fresh, fingerprints):
+        """
+        yield (sql, status, results) per candidate: the remembered outcome for a query this episode
+        already ran in another form, then the executions of the new ones.
+        """
+        for sql in repeated:
+            first_step, status, results = self.attempts[fingerprints[sql]]
+            logger.info("Instance %s: Query already tried at step %d, reusing its outcome.", self.instance_id, first_step)
+            yield sql, status, results
+        if fresh:
+            yield from self.execute_candidates(fresh)
+
+    @property
+    def keep_rows(self):
+        """rows of a candidate to keep: what a comparison with the ground truth can use, and a preview for feedback."""
+        comparator = self.context.comparator
+        if self.gt_out.fingerprint is None or (comparator is not None and not comparator.counts_rows):
+            return True
+        return max(self.gt_out.row_count, ExecSQL.PREVIEW_ROWS)
+
+    @property
+    def cache_scope(self):
+        """the state candidates run against: the shared database, or this episode's own preprocessed view of it."""
+        if self.conn is None:
+            return self.db_name
+        return f"{self.clone or self.db_name}#{self.instance_id}"
+
+    def execute_candidates(self, sqls):
+        """
+        yield (sql, status, results) per candidate, read-only ones already in the result cache
+        first, then the rest in completion order when run one by one and as they finish when run
+        concurrently. closing the generator early (first correct candidate) cancels candidates
+        that have not started.
+        """
+        cache = self.context.result_cache
+        pending = []
+        for sql in sqls:
+            hit = cache.get(self.cache_scope, sql) if cache and cache.is_read_only(sql) else None
+            if hit is None:
+                pending.append(sql)
+            else:
+                logger.info("Instance %s: Reusing the cached result of a candidate.", self.instance_id)
+                yield (sql,) + hit
+        if not pending:
+            return
+
+        runs = self.run_candidates(pending)
+        try:
+            for sql, status, results in runs:
+                if cache:
+                    self.remember(cache, sql, status, results)
+                yield sql, status, results
+        finally:
+            runs.close()
+
+    def remember(self, cache, sql, status, results):
+        if cache.is_read_only(sql):
+            # rows kept for this instance's ground truth only would not do for another one
+            truncated = isinstance(results, list) and getattr(results, 'row_count', len(results)) > len(results)
+            if not isinstance(results, TimedOut) and not truncated:
+                cache.put(self.cache_scope, sql, status, results)
+        elif self.conn is not None and not self.clone and not self.sandboxed:
+            # the candidate ran on the episode's conn and was not rolled back
+            cache.bump(self.cache_scope)
+
+    def run_candidates(self, sqls):
+        logger.info("Instance %s: Executing %d generated SQL candidates.", self.instance_id, len(sqls))
+        options = {
+            'guard': self.context.guard, 'issue_type': self.sample.get('issue_type'), 'reader': self.context.reader,
+            'screen': self.context.plan_screen, 'fingerprint': self.gt_out.fingerprint is not None,
+            'keep': self.keep_rows,
+        }
+        if self.clone:
+            for sql in sqls:
+                yield (sql,) + ExecSQL.execute_and_rollback(self.conn, sql, **options)
+            return
+        refused = {sql: ExecSQL.refusal(sql) for sql in sqls}
+        for sql in sqls:
+            if refused[sql]:
+                logger.info("Instance %s: Refused a candidate: %s", self.instance_id, refused[sql])
+                yield sql, False, refused[sql]
+        sqls = [sql for sql in sqls if not refused[sql]]
+        if self.conn is not None:
+            for sql in sqls:
+                if self.sandboxed:
+                    yield (sql,) + ExecSQL.execute_in_savepoint(self.cursor, sql, **options)
                 else:
-                    logger.info("Instance %s: Incorrect output at step %d.", instance_id, step)
-                    payload += f"\nResults from previous correction attempt at step {step}:\n{results}"
-
-            if clean_up_sql:
-                for csql in clean_up_sql:
-                    logger.info("Instance %s: Cleaning up SQL: %s", instance_id, csql)
-                    status, _ = cls.execute_sql(cursor, csql, alter=True)
-                    if status:
-                        logger.info("Instance %s: Cleanup succeeded.", instance_id)
-                    else:
-                        logger.error("Instance %s: Cleanup failed. Rolling back.", instance_id)
-                        conn.rollback()
+                    yield (sql,) + ExecSQL.model_execute_sql(self.cursor, sql, **options)
+            return
+        # mutating candidates are rolled back too, but would block each other on the shared database
+        writes = [sql for sql in sqls if not SQLClassifier.read_only(sql)]
+        reads = [sql for sql in sqls if sql not in writes]
+        if len(reads) == 1:
+            yield (reads[0],) + ExecSQL.execute_candidate(self.pools, self.db_name, reads[0], **options)
+        elif reads:
+            futures = {
+                self.context.executor.submit(ExecSQL.execute_candidate, self.pools, self.db_name, sql, **options): sql
+                for sql in reads
+            }
+            try:
+                for future in as_completed(futures):
+                    yield (futures[future],) + future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+        for sql in writes:
+            yield (sql,) + ExecSQL.execute_candidate(self.pools, self.db_name, sql, **options)
+
+    def rank_feedback(self, outcomes):
+        """pick the candidates worth showing the model: distinct results, successful executions first."""
+        ranked, seen = [], set()
+        for outcome in sorted(outcomes, key=lambda outcome: not outcome[1]):
+            key = str(outcome[2])
+            if key in seen:
+                continue
+            seen.add(key)
+            ranked.append(outcome)
+        return ranked[:self.context.feedback_candidates]
+
+    def finish(self):
+        if self.context.budget:
+            self.context.budget.finish(self.sample)
+
+    def close(self):
+        self.finish()
+        if self.conn is not None and not self.clone:
+            if self.sandboxed:
+                logger.info("Instance %s: Rolling back the instance transaction.", self.instance_id)
+                self.conn.rollback()
             else:
-                logger.info("Instance %s: No cleanup SQL provided.", instance_id)
+                ExecSQL.run_clean_up(self.conn, self.cursor, self.sample)
+                self.conn.commit()
+                if self.context.result_cache:
+                    self.context.result_cache.bump(self.db_name)
+            self.cursor.close()
+        self.release()
+        self.closed = True
+        if self.context.journal:
+            self.context.journal.log_instance(self.instance_id, self.success, self.response)
 
-            conn.commit()
-            cursor.close()
-            conn.close()
-            return True, response
+    def abort(self, e):
+        logger.error("Instance %s: Database connection error: %s", self.instance_id, e)
+        logger.error(traceback.format_exc())
+        self.finish()
+        self.release()
+        self.closed = True
 
-        except Exception as e:
-            inst = sample.get('instance_id', 'unknown')
-            logger.error("Instance %s: Database connection error: %s", inst, e)
-            logger.error(traceback.format_exc())
-            if 'conn' in locals() and conn:
-                conn.close()
-            sys.exit(1)
+    def release(self):
+        """give back the episode's conn and, with --isolation clone, its clone to be recycled."""
+        if self.context.result_cache and self.conn is not None:
+            self.context.result_cache.drop(self.cache_scope)
+        if self.clone:
+            if self.conn is not None:
+                self.pools.putconn(self.clone, self.conn, close=True)
+            self.pools.discard(self.clone)
+            self.context.clone_pool(self.db_name).release(self.clone)
+            self.clone = None
+        elif self.conn is not None:
+            self.pools.putconn(self.db_name, self.conn)
+        self.conn = None
 
 
 class Model:
-    def __init__(self, model_name: str, tokenizer: str, sampling_params: dict, n=15):
+    def __init__(self, model_name: str, tokenizer: str, sampling_params: dict, n=15, backend=None, candidates=1,
+                 step_feedback_tokens=1024, total_feedback_tokens=8192, budget=None, journal=None, resume_state=None,
+                 pools=None, route_databases=False, isolation='cleanup', clones=None, guard=None, reader=None,
+                 result_cache=None, max_repeat_streak=0, plan_screen=None, scheduler=None, comparator=None):
         """
         n: max steps.
+        backend: generation backend, defaults to vllm.
+        candidates: completions sampled per step.
+        step_feedback_tokens, total_feedback_tokens: feedback budgets of a single turn and of the whole history.
+        budget: optional BudgetScheduler for per-step max_tokens.
+        journal, resume_state: optional RunJournal to write to and journal state of a run to resume.
+        pools: DatabasePools the run checks its conns out from.
+        route_databases: connect each instance to its selected_database.
+        isolation: 'cleanup', 'savepoint', 'clone' or 'auto', see EpisodeContext.
+        clones: ClonePool per source database, for --isolation clone and auto.
+        guard: optional ExecutionGuard limiting how long candidates run.
+        reader: ResultReader capping how much of a candidate's result is read.
+        result_cache: optional ResultCache reusing outcomes of read-only candidates.
+        max_repeat_streak: stop an instance after this many steps of only already tried queries.
+        plan_screen: optional PlanScreen rejecting candidates with too expensive plans.
+        scheduler: optional ConflictScheduler running instances on disjoint tables in the same batch wave.
+        comparator: optional ResultComparator accepting results within tolerance, as ex_base does.
         """
         self.model_name = model_name
         self.tokenizer = tokenizer
-        self.sampling_params = SamplingParams(**sampling_params)
+        self.sampling_params = dict(sampling_params)
         self.n = n
+        self.backend = backend or VLLMBackend(model_name, tokenizer)
+        token_counter = TokenCounter(tokenizer)
+        self.context = EpisodeContext(
+            token_counter=token_counter,
+            candidates=candidates,
+            compactor=FeedbackCompactor(
+                token_counter, step_budget=step_feedback_tokens, total_budget=total_feedback_tokens
+            ),
+            budget=budget,
+            journal=journal,
+            resume_state=resume_state,
+            pools=pools,
+            route_databases=route_databases,
+            isolation=isolation,
+            clones=clones,
+            guard=guard,
+            reader=reader,
+            result_cache=result_cache,
+            max_repeat_streak=max_repeat_streak,
+            plan_screen=plan_screen,
+            scheduler=scheduler,
+            comparator=comparator
+        )
+        if candidates > 1:
+            self.sampling_params['n'] = candidates
 
     def load_model(self):
-        self.model = LLM(model=self.model_name, tokenizer=self.tokenizer)
+        self.backend.load()
+        self.model = self.backend
 
     def generate(self, sample, db_name, user, password):
         success, response = ExecSQL.process_queries(
@@ -166,6 +950,20 @@ class Model:
             db_name=db_name,
             user=user,
             password=password,
-            sampling_params=self.sampling_params
+            sampling_params=self.sampling_params,
+            context=self.context
         )
         return success, response
+
+    def generate_batch(self, samples, db_name, user, password, stateful_batch_size=1):
+        return ExecSQL.process_batch(
+            model=self.model,
+            n=self.n,
+            samples=samples,
+            db_name=db_name,
+            user=user,
+            password=password,
+            sampling_params=self.sampling_params,
+            stateful_batch_size=stateful_batch_size,
+            context=self.context
+        )
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from model import Episode, ExecSQL
+
+logger = logging.getLogger(__name__)
+
+
+class PhaseTimer:
+    """
+    records when generation and db work are in flight, to measure how much they overlap.
+    """
+    def __init__(self):
+        self.intervals = {'generate': [], 'db': []}
+        self.start = time.perf_counter()
+
+    def record(self, phase, start, end):
+        self.intervals[phase].append((start, end))
+
+    @staticmethod
+    def merge(intervals):
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    @classmethod
+    def busy(cls, intervals):
+        return sum(end - start for start, end in cls.merge(intervals))
+
+    @classmethod
+    def intersect(cls, a, b):
+        a, b = cls.merge(a), cls.merge(b)
+        i = j = 0
+        total = 0.0
+        while i < len(a) and j < len(b):
+            lo = max(a[i][0], b[j][0])
+            hi = min(a[i][1], b[j][1])
+            if lo < hi:
+                total += hi - lo
+            if a[i][1] < b[j][1]:
+                i += 1
+            else:
+                j += 1
+        return total
+
+    def report(self):
+        wall = time.perf_counter() - self.start
+        generate = self.busy(self.intervals['generate'])
+        db = self.busy(self.intervals['db'])
+        overlap = self.intersect(self.intervals['generate'], self.intervals['db'])
+        return {
+            'wall_s': wall,
+            'generate_busy_s': generate,
+            'db_busy_s': db,
+            'overlap_s': overlap,
+            'overlap_frac_of_db': overlap / db if db else 0.0,
+            'serial_estimate_s': generate + db,
+        }
+
+
+class AsyncPipeline:
+    """
+    runs every instance as a coroutine: generation goes through the backend's async interface while db work
+    (preprocess, candidate execution, comparison, clean up) runs on a thread pool, so one
+    instance's SQL executes while other instances are decoding.
+
+    stateful instances keep an open transaction holding locks on the tables they alter, so as in
+    ExecSQL.process_batch they run after every stateless instance is done, at most
+    stateful_batch_size at a time. instances on a clone of their own run with the stateless ones.
+    """
+    def __init__(self, backend, n, sampling_params, db_name, user, password, concurrency=8, context=None,
+                 stateful_batch_size=1):
+        self.backend = backend
+        self.context = context
+        self.n = n
+        self.sampling_params = sampling_params
+        self.db_name = db_name
+        self.user = user
+        self.password = password
+        self.concurrency = concurrency
+        self.stateful_batch_size = stateful_batch_size
+        self.timer = None
+
+    def holds_locks(self, sample):
+        """True if the instance holds uncommitted changes to a shared database for its whole episode."""
+        if not ExecSQL.is_stateful(sample):
+            return False
+        if self.context is None:
+            return True
+        return self.context.isolation_of(sample, self.context.route(sample, self.db_name)) != 'clone'
+
+    async def generate(self, prompt, sampling_params):
+        return await self.backend.agenerate(prompt, sampling_params)
+
+    async def timed(self, phase, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.timer.record(phase, start, time.perf_counter())
+
+    async def run_instance(self, sample, semaphore, executor):
+        loop = asyncio.get_running_loop()
+
+        def db(fn, *args):
+            return self.timed('db', loop.run_in_executor(executor, fn, *args))
+
+        async with semaphore:
+            episode = Episode(sample, self.context)
+            try:
+                await db(episode.open, self.db_name, self.user, self.password)
+                while not episode.done and episode.next_step < self.n:
+                    params = episode.step_params(episode.next_step, self.sampling_params)
+                    if params is None:
+                        break
+                    completions = await self.timed('generate', self.generate(episode.payload, params))
+                    await db(episode.observe, episode.next_step, completions)
+                await db(episode.close)
+                return True, episode.response
+            except Exception as e:
+                episode.abort(e)
+                return False, episode.response
+
+    async def run(self, samples):
+        """
+        :return: List of (success, response) tuples, in the order of samples.
+        """
+        self.timer = PhaseTimer()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        first = [i for i, sample in enumerate(samples) if not self.holds_locks(sample)]
+        last = [i for i, sample in enumerate(samples) if self.holds_locks(sample)]
+        logger.info("Async run: %d instances, then %d holding locks.", len(first), len(last))
+        outcomes = [None] * len(samples)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            stateful_semaphore = asyncio.Semaphore(min(self.stateful_batch_size, self.concurrency))
+            for phase, limit in ((first, semaphore), (last, stateful_semaphore)):
+                results = await asyncio.gather(
+                    *(self.run_instance(samples[i], limit, executor) for i in phase)
+                )
+                for i, outcome in zip(phase, results):
+                    outcomes[i] = outcome
+        stats = self.timer.report()
+        logger.info(
+            "Async run: wall %.1fs, generate busy %.1fs, db busy %.1fs, overlap %.1fs (%.0f%% of db time hidden).",
+            stats['wall_s'], stats['generate_busy_s'], stats['db_busy_s'], stats['overlap_s'],
+            100 * stats['overlap_frac_of_db']
+        )
+        return outcomes
@@ -0,0 +1,132 @@
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+
+import psycopg2.extensions
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util_scripts.sql_classify import SQLClassifier
+
+logger = logging.getLogger(__name__)
+
+
+class PlanTooExpensive(str):
+    """feedback of a candidate rejected by the PlanScreen without running it."""
+
+
+class PlanScreen:
+    """
+    pre-flight EXPLAIN (FORMAT JSON) of model written SQL. planning takes microseconds where a
+    runaway execution on tables like trans or cards can take minutes.
+
+    a plan whose estimated total cost is above max_cost or whose estimated row count is above
+    max_rows is either rejected, so the candidate never runs and the model is told its plan is
+    too expensive, or, with action 'downgrade', run under a statement_timeout of
+    downgrade_timeout_ms while it runs. a limit of None is off. a query that does not plan fails
+    with the same error its execution would give.
+
+    only the statements EXPLAIN can plan are explained (SELECT, DML, ...): costs are summed and the
+    largest row estimate counts. a candidate whose first statement is DDL, SET, CREATE INDEX and the
+    like is not screened, and statements after such a one are left out, since they may use what it creates.
+    """
+    PLANNABLE = {'SELECT', 'WITH', 'VALUES', 'TABLE', 'INSERT', 'UPDATE', 'DELETE', 'MERGE'}
+
+    def __init__(self, max_cost=None, max_rows=None, action='reject', downgrade_timeout_ms=5000):
+        self.max_cost = max_cost
+        self.max_rows = max_rows
+        self.action = action
+        self.downgrade_timeout_ms = downgrade_timeout_ms
+        self.screened = 0
+        self.rejected = 0
+        self.downgraded = 0
+        self.explain_s = 0.0
+        self._lock = threading.Lock()
+
+    def plannable(self, query):
+        """the statements of query up to the first one EXPLAIN cannot plan."""
+        statements = []
+        for statement in SQLClassifier.classify_all(query):
+            if statement.verb not in self.PLANNABLE or statement.kind not in ('read', 'write', 'lock'):
+                break
+            statements.append(statement.sql)
+        return statements
+
+    def estimate(self, cursor, statements):
+        """:return: (total cost, plan rows) of the statements' plans."""
+        cost, rows = 0.0, 0.0
+        for statement in statements:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + statement)
+            plan = cursor.fetchone()[0][0]['Plan']
+            cost += plan['Total Cost']
+            rows = max(rows, plan['Plan Rows'])
+        return cost, rows
+
+    def over(self, cost, rows):
+        return (self.max_cost is not None and cost > self.max_cost) or (self.max_rows is not None and rows > self.max_rows)
+
+    @contextlib.contextmanager
+    def screening(self, cursor, query):
+        """
+        explain the query and act on its estimates before it runs in the with block. a downgraded
+        statement_timeout is put back afterwards, so it does not outlive the candidate on a conn
+        held for the rest of the episode.
+
+        :return: (PlanTooExpensive feedback if the candidate must not run, else None, the
+            statement_timeout in ms it runs under if downgraded, else None).
+        """
+        rejected, previous = self._check(cursor, query)
+        try:
+            yield rejected, self.downgrade_timeout_ms if previous is not None else None
+        finally:
+            conn = cursor.connection
+            if previous is not None and not conn.closed and (
+                conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+            ):
+                cursor.execute("SELECT set_config('statement_timeout', %s, true)", (previous,))
+
+    def _check(self, cursor, query):
+        """:return: (PlanTooExpensive or None, statement_timeout before a downgrade or None)."""
+        statements = self.plannable(query)
+        if not statements:
+            return None, None
+        start = time.perf_counter()
+        cost, rows = self.estimate(cursor, statements)
+        over = self.over(cost, rows)
+        with self._lock:
+            self.screened += 1
+            self.explain_s += time.perf_counter() - start
+            if over and self.action == 'reject':
+                self.rejected += 1
+            elif over:
+                self.downgraded += 1
+        if not over:
+            return None, None
+        if self.action == 'downgrade':
+            logger.info("Plan screen: estimated cost %.0f, %.0f rows, running under a %d ms timeout.",
+                        cost, rows, self.downgrade_timeout_ms)
+            cursor.execute("SELECT current_setting('statement_timeout')")
+            previous = cursor.fetchone()[0]
+            cursor.execute(f"SET LOCAL statement_timeout = {int(self.downgrade_timeout_ms)}")
+            return None, previous
+        logger.info("Plan screen: rejected a plan with estimated cost %.0f, %.0f rows.", cost, rows)
+        return PlanTooExpensive(
+            f"Plan too expensive, the query was not run: estimated cost {cost:.0f} (limit {self.limit(self.max_cost)}), "
+            f"estimated {rows:.0f} rows (limit {self.limit(self.max_rows)}). "
+            "Check for missing join conditions or filters."
+        ), None
+
+    @staticmethod
+    def limit(value):
+        return 'none' if value is None else f"{value:.0f}"
+
+    def stats(self):
+        with self._lock:
+            return {
+                'screened': self.screened,
+                'rejected': self.rejected,
+                'downgraded': self.downgraded,
+                'explain_s': self.explain_s,
+            }
@@ -0,0 +1,117 @@
+import collections
+import os
+import re
+import sys
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util_scripts.sql_classify import SQLClassifier
+
+
+class ResultCache:
+    """
+    byte bounded LRU of execution outcomes, (status, rows or error text), of read-only candidate
+    SQL, keyed by (scope, state version, normalized SQL).
+
+    a scope is a database whose state every stateless episode shares, or a single episode's view
+    of its own preprocessed state. bump moves a scope to a new state version once committed
+    preprocess or DML changed what it holds; entries of older versions are dropped right away.
+    only statements is_read_only accepts are cached, so a hit can never hide a side effect.
+    """
+    VOLATILE = re.compile(
+        r"\b(random|now|clock_timestamp|statement_timestamp|transaction_timestamp|timeofday|current_timestamp|"
+        r"current_time|current_date|localtime|localtimestamp|nextval|setval|currval|gen_random_uuid|txid_current|pg_\w+)\b",
+        re.IGNORECASE,
+    )
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.versions = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(sql):
+        return " ".join(sql.split()).rstrip(";").strip()
+
+    @classmethod
+    def is_read_only(cls, sql):
+        """a single statement the SQLClassifier reads as read-only that calls no volatile functions."""
+        statements = SQLClassifier.classify_all(sql)
+        if len(statements) != 1 or not statements[0].read_only or statements[0].verb not in ('SELECT', 'WITH'):
+            return False
+        return not cls.VOLATILE.search(sql)
+
+    @staticmethod
+    def size(status, results):
+        if not status or not isinstance(results, list):
+            return sys.getsizeof(str(results))
+        nbytes = getattr(results, 'nbytes', None)
+        if nbytes is None:
+            nbytes = sum(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in results)
+        return nbytes + sys.getsizeof(results)
+
+    def version(self, scope):
+        with self._lock:
+            return self.versions.get(scope, 0)
+
+    def bump(self, scope):
+        """start a new state version of scope and drop the entries of the old one."""
+        with self._lock:
+            self.versions[scope] = self.versions.get(scope, 0) + 1
+            stale = [key for key in self.entries if key[0] == scope]
+            for key in stale:
+                self.nbytes -= self.entries.pop(key)[2]
+            self.invalidations += len(stale)
+
+    def get(self, scope, sql):
+        """:return: the cached (status, results), or None."""
+        with self._lock:
+            key = (scope, self.versions.get(scope, 0), self.normalize(sql))
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, scope, sql, status, results):
+        size = self.size(status, results)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            key = (scope, self.versions.get(scope, 0), self.normalize(sql))
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[2]
+            self.entries[key] = (status, results, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+
+    def drop(self, scope):
+        """forget a scope whose state is gone, e.g. a finished episode's."""
+        with self._lock:
+            for key in [key for key in self.entries if key[0] == scope]:
+                self.nbytes -= self.entries.pop(key)[2]
+            self.versions.pop(scope, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
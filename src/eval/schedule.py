@@ -0,0 +1,147 @@
+import logging
+import os
+import sys
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util_scripts.sql_classify import SQLClassifier
+
+logger = logging.getLogger(__name__)
+
+
+class TableAccess:
+    """tables of one database an instance reads and writes, from all of its SQL."""
+    def __init__(self, db_name, reads=(), writes=(), isolated=False):
+        self.db_name = db_name
+        self.reads = frozenset(reads)
+        self.writes = frozenset(writes)
+        self.isolated = isolated
+
+    @classmethod
+    def of(cls, db_name, sqls, isolated=False):
+        reads, writes = set(), set()
+        for statement in (statement for sql in sqls if sql for statement in SQLClassifier.split(sql)):
+            statement_reads, statement_writes = SQLClassifier.tables(statement)
+            reads |= statement_reads
+            writes |= statement_writes
+        return cls(db_name, reads - writes, writes, isolated)
+
+    def conflicts(self, other):
+        """True if one of the two writes a table the other reads or writes, on the same database."""
+        if self.isolated or other.isolated or self.db_name != other.db_name:
+            return False
+        if SQLClassifier.ANY_TABLE in self.writes | other.writes and (self.reads | self.writes) and (other.reads | other.writes):
+            return True
+        return bool(self.writes & (other.reads | other.writes) or other.writes & self.reads)
+
+
+class ConflictScheduler:
+    """
+    splits a batch into waves of instances that can run at the same time on the same database.
+
+    the tables each instance reads and writes come from its preprocess, erroneous, solution
+    (gt_sql, instance_id to sol_sql) and clean up SQL. two instances conflict when one writes a
+    table the other touches; instances on a clone of their own (isolated) conflict with nothing.
+    instances keep the order of the batch: each one goes into the first wave after every earlier
+    instance it conflicts with that still has room. a wave holds at most max_held instances with an
+    episode conn of their own (held) and at most max_isolated isolated instances per database, the
+    size of its clone pool.
+
+    report gives the achieved parallelism (instance seconds over wave seconds) and the critical
+    path: the longest chain of conflicting instances, which bounds how fast any schedule in this
+    order could get.
+    """
+    def __init__(self, gt_sql=None, max_held=16, max_isolated=None):
+        self.gt_sql = gt_sql or {}
+        self.max_held = max_held
+        self.max_isolated = max_isolated
+        self.instances = {}
+        self.wave_of = {}
+        self.after = {}
+        self.durations = {}
+        self.wave_seconds = []
+        self._lock = threading.Lock()
+
+    def access(self, sample, db_name, isolated=False):
+        sqls = [
+            *(sample.get('preprocess_sql') or []),
+            *(sample.get('error_sql') or []),
+            *self.gt_sql.get(sample['instance_id'], []),
+            *(sample.get('clean_up_sql') or []),
+        ]
+        return TableAccess.of(db_name, sqls, isolated)
+
+    def waves(self, samples, db_of, held, isolated):
+        """
+        :param db_of: database an instance runs on.
+        :param held: True for instances holding an episode conn for their whole run.
+        :param isolated: True for instances running on a clone of their own.
+        :return: the samples in waves, lists to run one after the other.
+        """
+        waves, held_counts, isolated_counts = [], [], []
+        placed = []
+        for sample in samples:
+            instance_id = sample['instance_id']
+            access = self.access(sample, db_of(sample), isolated(sample))
+            conflicts = [other for other, other_access in placed if access.conflicts(other_access)]
+            wave = max((self.wave_of[other] + 1 for other in conflicts), default=0)
+            while wave < len(waves) and self.full(access, held(sample), held_counts[wave], isolated_counts[wave]):
+                wave += 1
+            if wave == len(waves):
+                waves.append([])
+                held_counts.append(0)
+                isolated_counts.append({})
+            waves[wave].append(sample)
+            held_counts[wave] += bool(held(sample))
+            if access.isolated:
+                isolated_counts[wave][access.db_name] = isolated_counts[wave].get(access.db_name, 0) + 1
+            placed.append((instance_id, access))
+            with self._lock:
+                self.instances[instance_id] = access
+                self.wave_of[instance_id] = wave
+                self.after[instance_id] = conflicts
+        logger.info(
+            "Scheduled %d instances in %d waves: %s.", len(samples), len(waves), [len(wave) for wave in waves]
+        )
+        return waves
+
+    def full(self, access, held, held_count, isolated_counts):
+        if held and held_count >= self.max_held:
+            return True
+        return (access.isolated and self.max_isolated is not None
+                and isolated_counts.get(access.db_name, 0) >= self.max_isolated)
+
+    def record(self, instance_id, seconds):
+        with self._lock:
+            self.durations[instance_id] = seconds
+
+    def record_wave(self, seconds):
+        with self._lock:
+            self.wave_seconds.append(seconds)
+
+    def critical_path(self):
+        """:return: (seconds, instance ids) of the longest chain of conflicting instances."""
+        longest = {}
+        for instance_id in self.wave_of:
+            before = max((longest[other] for other in self.after[instance_id]), default=(0.0, []))
+            longest[instance_id] = (before[0] + self.durations.get(instance_id, 0.0), before[1] + [instance_id])
+        return max(longest.values(), default=(0.0, []))
+
+    def report(self):
+        with self._lock:
+            widths = {}
+            for wave in self.wave_of.values():
+                widths[wave] = widths.get(wave, 0) + 1
+            busy = sum(self.durations.values())
+            wall = sum(self.wave_seconds)
+            seconds, path = self.critical_path()
+            return {
+                'instances': len(self.wave_of),
+                'waves': len(widths),
+                'max_wave': max(widths.values(), default=0),
+                'mean_wave': len(self.wave_of) / len(widths) if widths else 0.0,
+                'conflicts': sum(len(after) for after in self.after.values()),
+                'parallelism': busy / wall if wall else 0.0,
+                'critical_path_s': seconds,
+                'critical_path': path,
+            }
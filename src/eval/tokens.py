@@ -0,0 +1,49 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCounter:
+    """
+    counts tokens with the run's --tokenizer.
+
+    the hf tokenizer is loaded on first use; if transformers or the tokenizer is unavailable
+    (e.g. on cpu-only boxes running the stub backend) counts fall back to chars_per_token.
+    """
+    def __init__(self, tokenizer=None, chars_per_token=4):
+        self.tokenizer_name = tokenizer
+        self.chars_per_token = chars_per_token
+        self._tokenizer = None
+        self._loaded = False
+
+    def _load(self):
+        self._loaded = True
+        if not self.tokenizer_name:
+            return
+        try:
+            from transformers import AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+        except Exception as e:
+            logger.warning("Could not load tokenizer %s (%s), approximating token counts.", self.tokenizer_name, e)
+
+    def encode(self, text):
+        if not self._loaded:
+            self._load()
+        if self._tokenizer is None:
+            return None
+        return self._tokenizer.encode(text, add_special_tokens=False)
+
+    def count(self, text):
+        ids = self.encode(text)
+        if ids is None:
+            return -(-len(text) // self.chars_per_token)
+        return len(ids)
+
+    def truncate(self, text, max_tokens):
+        """cut text down to at most max_tokens tokens."""
+        ids = self.encode(text)
+        if ids is None:
+            return text[:max_tokens * self.chars_per_token]
+        if len(ids) <= max_tokens:
+            return text
+        return self._tokenizer.decode(ids[:max_tokens])
@@ -1,9 +1,17 @@
-import psycopg2
-import csv
+import argparse
 import sys
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from util_scripts.db_pool import DatabasePools
+from util_scripts.result_stream import ResultReader
+from util_scripts.gt_store import GTStoreWriter
+from util_scripts.result_fingerprint import ResultFingerprint
+from util_scripts.sql_classify import SQLClassifier
+from util_scripts.clone_pool import ClonePool
 
 logging.basicConfig(
     level=logging.INFO, 
@@ -16,11 +24,22 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--route_databases', action='store_true', help="run each instance on its selected_database instead of the db_name in postgres_cred.json")
+parser.add_argument('--workers', type=int, default=1, help="instances collected at once, each in a transaction that is rolled back; 1 runs them in order with their clean up SQL")
+parser.add_argument('--clones', type=int, default=0, help="with --workers, clones per database for instances a rollback cannot undo; 0 runs those one at a time after the others")
+
+reader = ResultReader()
+
 def execute_sql(cursor, query, alter=False):
-    """Execute SQL using an existing cursor."""
+    """Execute SQL using an existing cursor; results are streamed through a server side cursor."""
     try:
-        cursor.execute(query)
-        results = cursor.fetchall() if not alter else None  
+        if alter:
+            cursor.execute(query)
+            return True, None
+        results = reader.read(cursor.connection, query)
+        if results.oversized:
+            logger.error(f"Result of {query} is larger than the reader's caps, it is incomplete")
         return True, results
     
     except Exception as e:
@@ -30,88 +49,241 @@ def execute_sql(cursor, query, alter=False):
         return False, None
 
 
-def write_to_csv(results, output_filename):
-    """Write query results to a CSV file."""
+def process_queries(dataset, alter_dataset, db_name, pools, store_path, route_databases=False, workers=1, clones=0):
+    """Process queries on pooled connections, one checkout per instance, into the ground truth store."""
+    
+    logger.info(f"Processing {len(dataset)} queries") 
+    targets = [alter_dataset[i]['selected_database'] if route_databases else db_name for i in range(len(dataset))]
+
     try:
-        with open(output_filename, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            if results:
-                for row in results:
-                    writer.writerow(row)
-        logger.info(f"Results written to {output_filename}")
+        if workers > 1:
+            results = process_parallel(dataset, alter_dataset, targets, pools, workers, clones)
+        else:
+            results = [process_committed(pools, targets[i], query_data, alter_dataset[i]) for i, query_data in enumerate(dataset)]
+        write_results(dataset, results, store_path)
+
     except Exception as e:
-        logger.error(f"Error writing to CSV: {e}")
+        logger.error(f"Database connection error: {e}")
+        pools.closeall()
+        sys.exit(1)
 
 
-def process_queries(dataset, alter_dataset, db_name, user, password, output_dir):
-    """Process queries in a batch while maintaining a single DB connection."""
-    
-    logger.info(f"Processing {len(dataset)} queries") 
+def write_results(dataset, results, store_path):
+    """Write the results to the store and query_ids.json in dataset order, however they were collected."""
     query_ids_list = []
+    store = GTStoreWriter(store_path)
+    for query_data, instance_results in zip(dataset, results):
+        instance_id = query_data.get('instance_id')
+        if instance_results is not None and instance_results.columns is not None:
+            store.add(instance_id, instance_results, ordered=ResultFingerprint.order_sensitive(query_data['sol_sql'][-1]))
+        if instance_results:
+            query_ids_list.append(instance_id) 
 
-    try:
-        conn = psycopg2.connect(dbname=db_name, user=user, password=password)
+    store.close()
+    with open('../../data/bc-1-fexp/data/query_ids.json', 'w') as file:
+        json.dump(query_ids_list, file)
+
+
+def process_committed(pools, target_db, query_data, alter_data):
+    """Run an instance, commit, and undo it with its clean up SQL."""
+    with pools.connection(target_db) as conn:
         cursor = conn.cursor()
+        results = process_instance(conn, cursor, query_data, alter_data)
+        conn.commit()
+        cursor.close()
+    return results
 
-        for i, query_data in enumerate(dataset):
-            instance_id = query_data.get('instance_id')
-            sol_sql = query_data.get('sol_sql', [])
-            alter_sql = alter_dataset[i].get('preprocess_sql', None)
-            clean_sql = alter_dataset[i].get('clean_up_sql', None)
-            results = None
-
-            if alter_sql:
-                for asql in alter_sql: 
-                    logger.info(f"Processing SQL {instance_id}: {asql}")
-                    status, _ = execute_sql(cursor, asql, alter=True)
-                    if status:
-                        logger.info(f"Successfully preprocessed SQL {instance_id}")
-                    elif not status and 'alter_error':
-                        conn.rollback()
-                        pass
-                    else:
-                        logger.error(f"Did not successfully preprocess SQL {instance_id}")
-                        conn.rollback()
-            else:
-                logger.info(f"No preprocess SQL for {instance_id}")
-
-            for ssql in sol_sql:
-                logger.info(f"Running SQL {instance_id}: {ssql}")
-                status, results = execute_sql(cursor, ssql)
-                if status:
-                    logger.info(f"Ran SQL query {instance_id}")
-
-            if clean_sql:
-                for csql in clean_sql:
-                    logger.info(f"Cleaning up SQL {instance_id}: {csql}")
-                    status, _ = execute_sql(cursor, csql, alter=True)
-                    if status:
-                        logger.info(f"Successfully cleaned up SQL {instance_id}")
-                    elif not status and 'alter_error':
-                        pass
-                    else:
-                        logger.error(f"Did not successfully clean up SQL {instance_id}")
-                        conn.rollback()
+
+def process_sandboxed(pools, target_db, query_data, alter_data):
+    """Run an instance in a transaction that is rolled back, leaving the database as it was."""
+    with pools.connection(target_db) as conn:
+        cursor = conn.cursor()
+        results = process_instance(conn, cursor, query_data, alter_data, clean_up=False)
+        conn.rollback()
+        cursor.close()
+    return results
+
+
+def process_cloned(pools, clone_pool, query_data, alter_data):
+    """Run an instance on a clone of its database, which is thrown away afterwards."""
+    instance_id = query_data.get('instance_id')
+    with clone_pool.leased_clone() as clone:
+        with pools.connection(clone) as conn:
+            cursor = conn.cursor()
+            # preprocess SQL such as VACUUM cannot run inside a transaction block
+            conn.autocommit = True
+            run_preprocess(cursor, instance_id, alter_data.get('preprocess_sql', None), savepoints=False)
+            conn.autocommit = False
+            results = run_solution(cursor, instance_id, query_data.get('sol_sql', []))
+            conn.commit()
+            cursor.close()
+        pools.discard(clone)
+    return results
+
+
+def needs_clone(query_data, alter_data):
+    """True if a rollback cannot undo the instance's preprocess, solution or clean up SQL."""
+    return not SQLClassifier.transactional(
+        (alter_data.get('preprocess_sql') or []) + query_data.get('sol_sql', []) + (alter_data.get('clean_up_sql') or [])
+    )
+
+
+def partition(dataset, alter_dataset, targets, indices):
+    """
+    Group instances so that no two groups touch a table of the same database that one of them
+    writes. Instances of a group run in order on one worker, so concurrent instances never wait
+    on each other's locks or deadlock.
+    """
+    parent = {i: i for i in indices}
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        i, j = find(i), find(j)
+        if i != j:
+            parent[max(i, j)] = min(i, j)
+
+    touched, written, any_table = {}, {}, {}
+    for i in indices:
+        sqls = (alter_dataset[i].get('preprocess_sql') or []) + dataset[i].get('sol_sql', [])
+        for statement in (statement for sql in sqls if sql for statement in SQLClassifier.split(sql)):
+            reads, writes = SQLClassifier.tables(statement)
+            for table in reads | writes:
+                touched.setdefault((targets[i], table), []).append(i)
+            for table in writes:
+                written.setdefault((targets[i], table), set()).add(i)
+            if SQLClassifier.ANY_TABLE in writes:
+                any_table.setdefault(targets[i], []).append(i)
+
+    for key, writers in written.items():
+        for i in touched[key]:
+            union(min(writers), i)
+    for i in indices:
+        for j in any_table.get(targets[i], []):
+            union(i, j)
+
+    groups = {}
+    for i in indices:
+        groups.setdefault(find(i), []).append(i)
+    return sorted(groups.values(), key=lambda group: (-len(group), group[0]))
+
+
+def process_parallel(dataset, alter_dataset, targets, pools, workers, clones=0):
+    """
+    Collect instances on workers threads. Instances a rollback can undo run in transactions
+    that are rolled back, grouped by partition; the others run on clones of their database with
+    clones > 0, or one at a time after everything else with their clean up SQL.
+
+    :return: The results of every instance, in dataset order.
+    """
+    cloned = [i for i in range(len(dataset)) if needs_clone(dataset[i], alter_dataset[i])]
+    sandboxed = [i for i in range(len(dataset)) if i not in set(cloned)]
+    groups = partition(dataset, alter_dataset, targets, sandboxed)
+    logger.info(
+        f"Collecting {len(sandboxed)} instances in {len(groups)} independent groups on {workers} workers, "
+        f"{len(cloned)} that cannot be rolled back {'on clones' if clones else 'afterwards'}"
+    )
+    results = [None] * len(dataset)
+
+    # clones are copied before anything connects to the databases they copy
+    clone_pools = {}
+    if clones:
+        for db_name in sorted({targets[i] for i in cloned}):
+            clone_pools[db_name] = ClonePool(db_name, size=clones, **pools.connect_kwargs)
+            clone_pools[db_name].start()
+
+    def run_group(group):
+        for i in group:
+            results[i] = process_sandboxed(pools, targets[i], dataset[i], alter_dataset[i])
+
+    def run_cloned(i):
+        results[i] = process_cloned(pools, clone_pools[targets[i]], dataset[i], alter_dataset[i])
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_group, group) for group in groups]
+            if clone_pools:
+                futures += [executor.submit(run_cloned, i) for i in cloned]
+            for future in futures:
+                future.result()
+    finally:
+        for clone_pool in clone_pools.values():
+            logger.info(f"Clone pool {clone_pool.source_db}: {clone_pool.stats()}")
+            clone_pool.close()
+
+    if not clone_pools:
+        for i in cloned:
+            results[i] = process_committed(pools, targets[i], dataset[i], alter_dataset[i])
+    return results
+
+
+def process_instance(conn, cursor, query_data, alter_data, clean_up=True):
+    """
+    Run preprocess, solution and clean up SQL of one instance, returning the solution's results.
+    Each preprocess and solution statement runs under a savepoint, so a failing one is undone on
+    its own, whether instances run serially or on workers.
+
+    :param clean_up: Run the clean up SQL; not needed when the transaction is rolled back.
+    """
+    instance_id = query_data.get('instance_id')
+    run_preprocess(cursor, instance_id, alter_data.get('preprocess_sql', None))
+    results = run_solution(cursor, instance_id, query_data.get('sol_sql', []))
+    if clean_up:
+        run_clean_up(conn, cursor, instance_id, alter_data.get('clean_up_sql', None))
+    return results
+
+
+def run_preprocess(cursor, instance_id, alter_sql, savepoints=True):
+    """:param savepoints: Undo a failing statement with a savepoint; off on autocommit conns, where it is undone anyway."""
+    if alter_sql:
+        for asql in alter_sql: 
+            logger.info(f"Processing SQL {instance_id}: {asql}")
+            if savepoints:
+                cursor.execute("SAVEPOINT preprocess")
+            status, _ = execute_sql(cursor, asql, alter=True)
+            if status:
+                logger.info(f"Successfully preprocessed SQL {instance_id}")
+                if savepoints:
+                    cursor.execute("RELEASE SAVEPOINT preprocess")
             else:
-                logger.info(f"No clean up SQL for {instance_id}")
+                logger.error(f"Did not successfully preprocess SQL {instance_id}, skipping the statement")
+                if savepoints:
+                    cursor.execute("ROLLBACK TO SAVEPOINT preprocess")
+    else:
+        logger.info(f"No preprocess SQL for {instance_id}")
 
-            if results:
-                query_ids_list.append(instance_id) 
-                output_filename = os.path.join(output_dir, f"query_{instance_id}_output.csv")
-                write_to_csv(results, output_filename)
 
-        conn.commit()
-        cursor.close()
-        conn.close()
+def run_solution(cursor, instance_id, sol_sql):
+    results = None
+    for ssql in sol_sql:
+        logger.info(f"Running SQL {instance_id}: {ssql}")
+        cursor.execute("SAVEPOINT solution")
+        status, results = execute_sql(cursor, ssql)
+        if status:
+            logger.info(f"Ran SQL query {instance_id}")
+        cursor.execute("RELEASE SAVEPOINT solution" if status else "ROLLBACK TO SAVEPOINT solution")
+    return results
 
-        with open('../../data/bc-1-fexp/data/query_ids.json', 'w') as file:
-            json.dump(query_ids_list, file)
 
-    except Exception as e:
-        logger.error(f"Database connection error: {e}")
-        if conn:
-            conn.close()
-            sys.exit(1)
+def run_clean_up(conn, cursor, instance_id, clean_sql):
+    if clean_sql:
+        for csql in clean_sql:
+            logger.info(f"Cleaning up SQL {instance_id}: {csql}")
+            status, _ = execute_sql(cursor, csql, alter=True)
+            if status:
+                logger.info(f"Successfully cleaned up SQL {instance_id}")
+            elif not status and 'alter_error':
+                pass
+            else:
+                logger.error(f"Did not successfully clean up SQL {instance_id}")
+                conn.rollback()
+    else:
+        logger.info(f"No clean up SQL for {instance_id}")
+
 
 def load_dataset(filename):
     dataset = []
@@ -121,23 +293,28 @@ def load_dataset(filename):
     return dataset
 
 def main():
-    
+    args = parser.parse_args()
+
     with open("postgres_cred.json", 'r') as file:
         cred = json.load(file)
    
     db_name = cred['db_name']
     user = cred['super_user']
     password = cred['password']
-    output_dir = '../../data/bc-1-fexp/data/gtout'
+    store_path = '../../data/bc-1-fexp/data/gt_store.bin'
     dataset_dir = '../../data/bc-1-fexp/data/GTsql_filtered.jsonl'
     alter_dataset_dir = '../../data/bc-1-fexp/data/input_filtered.jsonl'
 
-    os.makedirs(output_dir, exist_ok=True)
-
     dataset = load_dataset(dataset_dir) 
     alter_dataset = load_dataset(alter_dataset_dir)
     
-    process_queries(dataset, alter_dataset, db_name, user, password, output_dir)
+    pools = DatabasePools(user, password, max_per_db=max(args.workers, 1))
+    process_queries(
+        dataset, alter_dataset, db_name, pools, store_path, route_databases=args.route_databases,
+        workers=args.workers, clones=args.clones
+    )
+    pools.closeall()
+    logger.info(f"Connection pools: {pools.stats()}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,193 @@
+import collections
+import contextlib
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+
+import psycopg2
+import psycopg2.pool
+from psycopg2 import sql
+
+logger = logging.getLogger(__name__)
+
+
+class ClonePool:
+    """
+    throwaway copies of a database for instances whose SQL cannot be undone by a rollback.
+
+    start copies source_db once into a private template (nobody else connects to it, which
+    CREATE DATABASE ... TEMPLATE requires) and creates size clones of that template. lease hands
+    out a clean clone, waiting up to timeout seconds for one; release marks it dirty, and a
+    background thread drops dirty clones and creates fresh ones in their place, so the pool
+    refills while instances keep running. start has to run before anything holds a connection
+    to source_db.
+
+    a recycle that fails is tried again up to retries times on a new admin connection; a clone
+    that still cannot be replaced is lost, and once every clone is lost lease fails at once
+    instead of waiting out its timeout.
+    """
+    def __init__(self, source_db, user, password, size=4, admin_db='postgres', timeout=600.0, retries=3,
+                 **connect_kwargs):
+        self.source_db = source_db
+        self.size = size
+        self.admin_db = admin_db
+        self.timeout = timeout
+        self.retries = retries
+        self.connect_kwargs = dict(connect_kwargs, user=user, password=password)
+        self.template = f"{source_db}_sandbox_{os.getpid()}"
+        self.clean = collections.deque()
+        self.dirty = queue.Queue()
+        self.leased = set()
+        self.leases = 0
+        self.recycled = 0
+        self.lost = []
+        self.wait_s = 0.0
+        self.create_s = 0.0
+        self._names = itertools.count()
+        self._cond = threading.Condition()
+        self._worker = None
+        self._stopped = False
+
+    def _admin(self):
+        conn = psycopg2.connect(dbname=self.admin_db, **self.connect_kwargs)
+        conn.autocommit = True
+        return conn
+
+    def _create(self, admin, name, template):
+        start = time.perf_counter()
+        with admin.cursor() as cursor:
+            cursor.execute(
+                sql.SQL("CREATE DATABASE {} TEMPLATE {}").format(sql.Identifier(name), sql.Identifier(template))
+            )
+        with self._cond:
+            self.create_s += time.perf_counter() - start
+
+    def _drop(self, admin, name):
+        with admin.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {} WITH (FORCE)").format(sql.Identifier(name)))
+
+    def _new_clone(self, admin):
+        name = f"{self.template}_{next(self._names)}"
+        self._create(admin, name, self.template)
+        with self._cond:
+            self.clean.append(name)
+            self._cond.notify()
+
+    def start(self):
+        admin = self._admin()
+        try:
+            logger.info("Clone pool: copying %s into template %s.", self.source_db, self.template)
+            self._drop(admin, self.template)
+            self._create(admin, self.template, self.source_db)
+            for _ in range(self.size):
+                self._new_clone(admin)
+        except psycopg2.Error:
+            # drop the template and the clones made so far
+            self.close()
+            raise
+        finally:
+            admin.close()
+        self._worker = threading.Thread(target=self._recycle, name=f"clones-{self.source_db}", daemon=True)
+        self._worker.start()
+        logger.info("Clone pool: %d clones of %s ready.", self.size, self.source_db)
+
+    def _recycle(self):
+        admin = self._admin()
+        try:
+            while True:
+                name = self.dirty.get()
+                if name is None:
+                    return
+                for attempt in range(self.retries + 1):
+                    try:
+                        if admin.closed:
+                            admin = self._admin()
+                        self._drop(admin, name)
+                        if not self._stopped:
+                            self._new_clone(admin)
+                        with self._cond:
+                            self.recycled += 1
+                        break
+                    except psycopg2.Error as e:
+                        logger.error("Clone pool: recycling %s failed (attempt %d): %s", name, attempt + 1, e)
+                        admin.close()
+                        time.sleep(attempt)
+                else:
+                    with self._cond:
+                        self.lost.append(name)
+                        logger.error("Clone pool: lost a clone of %s, %d of %d left.",
+                                     self.source_db, self.size - len(self.lost), self.size)
+                        self._cond.notify_all()
+        finally:
+            admin.close()
+
+    def lease(self):
+        """:return: name of a clean clone, which belongs to the caller until release."""
+        start = time.monotonic()
+        with self._cond:
+            while not self.clean:
+                if len(self.lost) >= self.size:
+                    raise psycopg2.pool.PoolError(f"no clone of {self.source_db} left, every recycle failed")
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise psycopg2.pool.PoolError(f"no clone of {self.source_db} became free within {self.timeout}s")
+                self._cond.wait(remaining)
+            name = self.clean.popleft()
+            self.leased.add(name)
+            self.leases += 1
+            self.wait_s += time.monotonic() - start
+        return name
+
+    def release(self, name):
+        """hand a clone back; it is dropped and replaced in the background. close every connection to it first."""
+        with self._cond:
+            self.leased.discard(name)
+        self.dirty.put(name)
+
+    @contextlib.contextmanager
+    def leased_clone(self):
+        name = self.lease()
+        try:
+            yield name
+        finally:
+            self.release(name)
+
+    def close(self):
+        """stop recycling and drop every clone and the template; does nothing the second time."""
+        if self._stopped:
+            return
+        self._stopped = True
+        if self._worker is not None:
+            self.dirty.put(None)
+            self._worker.join()
+        admin = self._admin()
+        try:
+            with self._cond:
+                names = list(self.clean) + list(self.leased) + self.lost
+                self.clean.clear()
+            while not self.dirty.empty():
+                name = self.dirty.get()
+                if name is not None:
+                    names.append(name)
+            for name in names + [self.template]:
+                try:
+                    self._drop(admin, name)
+                except psycopg2.Error as e:
+                    logger.error("Clone pool: could not drop %s: %s", name, e)
+        finally:
+            admin.close()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'clean': len(self.clean),
+                'leases': self.leases,
+                'recycled': self.recycled,
+                'lost': len(self.lost),
+                'wait_s': self.wait_s,
+                'create_s': self.create_s,
+            }
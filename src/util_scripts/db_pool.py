@@ -0,0 +1,198 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+logger = logging.getLogger(__name__)
+
+
+class DatabasePool:
+    """
+    warm connections to a single database, at most max_size of them open at once.
+
+    getconn hands out an idle connection, opens a new one while below max_size, and otherwise
+    waits up to timeout seconds for one to come back before raising psycopg2.pool.PoolError.
+    connections are health checked on checkout: closed or broken ones are replaced, leftover
+    transactions are rolled back, and one idle for longer than ping_after_s has to answer a
+    SELECT 1 first.
+    """
+    def __init__(self, db_name, connect_kwargs, max_size=16, timeout=60.0, ping_after_s=30.0):
+        self.db_name = db_name
+        self.connect_kwargs = connect_kwargs
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_after_s = ping_after_s
+        self.idle = collections.deque()
+        self.size = 0
+        self.checkouts = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.wait_s = 0.0
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        conn = psycopg2.connect(dbname=self.db_name, **self.connect_kwargs)
+        with self._cond:
+            self.connects += 1
+        return conn
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        try:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                return False
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if time.monotonic() - idle_since > self.ping_after_s:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        with self._cond:
+            while not self.idle and self.size >= self.max_size:
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise psycopg2.pool.PoolError(
+                        f"no connection to {self.db_name} came back within {self.timeout}s"
+                    )
+                self._cond.wait(remaining)
+            entry = self.idle.popleft() if self.idle else None
+            if entry is None:
+                self.size += 1
+            self.checkouts += 1
+            self.wait_s += time.monotonic() - start
+
+        try:
+            if entry is None:
+                return self._connect()
+            conn, idle_since = entry
+            if self._healthy(conn, idle_since):
+                return conn
+            logger.warning("Pool %s: replacing a broken connection.", self.db_name)
+            with self._cond:
+                self.reconnects += 1
+            with contextlib.suppress(Exception):
+                conn.close()
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self.size -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, close=False):
+        """return a connection; it goes back idle with no open transaction, or is closed if close is set or it broke."""
+        if not close and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+        if close or conn.closed:
+            with contextlib.suppress(Exception):
+                conn.close()
+            with self._cond:
+                self.size -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self.idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def warm(self, count):
+        """open connections up front so the first checkouts do not pay the connection setup."""
+        conns = [self.getconn() for _ in range(min(count, self.max_size))]
+        for conn in conns:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            while self.idle:
+                conn, _ = self.idle.popleft()
+                with contextlib.suppress(Exception):
+                    conn.close()
+                self.size -= 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                'open': self.size,
+                'idle': len(self.idle),
+                'checkouts': self.checkouts,
+                'connects': self.connects,
+                'reconnects': self.reconnects,
+                'wait_s': self.wait_s,
+            }
+
+
+class DatabasePools:
+    """
+    one DatabasePool per target database, created on first use, all with the same credentials.
+    """
+    def __init__(self, user, password, max_per_db=16, timeout=60.0, ping_after_s=30.0, **connect_kwargs):
+        self.connect_kwargs = dict(connect_kwargs, user=user, password=password)
+        self.max_per_db = max_per_db
+        self.timeout = timeout
+        self.ping_after_s = ping_after_s
+        self.pools = {}
+        self._lock = threading.Lock()
+
+    def pool(self, db_name):
+        with self._lock:
+            if db_name not in self.pools:
+                self.pools[db_name] = DatabasePool(
+                    db_name, self.connect_kwargs, self.max_per_db, self.timeout, self.ping_after_s
+                )
+            return self.pools[db_name]
+
+    def getconn(self, db_name):
+        return self.pool(db_name).getconn()
+
+    def putconn(self, db_name, conn, close=False):
+        self.pool(db_name).putconn(conn, close=close)
+
+    @contextlib.contextmanager
+    def connection(self, db_name):
+        """check out a connection for the with block; it is closed instead of reused if the block loses it."""
+        conn = self.getconn(db_name)
+        close = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            close = True
+            raise
+        finally:
+            self.putconn(db_name, conn, close=close)
+
+    def warm(self, db_name, count):
+        self.pool(db_name).warm(count)
+
+    def discard(self, db_name):
+        """close the idle connections to a database and forget its pool, e.g. before it is dropped."""
+        with self._lock:
+            pool = self.pools.pop(db_name, None)
+        if pool is not None:
+            pool.closeall()
+
+    def closeall(self):
+        with self._lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            pool.closeall()
+
+    def stats(self):
+        with self._lock:
+            pools = dict(self.pools)
+        return {db_name: pool.stats() for db_name, pool in pools.items()}
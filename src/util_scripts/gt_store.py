@@ -0,0 +1,159 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+
+from util_scripts.result_fingerprint import ResultFingerprint
+
+logger = logging.getLogger(__name__)
+
+
+class GTEntry:
+    """
+    ground truth of one instance: column names, PostgreSQL type OIDs, row count, typed rows and their
+    digest, and the ResultFingerprint value candidates are checked against, ordered if the
+    solution's ORDER BY makes the row order part of the answer.
+    """
+    def __init__(self, instance_id, columns, type_oids, row_count, digest, oversized=False, rows=None, store=None,
+                 offset=0, length=0, ordered=False, fingerprint=None):
+        self.instance_id = instance_id
+        self.columns = columns
+        self.type_oids = type_oids
+        self.row_count = row_count
+        self.digest = digest
+        self.oversized = oversized
+        self.ordered = ordered
+        self.fingerprint = fingerprint
+        self._rows = rows
+        self._store = store
+        self._offset = offset
+        self._length = length
+
+    @property
+    def rows(self):
+        """the typed rows, unpickled from the store's memory map on first use."""
+        if self._rows is None:
+            self._rows = self._store.read_rows(self._offset, self._length)
+        return self._rows
+
+    @staticmethod
+    def digest_of(rows):
+        """digest of typed rows in order; rows with equal values and types share it."""
+        digest = hashlib.sha1()
+        for row in rows:
+            digest.update(repr(tuple(row)).encode('utf-8'))
+            digest.update(b'\n')
+        return digest.hexdigest()
+
+    def to_index(self):
+        return {
+            'instance_id': self.instance_id, 'columns': self.columns, 'type_oids': self.type_oids,
+            'row_count': self.row_count, 'digest': self.digest, 'oversized': self.oversized, 'ordered': self.ordered,
+            'fingerprint': self.fingerprint, 'offset': self._offset, 'length': self._length,
+        }
+
+
+class GTStore:
+    """
+    every instance's ground truth in a single file, replacing the per instance CSVs of gtout/.
+
+    the file is a header (magic, index offset, index length), the pickled rows of each instance
+    one after the other, then a JSON index with every instance's columns, type OIDs, row count,
+    digest and where its rows are. open maps the file read only and parses the index; rows are unpickled
+    the first time an entry's rows are used. open returns the same store for a path within a
+    process, so the file is read once however many episodes look up their ground truth.
+    """
+    MAGIC = b'GTSTORE1'
+    HEADER = struct.Struct('<8sQQ')
+    _opened = {}
+    _open_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{path} is not a ground truth store.")
+        index = json.loads(self._map[index_offset:index_offset + index_length].decode('utf-8'))
+        self.entries = {
+            entry['instance_id']: GTEntry(
+                entry['instance_id'], entry['columns'], entry['type_oids'], entry['row_count'], entry['digest'],
+                entry['oversized'], store=self, offset=entry['offset'], length=entry['length'],
+                ordered=entry.get('ordered', False), fingerprint=entry.get('fingerprint'),
+            )
+            for entry in index
+        }
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path):
+        path = os.path.abspath(path)
+        with cls._open_lock:
+            if path not in cls._opened:
+                cls._opened[path] = cls(path)
+                logger.info("Loaded %d ground truth entries from %s.", len(cls._opened[path].entries), path)
+            return cls._opened[path]
+
+    def read_rows(self, offset, length):
+        with self._lock:
+            return pickle.loads(self._map[offset:offset + length])
+
+    def get(self, instance_id):
+        """:return: the GTEntry of instance_id, or None."""
+        return self.entries.get(instance_id)
+
+    def __contains__(self, instance_id):
+        return instance_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class GTStoreWriter:
+    """
+    writes a GTStore file. entries are added in any order and indexed by instance_id; the file is
+    written under a temporary name and moved into place on close, so readers never see a partial store.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(self.tmp_path, 'wb')
+        self._file.write(GTStore.HEADER.pack(GTStore.MAGIC, 0, 0))
+        self.entries = {}
+
+    def add(self, instance_id, results, ordered=False):
+        """
+        :param results: ResultRows of the instance's solution, with their columns, type OIDs and oversized flag.
+        :param ordered: The solution's row order is part of the answer, see ResultFingerprint.order_sensitive.
+        """
+        rows = [tuple(row) for row in results]
+        blob = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+        offset = self._file.tell()
+        self._file.write(blob)
+        self.entries[instance_id] = GTEntry(
+            instance_id, getattr(results, 'columns', None), getattr(results, 'type_oids', None), len(rows),
+            GTEntry.digest_of(rows), getattr(results, 'oversized', False), offset=offset, length=len(blob),
+            ordered=ordered, fingerprint=ResultFingerprint.of(rows).value(ordered),
+        )
+
+    def close(self):
+        index = json.dumps(
+            [self.entries[instance_id].to_index() for instance_id in sorted(self.entries)]
+        ).encode('utf-8')
+        index_offset = self._file.tell()
+        self._file.write(index)
+        self._file.seek(0)
+        self._file.write(GTStore.HEADER.pack(GTStore.MAGIC, index_offset, len(index)))
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+        logger.info("Wrote %d ground truth entries to %s.", len(self.entries), self.path)
@@ -0,0 +1,183 @@
+import datetime
+import re
+from decimal import Decimal
+
+import numpy as np
+
+from util_scripts.result_fingerprint import ResultFingerprint
+
+
+class ResultComparator:
+    """
+    tolerant, column at a time comparison of a candidate's rows with the ground truth, after the
+    ex_base / remove_distinct checks of the test_cases in GTsql_filtered.jsonl.
+
+    every column becomes one NumPy array per side: integers as their exact digits, other numbers
+    (float, Decimal, or ints next to them) as float64 rounded to decimal_places, dates and
+    timestamps as datetime64 truncated to temporal_unit ('D' compares the date only, as ex_base
+    does), everything else, booleans included, as normalized text with array elements sorted when
+    sort_arrays is set (array_agg without ORDER BY has no order). a column that is a number or a
+    date on one side and text on the other is compared as numbers or dates if all of the text
+    parses as such ('2.50' matches 2.5, '2020-01-01' a date, only full ISO dates count), else as
+    text. NULLs only match NULLs.
+
+    semantics 'set' compares the distinct rows, like ex_base on remove_distinct queries; 'bag'
+    counts duplicates; 'ordered' also compares positions. respect_order switches to 'ordered' for
+    ground truth whose solution has a top level ORDER BY. rel_tol and abs_tol loosen number
+    comparison after rounding. ex_base never accepts an empty result, neither does this unless
+    empty_matches is set.
+    """
+    SEMANTICS = ('set', 'bag', 'ordered')
+    TEMPORAL = (datetime.date, datetime.datetime)
+    ISO_TEMPORAL = re.compile(r'\d{4}-\d{2}-\d{2}(?:[ T]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:[+-]\d{2}:\d{2})?)?')
+
+    def __init__(self, semantics='set', decimal_places=2, rel_tol=0.0, abs_tol=0.0, temporal_unit='D',
+                 sort_arrays=True, respect_order=False, empty_matches=False):
+        if semantics not in self.SEMANTICS:
+            raise ValueError(f"Unknown comparison semantics {semantics}, expected one of {self.SEMANTICS}.")
+        self.semantics = semantics
+        self.decimal_places = decimal_places
+        self.rel_tol = rel_tol
+        self.abs_tol = abs_tol
+        self.temporal_unit = temporal_unit
+        self.sort_arrays = sort_arrays
+        self.respect_order = respect_order
+        self.empty_matches = empty_matches
+
+    @property
+    def counts_rows(self):
+        """True if results with different row counts can never match."""
+        return self.semantics != 'set'
+
+    def kind(self, values):
+        present = [value for value in values if value is not None]
+        if present and all(isinstance(value, int) and not isinstance(value, bool) for value in present):
+            return 'integer'
+        if present and all(isinstance(value, (int, float, Decimal)) and not isinstance(value, bool) for value in present):
+            return 'number'
+        if present and all(isinstance(value, self.TEMPORAL) for value in present):
+            return 'temporal'
+        return 'text'
+
+    def coerced(self, kind, values):
+        """:return: True if every value of a column can be compared as kind."""
+        types = {'integer': int, 'number': (int, float, Decimal), 'temporal': self.TEMPORAL}[kind]
+        try:
+            for value in values:
+                if value is None:
+                    continue
+                if isinstance(value, str):
+                    {'integer': int, 'number': float, 'temporal': self.parse_temporal}[kind](value)
+                elif isinstance(value, bool) or not isinstance(value, types):
+                    return False
+        except ValueError:
+            return False
+        return True
+
+    @classmethod
+    def parse_temporal(cls, value):
+        """a full ISO date or timestamp; partial dates such as '2020' raise ValueError."""
+        if not cls.ISO_TEMPORAL.fullmatch(value.strip()):
+            raise ValueError(f"not an ISO date: {value!r}")
+        return datetime.datetime.fromisoformat(value.strip())
+
+    def rounded(self, value):
+        if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool) and self.decimal_places is not None:
+            return round(float(value), self.decimal_places)
+        return value
+
+    def text(self, value):
+        value = self.rounded(value)
+        if isinstance(value, (list, tuple)) and self.sort_arrays:
+            return '[' + ','.join(sorted(self.text(item) for item in value)) + ']'
+        return ResultFingerprint.normalize(value)
+
+    def temporal(self, value):
+        if isinstance(value, str):
+            value = self.parse_temporal(value)
+        if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return np.datetime64(value, self.temporal_unit).astype(np.int64)
+
+    def encode(self, values, kind):
+        """:return: (nulls, values) arrays of one column."""
+        count = len(values)
+        nulls = np.fromiter((value is None for value in values), dtype=bool, count=count)
+        if kind == 'integer':
+            return nulls, np.array(['' if value is None else str(int(value)) for value in values], dtype=object)
+        if kind == 'number':
+            numbers = np.fromiter((0.0 if value is None else float(value) for value in values), dtype=np.float64, count=count)
+            if self.decimal_places is not None:
+                numbers = np.round(numbers, self.decimal_places)
+            return nulls, numbers
+        if kind == 'temporal':
+            return nulls, np.fromiter(
+                (0 if value is None else self.temporal(value) for value in values), dtype=np.int64, count=count
+            )
+        return nulls, np.array(['' if value is None else self.text(value) for value in values], dtype=object)
+
+    def table(self, rows, kinds):
+        """rows as a structured array with a null flag and a value field per column."""
+        columns = list(zip(*rows)) if rows else [()] * len(kinds)
+        encoded = [self.encode(values, kind) for values, kind in zip(columns, kinds)]
+        fields = []
+        for i, (kind, (_, values)) in enumerate(zip(kinds, encoded)):
+            if kind in ('text', 'integer'):
+                width = max((len(value) for value in values), default=1) or 1
+                fields += [(f'n{i}', bool), (f'v{i}', f'U{width}')]
+            else:
+                fields += [(f'n{i}', bool), (f'v{i}', values.dtype)]
+        table = np.zeros(len(rows), dtype=fields)
+        for i, (nulls, values) in enumerate(encoded):
+            table[f'n{i}'] = nulls
+            table[f'v{i}'] = values
+        return table
+
+    def arrange(self, table, semantics):
+        if semantics == 'set':
+            return np.unique(table)
+        if semantics == 'bag':
+            return np.sort(table)
+        return table
+
+    def equal(self, rows, gt_rows, ordered=False):
+        """
+        :param ordered: The ground truth's solution orders its rows, see ResultFingerprint.order_sensitive.
+        :return: True if the rows match the ground truth rows under the comparator's semantics.
+        """
+        if not rows or not gt_rows:
+            return self.empty_matches and not rows and not gt_rows
+        width = len(gt_rows[0])
+        if any(len(row) != width for row in rows):
+            return False
+        columns = list(zip(*rows))
+        gt_columns = list(zip(*gt_rows))
+        kinds = []
+        for values, gt_values in zip(columns, gt_columns):
+            kind, gt_kind = self.kind(values), self.kind(gt_values)
+            # integers are only compared exactly against integers, and not under a tolerance
+            if 'integer' in (kind, gt_kind) and ('number' in (kind, gt_kind) or self.rel_tol or self.abs_tol):
+                kind, gt_kind = ('number' if k == 'integer' else k for k in (kind, gt_kind))
+            if kind != gt_kind and 'text' in (kind, gt_kind):
+                target = kind if kind != 'text' else gt_kind
+                targets = ('integer', 'number') if target == 'integer' else (target,)
+                kind = gt_kind = next(
+                    (target for target in targets if self.coerced(target, values) and self.coerced(target, gt_values)), 'text'
+                )
+            kinds.append(kind if kind == gt_kind else 'text')
+
+        semantics = 'ordered' if self.respect_order and ordered else self.semantics
+        table = self.arrange(self.table(rows, kinds), semantics)
+        gt_table = self.arrange(self.table(gt_rows, kinds), semantics)
+        if table.shape != gt_table.shape:
+            return False
+        for i, kind in enumerate(kinds):
+            if not np.array_equal(table[f'n{i}'], gt_table[f'n{i}']):
+                return False
+            values, gt_values = table[f'v{i}'], gt_table[f'v{i}']
+            if kind == 'number' and (self.rel_tol or self.abs_tol):
+                if not np.allclose(values, gt_values, rtol=self.rel_tol, atol=self.abs_tol):
+                    return False
+            elif not np.array_equal(values, gt_values):
+                return False
+        return True
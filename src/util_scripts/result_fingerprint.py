@@ -0,0 +1,94 @@
+import datetime
+import hashlib
+import json
+from decimal import Decimal
+
+from util_scripts.sql_classify import SQLClassifier
+
+
+class ResultFingerprint:
+    """
+    (row count, fingerprint) of a result, computed a row at a time as a ResultReader sink, so two
+    results can be told apart without holding either.
+
+    every row is normalized first: numbers of any type by value (2.5, 2.50 and Decimal('2.5') are
+    one value), dates and times by ISO format, arrays element by element, JSON with sorted keys.
+    the unordered fingerprint is the sum of the row hashes modulo 2**128, a multiset hash equal
+    for the same rows in any order; the ordered one chains the row hashes, for queries whose
+    ORDER BY makes the order part of the answer. both are kept, the caller picks with ordered.
+    """
+    MODULUS = 1 << 128
+
+    def __init__(self):
+        self.row_count = 0
+        self._sum = 0
+        self._chain = hashlib.blake2b(digest_size=16)
+
+    @classmethod
+    def normalize(cls, value):
+        if value is None:
+            return 'n'
+        if isinstance(value, bool):
+            return 'b1' if value else 'b0'
+        if isinstance(value, (int, float, Decimal)):
+            if isinstance(value, float) and (value != value or value in (float('inf'), float('-inf'))):
+                return 'f' + repr(value)
+            number = Decimal(repr(value)) if isinstance(value, float) else Decimal(value)
+            number = Decimal(0) if number == 0 else number.normalize()
+            return 'd' + format(number, 'f')
+        if isinstance(value, (list, tuple)):
+            return '[' + ','.join(cls.normalize(item) for item in value) + ']'
+        if isinstance(value, dict):
+            return 'j' + json.dumps(value, sort_keys=True, default=str)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return 'x' + bytes(value).hex()
+        if isinstance(value, (datetime.date, datetime.time, datetime.datetime)):
+            return 't' + value.isoformat()
+        if isinstance(value, datetime.timedelta):
+            return 'i' + str(value.total_seconds())
+        return 's' + str(value)
+
+    @classmethod
+    def row_key(cls, row):
+        return '\x1f'.join(cls.normalize(value) for value in row)
+
+    def add(self, row):
+        digest = hashlib.blake2b(self.row_key(row).encode('utf-8'), digest_size=16).digest()
+        self.row_count += 1
+        self._sum = (self._sum + int.from_bytes(digest, 'big')) % self.MODULUS
+        self._chain.update(digest)
+
+    @property
+    def unordered(self):
+        return f"{self._sum:032x}"
+
+    @property
+    def ordered(self):
+        return self._chain.hexdigest()
+
+    def value(self, ordered=False):
+        return self.ordered if ordered else self.unordered
+
+    @classmethod
+    def of(cls, rows):
+        fingerprint = cls()
+        for row in rows:
+            fingerprint.add(row)
+        return fingerprint
+
+    @staticmethod
+    def order_sensitive(sql):
+        """True if the last statement of sql has a top level ORDER BY."""
+        statements = SQLClassifier.split(sql)
+        if not statements:
+            return False
+        depth = 0
+        words = SQLClassifier.tokens(statements[-1])
+        for i, (kind, text) in enumerate(words):
+            if text == '(':
+                depth += 1
+            elif text == ')':
+                depth -= 1
+            elif depth == 0 and text == 'ORDER' and i + 1 < len(words) and words[i + 1][1] == 'BY':
+                return True
+        return False
@@ -0,0 +1,100 @@
+import itertools
+import logging
+import sys
+import threading
+
+from util_scripts.sql_classify import SQLClassifier
+
+logger = logging.getLogger(__name__)
+
+
+class ResultRows(list):
+    """
+    rows read by ResultReader: a plain list of at most the capped rows, with the column names, their
+    PostgreSQL type OIDs and oversized set when the query had rows left that were never fetched.
+    row_count counts every row read, also those the list did not keep.
+    """
+    def __init__(self, rows=(), columns=None, oversized=False, nbytes=0, type_oids=None):
+        super().__init__(rows)
+        self.row_count = len(self)
+        self.columns = columns
+        self.type_oids = type_oids
+        self.oversized = oversized
+        self.nbytes = nbytes
+
+
+class ResultReader:
+    """
+    reads query results through a named (server side) cursor, itersize rows per round trip, so
+    postgres keeps what has not been read yet instead of libpq materializing the whole result.
+
+    fetching stops once max_rows rows or max_bytes bytes (estimated with sys.getsizeof) were read
+    and the result is marked oversized, which keeps the memory of a worker flat whatever the
+    query returns. every row is handed to the add method of each sink as it arrives; with
+    keep=False the rows only go to the sinks, with keep=n only the first n rows are kept. statements a named cursor cannot run (anything but a
+    single SELECT, WITH, VALUES or TABLE query that does not write, see SQLClassifier) fall back to
+    a regular cursor, under the same caps.
+    """
+    STREAMABLE = ('SELECT', 'WITH', 'VALUES', 'TABLE')
+
+    @classmethod
+    def streamable(cls, query):
+        statements = SQLClassifier.classify_all(query)
+        return len(statements) == 1 and statements[0].verb in cls.STREAMABLE and statements[0].kind in ('read', 'lock')
+
+    def __init__(self, itersize=2000, max_rows=100000, max_bytes=64 * 1024 ** 2):
+        self.itersize = itersize
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.reads = 0
+        self.oversized = 0
+        self._names = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def row_bytes(row):
+        return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+    def _cursor(self, conn, query):
+        if not conn.autocommit and self.streamable(query):
+            cursor = conn.cursor(name=f"result_{threading.get_ident()}_{next(self._names)}")
+            cursor.itersize = self.itersize
+            return cursor
+        return conn.cursor()
+
+    def read(self, conn, query, sinks=(), keep=True):
+        """:return: ResultRows of the query, empty with columns None for statements returning no rows."""
+        rows = ResultRows()
+        count = 0
+        with self._cursor(conn, query) as cursor:
+            cursor.execute(query)
+            # a named cursor only gets its description with the first fetch
+            returns_rows = cursor.name is not None or cursor.description is not None
+            while returns_rows and not rows.oversized:
+                batch = cursor.fetchmany(self.itersize)
+                if not batch:
+                    break
+                for row in batch:
+                    if count >= self.max_rows or rows.nbytes >= self.max_bytes:
+                        rows.oversized = True
+                        break
+                    count += 1
+                    rows.nbytes += self.row_bytes(row)
+                    for sink in sinks:
+                        sink.add(row)
+                    if keep is True or count <= keep:
+                        rows.append(row)
+            rows.row_count = count
+            if cursor.description is not None:
+                rows.columns = [column[0] for column in cursor.description]
+                rows.type_oids = [column[1] for column in cursor.description]
+        with self._lock:
+            self.reads += 1
+            self.oversized += rows.oversized
+        if rows.oversized:
+            logger.warning("Stopped reading a result at %d rows, %d bytes.", count, rows.nbytes)
+        return rows
+
+    def stats(self):
+        with self._lock:
+            return {'reads': self.reads, 'oversized': self.oversized}
@@ -0,0 +1,384 @@
+import re
+
+
+class Statement:
+    """
+    what a single SQL statement does to the database.
+
+    kind is one of 'read', 'write' (DML, sequence updates, procedures), 'ddl', 'lock' (SELECT ...
+    FOR UPDATE / SHARE), 'maintenance', 'session', 'transaction' (BEGIN, COMMIT, SAVEPOINT ...) or
+    'other'. transactional is False for statements a rollback cannot undo or that cannot run
+    inside a transaction block at all.
+    """
+    def __init__(self, sql, verb, kind, transactional=True, returns_rows=False):
+        self.sql = sql
+        self.verb = verb
+        self.kind = kind
+        self.transactional = transactional
+        self.returns_rows = returns_rows
+
+    @property
+    def read_only(self):
+        return self.kind == 'read'
+
+    def __repr__(self):
+        return f"Statement({self.verb}, {self.kind}, transactional={self.transactional})"
+
+
+class SQLClassifier:
+    """
+    classifies preprocess_sql, sol_sql, clean_up_sql and extracted candidates by what they do,
+    without a database round trip.
+
+    strings may hold several statements separated by semicolons; dollar quoted bodies, string
+    literals, quoted identifiers and comments are skipped while splitting and classifying.
+    WITH queries are writes when any of their CTEs or their main statement is INSERT, UPDATE,
+    DELETE or MERGE; DML with RETURNING is a write that returns rows; EXPLAIN ANALYZE is
+    classified as the statement it runs. queries calling sequence, large object, set_config,
+    backend signalling or dblink_exec functions are writes, non-transactional where a rollback
+    does not undo the call.
+    """
+    TOKEN = re.compile(
+        r"""
+        (?P<comment>--[^\n]*|/\*.*?\*/)
+        |(?P<dollar>\$(?P<tag>[A-Za-z_]\w*)?\$.*?\$(?P=tag)?\$)
+        |(?P<string>[EeBbXxNnUu]?&?'(?:[^']|'')*')
+        |(?P<quoted>"(?:[^"]|"")*")
+        |(?P<word>[A-Za-z_][A-Za-z_0-9$]*)
+        |(?P<semicolon>;)
+        |(?P<op>[^\s])
+        """,
+        re.VERBOSE | re.DOTALL,
+    )
+    DML = {'INSERT', 'UPDATE', 'DELETE', 'MERGE'}
+    DDL = {'CREATE', 'ALTER', 'DROP', 'COMMENT', 'GRANT', 'REVOKE', 'REFRESH', 'SECURITY', 'IMPORT'}
+    TRANSACTION = {'BEGIN', 'START', 'COMMIT', 'END', 'ROLLBACK', 'ABORT', 'SAVEPOINT', 'RELEASE', 'PREPARE'}
+    SESSION = {'SET', 'RESET', 'DISCARD', 'LISTEN', 'UNLISTEN', 'NOTIFY', 'LOAD', 'DEALLOCATE'}
+    MAINTENANCE = {'VACUUM', 'ANALYZE', 'CLUSTER', 'REINDEX', 'CHECKPOINT'}
+    # these never run inside a transaction block, or are not undone by a rollback
+    NON_TRANSACTIONAL_OBJECTS = {'DATABASE', 'TABLESPACE', 'SUBSCRIPTION', 'SYSTEM'}
+    SEQUENCE_FUNCTIONS = {'NEXTVAL', 'SETVAL'}
+    # functions with side effects a rollback does not undo: other backends, the server, remote databases
+    SIDE_EFFECT_FUNCTIONS = {
+        'PG_TERMINATE_BACKEND', 'PG_CANCEL_BACKEND', 'PG_RELOAD_CONF', 'PG_ROTATE_LOGFILE', 'DBLINK_EXEC',
+        'LO_EXPORT',
+    }
+    # functions that write through the transaction: session settings and large objects
+    WRITE_FUNCTIONS = {
+        'SET_CONFIG', 'LO_UNLINK', 'LO_CREATE', 'LO_CREAT', 'LO_IMPORT', 'LO_FROM_BYTEA', 'LO_PUT', 'LOWRITE',
+        'LO_TRUNCATE', 'LO_TRUNCATE64',
+    }
+    # VACUUM, ANALYZE, CLUSTER and REINDEX options written before the table
+    MAINTENANCE_OPTIONS = {'FULL', 'VERBOSE', 'FREEZE', 'ANALYZE', 'ANALYSE', 'CONCURRENTLY', 'TABLE', 'INDEX'}
+    # any table at all, for statements whose tables cannot be told from their text (DO, CALL, ...)
+    ANY_TABLE = '*'
+    # words that can follow a table in FROM / JOIN without being its alias
+    NOT_ALIAS = {
+        'WHERE', 'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'OUTER', 'CROSS', 'NATURAL', 'ON', 'USING', 'GROUP',
+        'ORDER', 'HAVING', 'LIMIT', 'OFFSET', 'UNION', 'INTERSECT', 'EXCEPT', 'WINDOW', 'FETCH', 'FOR', 'RETURNING',
+        'TABLESAMPLE', 'SET', 'WHEN', 'THEN', 'VALUES', 'SELECT', 'DO', 'AND', 'OR',
+    }
+    # functions whose arguments use FROM without naming a table
+    FROM_FUNCTIONS = {'EXTRACT', 'SUBSTRING', 'TRIM', 'OVERLAY', 'POSITION'}
+    CREATE_MODIFIERS = {
+        'OR', 'REPLACE', 'TEMP', 'TEMPORARY', 'UNLOGGED', 'GLOBAL', 'LOCAL', 'MATERIALIZED', 'RECURSIVE', 'UNIQUE',
+        'CONSTRAINT', 'FOREIGN', 'DATA',
+    }
+    IF_EXISTS = {'IF', 'NOT', 'EXISTS', 'CONCURRENTLY', 'ONLY'}
+
+    @classmethod
+    def tokens(cls, sql):
+        """(kind, text) tokens without comments; words are upper cased."""
+        tokens = []
+        for match in cls.TOKEN.finditer(sql):
+            kind = match.lastgroup if match.lastgroup != 'tag' else 'dollar'
+            if kind == 'comment':
+                continue
+            text = match.group()
+            tokens.append((kind, text.upper() if kind == 'word' else text))
+        return tokens
+
+    @classmethod
+    def split(cls, sql):
+        """the non blank statements of a string, split on top level semicolons."""
+        statements, start = [], 0
+        for match in cls.TOKEN.finditer(sql):
+            if match.lastgroup == 'semicolon':
+                statements.append(sql[start:match.start()])
+                start = match.end()
+        statements.append(sql[start:])
+        return [statement.strip() for statement in statements if cls.tokens(statement)]
+
+    @classmethod
+    def classify(cls, statement):
+        """classify a single statement, see Statement."""
+        tokens = [(kind, text) for kind, text in cls.tokens(statement) if kind != 'semicolon']
+        while tokens and tokens[0] == ('op', '('):
+            tokens = tokens[1:]
+        words = [text for kind, text in tokens if kind == 'word']
+        if not words:
+            return Statement(statement, None, 'other')
+        verb = words[0]
+
+        if verb == 'EXPLAIN':
+            options = words[1:4]
+            if 'ANALYZE' in options or 'ANALYSE' in options:
+                inner = next((i for i, (kind, text) in enumerate(tokens[1:], 1)
+                              if kind == 'word' and text in cls.DML | {'SELECT', 'WITH', 'VALUES', 'TABLE', 'CREATE'}), None)
+                if inner is not None:
+                    explained = cls.classify(" ".join(text for _, text in tokens[inner:]))
+                    return Statement(statement, verb, explained.kind, explained.transactional, returns_rows=True)
+            return Statement(statement, verb, 'read', returns_rows=True)
+
+        if verb in ('SELECT', 'VALUES', 'TABLE', 'SHOW', 'WITH', 'FETCH'):
+            return cls.classify_query(statement, verb, tokens, words)
+        if verb in cls.DML or verb == 'TRUNCATE':
+            return Statement(statement, verb, 'write', returns_rows='RETURNING' in words)
+        if verb == 'COPY':
+            writes = 'FROM' in words and 'TO' not in words[:words.index('FROM')]
+            return Statement(statement, verb, 'write' if writes else 'read', returns_rows=not writes)
+        if verb in cls.DDL:
+            transactional = not (
+                set(words[1:4]) & cls.NON_TRANSACTIONAL_OBJECTS or 'CONCURRENTLY' in words[1:5]
+            )
+            return Statement(statement, verb, 'ddl', transactional)
+        if verb in cls.MAINTENANCE:
+            transactional = verb not in ('VACUUM', 'CHECKPOINT') and 'CONCURRENTLY' not in words[1:4]
+            return Statement(statement, verb, 'maintenance', transactional)
+        if verb in ('DO', 'CALL'):
+            return Statement(statement, verb, 'write')
+        if verb in cls.TRANSACTION:
+            return Statement(statement, verb, 'transaction', transactional=False)
+        if verb in cls.SESSION:
+            return Statement(statement, verb, 'session')
+        return Statement(statement, verb, 'other')
+
+    @classmethod
+    def classify_query(cls, statement, verb, tokens, words):
+        """SELECT, VALUES, TABLE, SHOW, FETCH and WITH: reads unless they write, lock or create."""
+        for i, (kind, text) in enumerate(tokens):
+            if kind != 'word':
+                continue
+            previous = tokens[i - 1][1] if i else None
+            if text in ('INSERT', 'DELETE', 'MERGE') or (text == 'UPDATE' and previous not in ('FOR', 'KEY')):
+                return Statement(statement, verb, 'write', returns_rows=True)
+            if i + 1 < len(tokens) and tokens[i + 1][1] == '(':
+                if text in cls.SEQUENCE_FUNCTIONS | cls.SIDE_EFFECT_FUNCTIONS:
+                    return Statement(statement, verb, 'write', transactional=False, returns_rows=True)
+                if text in cls.WRITE_FUNCTIONS:
+                    return Statement(statement, verb, 'write', returns_rows=True)
+        depth = 0
+        for i, (kind, text) in enumerate(tokens):
+            if text == '(':
+                depth += 1
+            elif text == ')':
+                depth -= 1
+            elif depth == 0 and kind == 'word' and text == 'INTO' and verb in ('SELECT', 'WITH'):
+                return Statement(statement, verb, 'ddl')
+        for i, text in enumerate(words[:-1]):
+            if text == 'FOR' and words[i + 1] in ('UPDATE', 'SHARE', 'NO', 'KEY'):
+                return Statement(statement, verb, 'lock', returns_rows=True)
+        return Statement(statement, verb, 'read', returns_rows=True)
+
+    @staticmethod
+    def name_at(tokens, i):
+        """:return: the table name starting at tokens[i] without a public schema, and the index after it."""
+        if i >= len(tokens) or tokens[i][0] not in ('word', 'quoted'):
+            return None, i
+        parts = []
+        while True:
+            kind, text = tokens[i]
+            parts.append(text[1:-1].replace('""', '"') if kind == 'quoted' else text.lower())
+            if i + 2 < len(tokens) and tokens[i + 1][1] == '.' and tokens[i + 2][0] in ('word', 'quoted'):
+                i += 2
+                continue
+            break
+        if len(parts) > 1 and parts[0] == 'public':
+            parts = parts[1:]
+        return ".".join(parts), i + 1
+
+    @classmethod
+    def name_list(cls, tokens, i, aliases=False):
+        """:return: the comma separated table names from tokens[i] on, skipping aliases if asked, and the index after them."""
+        names = []
+        while True:
+            while i < len(tokens) and tokens[i][1] in cls.IF_EXISTS | {'TABLE', 'LATERAL'}:
+                i += 1
+            name, i = cls.name_at(tokens, i)
+            if name is None:
+                break
+            if i < len(tokens) and tokens[i][1] == '(' and aliases:
+                # a set returning function, not a table
+                name = None
+            if name is not None:
+                names.append(name)
+            if aliases:
+                if i < len(tokens) and tokens[i][1] == 'AS':
+                    i += 1
+                if i < len(tokens) and tokens[i][0] in ('word', 'quoted') and tokens[i][1] not in cls.NOT_ALIAS:
+                    i += 1
+            depth = 0
+            while aliases and i < len(tokens) and (depth or tokens[i][1] == '('):
+                depth += {'(': 1, ')': -1}.get(tokens[i][1], 0)
+                i += 1
+            if i < len(tokens) and tokens[i][1] == ',':
+                i += 1
+                continue
+            break
+        return names, i
+
+    @classmethod
+    def tables(cls, statement):
+        """
+        :return: (reads, writes), the sets of tables (and other named objects a statement creates,
+            alters or drops) a single statement reads and writes. CTE and temporary table names are
+            left out; writes is {ANY_TABLE} for statements whose tables are unknown, e.g. DO and CALL.
+            function bodies in dollar quotes count as part of the statement.
+        """
+        statement_kind = cls.classify(statement)
+        if statement_kind.kind in ('transaction', 'session', 'other') and statement_kind.verb not in ('DO', 'CALL', None):
+            return set(), set()
+        if statement_kind.verb in ('DO', 'CALL') or statement_kind.kind == 'other':
+            return set(), {cls.ANY_TABLE} if statement_kind.verb else set()
+        tokens = [token for token in cls.tokens(statement) if token[0] != 'semicolon']
+        while tokens and tokens[0][1] == '(':
+            tokens = tokens[1:]
+        reads, writes, ctes, temporary = set(), set(), set(), set()
+        verb = statement_kind.verb
+
+        i = 1
+        if verb in ('CREATE', 'ALTER', 'DROP', 'COMMENT', 'REFRESH', 'TRUNCATE', 'LOCK', 'VACUUM', 'ANALYZE',
+                    'CLUSTER', 'REINDEX'):
+            temp = False
+            while i < len(tokens) and tokens[i][1] in cls.CREATE_MODIFIERS | {'ON'}:
+                temp = temp or tokens[i][1] in ('TEMP', 'TEMPORARY')
+                i += 1
+            target = tokens[i][1] if i < len(tokens) else None
+            if verb in ('TRUNCATE', 'LOCK', 'VACUUM', 'ANALYZE', 'CLUSTER', 'REINDEX'):
+                while i < len(tokens) and (tokens[i][1] in cls.MAINTENANCE_OPTIONS or tokens[i][1] == '('):
+                    if tokens[i][1] == '(':
+                        while i < len(tokens) and tokens[i][1] != ')':
+                            i += 1
+                    i += 1
+                names, i = cls.name_list(tokens, i)
+            else:
+                i += 1
+                names = []
+                if i < len(tokens) and tokens[i][1] != 'ON':
+                    names, i = cls.name_list(tokens, i)
+                if target in ('INDEX', 'TRIGGER', 'POLICY', 'RULE') and verb == 'CREATE':
+                    # the table follows ON, past a trigger's UPDATE OF column list; a rule's follows ON event TO
+                    on = next((j for j in range(i, len(tokens)) if tokens[j][1] == ('TO' if target == 'RULE' else 'ON')), None)
+                    if on is not None:
+                        table, i = cls.name_list(tokens, on + 1)
+                        names += table
+            if not names and verb in ('VACUUM', 'ANALYZE', 'CLUSTER', 'REINDEX'):
+                names = [cls.ANY_TABLE]
+            if temp and verb == 'CREATE':
+                temporary.update(names)
+            writes.update(names)
+        elif verb == 'COPY':
+            names, i = cls.name_list(tokens, i)
+            (writes if statement_kind.kind == 'write' else reads).update(names)
+        elif verb in ('INSERT', 'MERGE') and i < len(tokens) and tokens[i][1] == 'INTO':
+            names, i = cls.name_list(tokens, i + 1)
+            writes.update(names)
+        elif verb == 'UPDATE':
+            names, i = cls.name_list(tokens, i, aliases=True)
+            writes.update(names)
+        elif verb == 'DELETE' and i < len(tokens) and tokens[i][1] == 'FROM':
+            names, i = cls.name_list(tokens, i + 1, aliases=True)
+            writes.update(names)
+        elif verb == 'TABLE':
+            names, i = cls.name_list(tokens, i)
+            reads.update(names)
+
+        # openers holds the token before every open parenthesis, from_depths the depths of FROM clauses being read
+        openers, from_depths = [], set()
+        while i < len(tokens):
+            kind, text = tokens[i]
+            previous = tokens[i - 1][1] if i else None
+            if text == '(':
+                openers.append(previous)
+            elif text == ')' and openers:
+                openers.pop()
+                from_depths.discard(len(openers) + 1)
+            elif text == ',' and len(openers) in from_depths:
+                names, i = cls.name_list(tokens, i + 1, aliases=True)
+                reads.update(names)
+                continue
+            elif kind == 'word' and text in cls.NOT_ALIAS - {'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'OUTER', 'CROSS',
+                                                             'NATURAL', 'ON', 'USING', 'AND', 'OR'} \
+                    and len(openers) in from_depths:
+                from_depths.discard(len(openers))
+            elif kind == 'dollar':
+                body = text[text.index('$', 1) + 1:text.rindex('$', 0, len(text) - 1)]
+                for nested in cls.split(body):
+                    nested_reads, nested_writes = cls.tables(nested)
+                    reads |= nested_reads
+                    writes |= nested_writes
+            elif kind in ('word', 'quoted') and previous in ('WITH', 'RECURSIVE', ',') and i + 1 < len(tokens):
+                following = tokens[i + 1][1]
+                if following == 'AS' or (following == '(' and any(t[1] == 'AS' for t in tokens[i + 2:i + 40])):
+                    name, _ = cls.name_at(tokens, i)
+                    if following == 'AS' or verb == 'WITH' or 'WITH' in (t[1] for t in tokens[:i]):
+                        ctes.add(name)
+            if kind != 'word':
+                i += 1
+                continue
+            if text in ('FROM', 'JOIN') and not (openers and openers[-1] in cls.FROM_FUNCTIONS) and previous != 'DISTINCT':
+                from_depths.add(len(openers))
+                names, i = cls.name_list(tokens, i + 1, aliases=True)
+                (writes if previous == 'DELETE' else reads).update(names)
+                continue
+            if text == 'INTO' and previous in ('INSERT', 'MERGE'):
+                names, i = cls.name_list(tokens, i + 1, aliases=True)
+                writes.update(names)
+                continue
+            if text == 'INTO' and verb in ('SELECT', 'WITH') and not openers:
+                names, i = cls.name_list(tokens, i + 1)
+                writes.update(names)
+                continue
+            if text == 'UPDATE' and previous not in ('FOR', 'KEY', 'DO', 'ON', 'NO') and i + 1 < len(tokens) \
+                    and tokens[i + 1][1] not in ('SET', 'OF'):
+                names, i = cls.name_list(tokens, i + 1, aliases=True)
+                writes.update(names)
+                continue
+            if text == 'USING' and verb in ('DELETE', 'MERGE') and i + 1 < len(tokens) and tokens[i + 1][1] != '(':
+                names, i = cls.name_list(tokens, i + 1, aliases=True)
+                reads.update(names)
+                continue
+            if text in ('REFERENCES', 'INHERITS', 'LIKE') and verb in ('CREATE', 'ALTER'):
+                names, i = cls.name_list(tokens, i + 1)
+                reads.update(names)
+                continue
+            if i + 1 < len(tokens) and tokens[i + 1][1] == '(' and text in cls.SIDE_EFFECT_FUNCTIONS:
+                writes.add(cls.ANY_TABLE)
+            elif i + 1 < len(tokens) and tokens[i + 1][1] == '(' and text in cls.WRITE_FUNCTIONS - {'SET_CONFIG'}:
+                writes.add('pg_largeobject')
+            if text == 'TO' and previous == 'RENAME' and verb == 'ALTER' and tokens[1][1] in ('TABLE', 'VIEW'):
+                names, i = cls.name_list(tokens, i + 1)
+                writes.update(names)
+                continue
+            i += 1
+
+        if statement_kind.kind == 'lock':
+            writes |= reads
+        reads -= ctes | temporary
+        writes -= ctes | temporary
+        return reads - writes, writes
+
+    @classmethod
+    def classify_all(cls, sqls):
+        """classify every statement of a string or a list of strings."""
+        if isinstance(sqls, str):
+            sqls = [sqls]
+        return [cls.classify(statement) for sql in sqls if sql for statement in cls.split(sql)]
+
+    @classmethod
+    def read_only(cls, sqls):
+        return all(statement.read_only for statement in cls.classify_all(sqls))
+
+    @classmethod
+    def transactional(cls, sqls):
+        return all(statement.transactional for statement in cls.classify_all(sqls))
@@ -0,0 +1,452 @@
+import hashlib
+import logging
+import marshal
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+import psycopg2
+import psycopg2.errors
+
+from util_scripts.db_pool import DatabasePools
+from util_scripts.result_compare import ResultComparator
+from util_scripts.sql_classify import SQLClassifier
+
+logger = logging.getLogger(__name__)
+
+
+############## helpers the test_cases call ################
+
+# ex_base compares the distinct rows with numbers rounded to 2 places and dates without their time
+EX_BASE = ResultComparator('set', decimal_places=2)
+
+
+def execute_queries(queries, db_name, conn, logger=None, section_title="", is_solution=True):
+    """
+    run queries in order on conn, each under a savepoint so a failing one leaves the transaction
+    usable. db_name is only informational, conn decides the database.
+
+    :return: (rows of the last query returning rows, execution error, timeout error).
+    """
+    if isinstance(queries, str):
+        queries = [queries]
+    rows = None
+    with conn.cursor() as cursor:
+        for query in queries:
+            cursor.execute("SAVEPOINT execute_queries")
+            try:
+                cursor.execute(query)
+                if cursor.description is not None:
+                    rows = cursor.fetchall()
+                cursor.execute("RELEASE SAVEPOINT execute_queries")
+            except psycopg2.errors.QueryCanceled:
+                cursor.execute("ROLLBACK TO SAVEPOINT execute_queries")
+                return None, False, True
+            except psycopg2.Error:
+                cursor.execute("ROLLBACK TO SAVEPOINT execute_queries")
+                return None, True, False
+    return rows, False, False
+
+
+def remove_distinct(sqls):
+    """drop every DISTINCT keyword, leaving string literals, identifiers and comments as they are."""
+    removed = []
+    for sql in sqls:
+        pieces, end = [], 0
+        for match in SQLClassifier.TOKEN.finditer(sql):
+            if match.lastgroup == 'word' and match.group().upper() == 'DISTINCT':
+                pieces.append(sql[end:match.start()])
+                end = match.end()
+        pieces.append(sql[end:])
+        removed.append("".join(pieces))
+    return removed
+
+
+def ex_base(pred_sqls, sol_sqls, db_name, conn):
+    """:return: 1 if pred_sqls and sol_sqls end in the same non empty distinct rows, else 0."""
+    if not pred_sqls or not sol_sqls:
+        return 0
+    pred_rows, pred_error, pred_timeout = execute_queries(pred_sqls, db_name, conn)
+    sol_rows, sol_error, sol_timeout = execute_queries(sol_sqls, db_name, conn)
+    if pred_error or pred_timeout or sol_error or sol_timeout:
+        return 0
+    return int(EX_BASE.equal(pred_rows or [], sol_rows or []))
+
+
+def plan_cost(sqls, conn):
+    """
+    estimated total cost of sqls, rolled back afterwards. statements EXPLAIN cannot plan (CREATE
+    INDEX, ...) are run instead, so the plans after them see their effect.
+    """
+    total = 0.0
+    with conn.cursor() as cursor:
+        cursor.execute("SAVEPOINT plan_cost")
+        try:
+            for statement in (statement for sql in sqls for statement in SQLClassifier.split(sql)):
+                if SQLClassifier.classify(statement).kind in ('read', 'write', 'lock'):
+                    cursor.execute("EXPLAIN (FORMAT JSON) " + statement)
+                    total += cursor.fetchone()[0][0]['Plan']['Total Cost']
+                else:
+                    cursor.execute(statement)
+        finally:
+            cursor.execute("ROLLBACK TO SAVEPOINT plan_cost")
+    return total
+
+
+def performance_compare_by_qep(pred_sqls, sol_sqls, db_name, conn):
+    """:return: 1 if the plans of pred_sqls cost no more than those of sol_sqls, else 0."""
+    try:
+        return int(plan_cost(pred_sqls, conn) <= plan_cost(sol_sqls, conn))
+    except psycopg2.Error as e:
+        logger.error("Comparing query plans on %s failed: %s", db_name, e)
+        return 0
+
+
+HELPERS = {
+    'execute_queries': execute_queries,
+    'remove_distinct': remove_distinct,
+    'ex_base': ex_base,
+    'performance_compare_by_qep': performance_compare_by_qep,
+}
+
+
+############## worker processes ################
+
+def _worker(channel, user, password, statement_timeout_ms, connect_kwargs):
+    """
+    serve jobs from channel until it closes: run an instance's preprocess and predicted SQL in a
+    transaction, then each of its test cases under a savepoint rolled back after it, reporting
+    every test as it finishes. the transaction is rolled back at the end of the job.
+    """
+    pools = DatabasePools(user, password, max_per_db=1, **connect_kwargs)
+    codes = {}
+    try:
+        while True:
+            try:
+                job = channel.recv()
+            except EOFError:
+                break
+            if job is None:
+                break
+            for digest, blob in job['codes'].items():
+                codes[digest] = marshal.loads(blob)
+            _run_job(channel, pools, codes, job, statement_timeout_ms)
+    finally:
+        # the parent's libpq sockets were inherited through fork, exiting without finalizers
+        # leaves them alone
+        channel.close()
+        os._exit(0)
+
+
+def _run_job(channel, pools, codes, job, statement_timeout_ms):
+    db_name = job['db_name']
+    try:
+        with pools.connection(db_name) as conn:
+            with conn.cursor() as cursor:
+
+                def setup():
+                    if statement_timeout_ms:
+                        cursor.execute(f"SET LOCAL statement_timeout = {int(statement_timeout_ms)}")
+                    for sql in job['preprocess_sql']:
+                        execute_queries([sql], db_name, conn)
+                    return execute_queries(job['pred_sqls'], db_name, conn)[0]
+
+                pred_query_result = setup()
+                channel.send(('ready',))
+                for index in range(job['start'], len(job['tests'])):
+                    start = time.perf_counter()
+                    status, message = _run_test(codes, job, index, conn, pred_query_result)
+                    try:
+                        cursor.execute("ROLLBACK TO SAVEPOINT test_case")
+                    except psycopg2.Error:
+                        # the test ended the transaction itself, start the instance over
+                        conn.rollback()
+                        pred_query_result = setup()
+                    channel.send(('test', index, status, message, time.perf_counter() - start))
+            conn.rollback()
+    except psycopg2.Error as e:
+        channel.send(('abort', f"{type(e).__name__}: {e}"))
+    channel.send(('done',))
+
+
+def _run_test(codes, job, index, conn, pred_query_result):
+    with conn.cursor() as cursor:
+        cursor.execute("SAVEPOINT test_case")
+    digest = job['tests'][index]
+    if digest not in codes:
+        return 'error', "the test case does not compile"
+    namespace = dict(HELPERS, pred_query_result=pred_query_result, __name__='test_case')
+    try:
+        exec(codes[digest], namespace)
+        namespace['test_case'](list(job['pred_sqls']), list(job['sol_sqls']), job['db_name'], conn)
+        return 'passed', None
+    except AssertionError as e:
+        return 'failed', str(e) or 'assertion failed'
+    except Exception as e:
+        return 'error', f"{type(e).__name__}: {e}\n{traceback.format_exc(limit=-3)}"
+
+
+class TestOutcome:
+    """outcome of one test case: 'passed', 'failed', 'error', 'timeout' or 'crashed'."""
+    def __init__(self, instance_id, index, status, message=None, seconds=0.0):
+        self.instance_id = instance_id
+        self.index = index
+        self.status = status
+        self.message = message
+        self.seconds = seconds
+
+    @property
+    def passed(self):
+        return self.status == 'passed'
+
+    def to_dict(self):
+        return {
+            'instance_id': self.instance_id, 'index': self.index, 'status': self.status,
+            'message': self.message, 'seconds': self.seconds,
+        }
+
+
+class _Worker:
+    """a worker process and the driver's end of its pipe, started again after it is killed."""
+    def __init__(self, start):
+        self._start = start
+        self.process = None
+        self.channel = None
+        self.known = set()
+
+    def ensure(self):
+        if self.process is None or not self.process.is_alive():
+            self.stop()
+            self.process, self.channel = self._start()
+            self.known = set()
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+        self.stop()
+
+    def stop(self):
+        if self.channel is not None:
+            self.channel.close()
+        self.process = None
+        self.channel = None
+
+
+class TestCaseRunner:
+    """
+    runs the test_cases of GTsql_filtered.jsonl against predicted SQL in a pool of worker processes.
+
+    every distinct test source is compiled once into a code object, which a worker receives the
+    first time it runs that test. each worker holds its own pooled connection and runs an instance
+    in one transaction: preprocess SQL, the predicted SQL (its rows become the pred_query_result
+    global the tests read), then every test under a savepoint rolled back after it, so tests do
+    not see each other's changes. the tests call execute_queries, remove_distinct, ex_base and
+    performance_compare_by_qep from HELPERS.
+
+    a test gets timeout_s seconds; a worker that overruns it, or dies, is killed and started
+    again, the test is recorded as 'timeout' or 'crashed' and the instance goes on with its next
+    test. workers are forked, so eval.py is not imported again in them.
+
+    instances whose SQL writes a table of the same database another one reads or writes are put
+    in one group, whose instances run in order on one worker: their tests never wait on each
+    other's row or table locks, which would count against timeout_s.
+    """
+    def __init__(self, user, password, workers=4, timeout_s=30.0, statement_timeout_ms=None, **connect_kwargs):
+        self.user = user
+        self.password = password
+        self.workers = workers
+        self.timeout_s = timeout_s
+        self.statement_timeout_ms = statement_timeout_ms if statement_timeout_ms is not None else int(timeout_s * 1000)
+        self.connect_kwargs = connect_kwargs
+        self.codes = {}
+        self.counts = {}
+        self.respawns = 0
+        self.wall_s = 0.0
+        self._mp = multiprocessing.get_context('fork')
+        self._lock = threading.Lock()
+
+    def compile(self, source, name='test_case'):
+        """:return: digest of source, its code object compiled and cached on first use (None if it does not compile)."""
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self._lock:
+            if digest not in self.codes:
+                try:
+                    self.codes[digest] = marshal.dumps(compile(source, f"<{name}>", 'exec'))
+                except SyntaxError as e:
+                    logger.error("%s does not compile: %s", name, e)
+                    self.codes[digest] = None
+        return digest
+
+    @staticmethod
+    def job(sample, gt_record, pred_sqls, db_name):
+        """
+        :param sample: Instance from input_filtered.jsonl, for its preprocess SQL.
+        :param gt_record: Its record from GTsql_filtered.jsonl, with sol_sql and test_cases.
+        """
+        return {
+            'instance_id': sample['instance_id'],
+            'db_name': db_name,
+            'pred_sqls': list(pred_sqls),
+            'sol_sqls': list(gt_record['sol_sql']),
+            'preprocess_sql': list(sample.get('preprocess_sql') or []),
+            'test_cases': list(gt_record['test_cases']),
+        }
+
+    @staticmethod
+    def groups(jobs):
+        """:return: the jobs in groups that touch no table of the same database another group writes."""
+        parent = list(range(len(jobs)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        def union(i, j):
+            i, j = find(i), find(j)
+            if i != j:
+                parent[max(i, j)] = min(i, j)
+
+        touched, written, any_table = {}, {}, {}
+        for i, job in enumerate(jobs):
+            sqls = job['preprocess_sql'] + job['pred_sqls'] + job['sol_sqls']
+            for statement in (statement for sql in sqls if sql for statement in SQLClassifier.split(sql)):
+                reads, writes = SQLClassifier.tables(statement)
+                for table in reads | writes:
+                    touched.setdefault((job['db_name'], table), []).append(i)
+                for table in writes:
+                    written.setdefault((job['db_name'], table), set()).add(i)
+                if SQLClassifier.ANY_TABLE in writes:
+                    any_table.setdefault(job['db_name'], set()).add(i)
+
+        for key, writers in written.items():
+            for i in touched[key]:
+                union(min(writers), i)
+        for i, job in enumerate(jobs):
+            for j in any_table.get(job['db_name'], ()):
+                union(i, j)
+
+        groups = {}
+        for i, job in enumerate(jobs):
+            groups.setdefault(find(i), []).append(job)
+        return list(groups.values())
+
+    def _start_worker(self):
+        parent, child = self._mp.Pipe()
+        process = self._mp.Process(
+            target=_worker, args=(child, self.user, self.password, self.statement_timeout_ms, self.connect_kwargs),
+            daemon=True,
+        )
+        process.start()
+        child.close()
+        return process, parent
+
+    def _receive(self, worker):
+        """:return: the worker's next message, 'timeout' or 'crashed'."""
+        try:
+            if not worker.channel.poll(self.timeout_s):
+                return ('timeout',)
+            return worker.channel.recv()
+        except (EOFError, OSError):
+            return ('crashed',)
+
+    def _serve(self, worker, job):
+        instance_id = job['instance_id']
+        tests = [self.compile(source, f"test_case {instance_id}.{i}") for i, source in enumerate(job['test_cases'])]
+        outcomes, start = [], 0
+        while start < len(tests):
+            worker.ensure()
+            fresh = {digest: self.codes[digest] for digest in set(tests) - worker.known if self.codes[digest] is not None}
+            worker.channel.send({
+                'db_name': job['db_name'], 'pred_sqls': job['pred_sqls'], 'sol_sqls': job['sol_sqls'],
+                'preprocess_sql': job['preprocess_sql'], 'tests': tests, 'start': start, 'codes': fresh,
+            })
+            worker.known |= set(fresh)
+            while True:
+                message = self._receive(worker)
+                if message[0] == 'test':
+                    _, index, status, text, seconds = message
+                    outcomes.append(TestOutcome(instance_id, index, status, text, seconds))
+                    start = index + 1
+                elif message[0] == 'ready':
+                    continue
+                elif message[0] == 'abort':
+                    outcomes += [TestOutcome(instance_id, i, 'error', message[1]) for i in range(start, len(tests))]
+                    start = len(tests)
+                elif message[0] == 'done':
+                    start = len(tests)
+                    break
+                else:
+                    logger.error("Instance %s: test case %d %s, restarting the worker.", instance_id, start, message[0])
+                    worker.kill()
+                    with self._lock:
+                        self.respawns += 1
+                    outcomes.append(TestOutcome(instance_id, start, message[0], seconds=self.timeout_s))
+                    start += 1
+                    break
+        with self._lock:
+            for outcome in outcomes:
+                self.counts[outcome.status] = self.counts.get(outcome.status, 0) + 1
+        return outcomes
+
+    def run(self, jobs):
+        """
+        :param jobs: Dicts from TestCaseRunner.job.
+        :return: instance_id to the TestOutcome of each of its test cases.
+        """
+        start = time.perf_counter()
+        groups = self.groups(jobs)
+        logger.info("Running the test cases of %d instances in %d groups.", len(jobs), len(groups))
+        pending = queue.Queue()
+        for group in groups:
+            pending.put(group)
+        results = {}
+
+        def drain():
+            worker = _Worker(self._start_worker)
+            try:
+                while True:
+                    try:
+                        group = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    for job in group:
+                        outcomes = self._serve(worker, job)
+                        with self._lock:
+                            results[job['instance_id']] = outcomes
+            finally:
+                if worker.channel is not None:
+                    try:
+                        worker.channel.send(None)
+                        worker.process.join(self.timeout_s)
+                    except (OSError, ValueError):
+                        pass
+                worker.kill()
+
+        threads = [threading.Thread(target=drain, daemon=True) for _ in range(min(self.workers, len(groups)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.wall_s += time.perf_counter() - start
+        return results
+
+    @staticmethod
+    def passed(outcomes):
+        """True if an instance has test cases and every one of them passed."""
+        return bool(outcomes) and all(outcome.passed for outcome in outcomes)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tests': sum(self.counts.values()),
+                **self.counts,
+                'compiled': len(self.codes),
+                'respawns': self.respawns,
+                'wall_s': self.wall_s,
+            }
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the eval scripts import each other by bare name and util_scripts from src
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.append(SRC)
+sys.path.append(os.path.join(SRC, 'eval'))
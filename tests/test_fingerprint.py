@@ -0,0 +1,35 @@
+from fingerprint import SQLFingerprint
+
+
+def same(a, b):
+    return SQLFingerprint.of(a) == SQLFingerprint.of(b)
+
+
+def test_whitespace_case_comments_and_numbers():
+    assert same("SELECT a FROM t WHERE b = 1.50", "select  a\nfrom T -- note\nwhere b = 15e-1;")
+
+
+def test_alias_names_and_optional_as():
+    assert same("SELECT t.a AS x FROM tab t ORDER BY x", "select q.a as y from tab AS q order by y")
+    assert same(
+        "SELECT MAX(amount) m FROM trans tr JOIN u ON tr.id = u.id ORDER BY m",
+        "SELECT MAX(amount) AS top FROM trans AS x JOIN u ON x.id = u.id ORDER BY top",
+    )
+
+
+def test_column_named_like_an_alias_is_kept():
+    assert not same("SELECT a AS b FROM t WHERE b > 1", "SELECT a AS c FROM t WHERE b > 1")
+    assert SQLFingerprint.canonical("SELECT status AS s FROM t status WHERE status = 1") == \
+        "select status a1 from t a2 where status = 1"
+
+
+def test_cast_type_is_not_an_alias():
+    assert not same("SELECT CAST(amount AS integer) FROM t", "SELECT CAST(amount AS numeric) FROM t")
+    assert not same("SELECT CAST('2020-01-01' AS date)", "SELECT CAST('2020-01-01' AS timestamp)")
+    assert SQLFingerprint.canonical("SELECT CAST(SUM(a) AS int) total FROM t") == \
+        "select cast ( sum ( a ) as int ) a1 from t"
+
+
+def test_literals_and_quoted_identifiers_are_verbatim():
+    assert not same("SELECT 'A' FROM t", "SELECT 'a' FROM t")
+    assert not same('SELECT "A" FROM t', 'SELECT "a" FROM t')
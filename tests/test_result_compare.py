@@ -0,0 +1,87 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+
+from util_scripts.result_compare import ResultComparator
+
+
+@pytest.fixture
+def comparator():
+    return ResultComparator('set')
+
+
+def test_semantics():
+    rows, gt_rows = [(1,), (1,), (2,)], [(2,), (1,)]
+    assert ResultComparator('set').equal(rows, gt_rows)
+    assert not ResultComparator('bag').equal(rows, gt_rows)
+    assert ResultComparator('bag').equal([(2,), (1,)], [(1,), (2,)])
+    assert not ResultComparator('ordered').equal([(2,), (1,)], [(1,), (2,)])
+
+
+def test_respect_order_only_for_ordered_ground_truth():
+    comparator = ResultComparator('bag', respect_order=True)
+    assert comparator.equal([(2,), (1,)], [(1,), (2,)])
+    assert not comparator.equal([(2,), (1,)], [(1,), (2,)], ordered=True)
+
+
+def test_unknown_semantics():
+    with pytest.raises(ValueError):
+        ResultComparator('sorted')
+
+
+def test_empty_results(comparator):
+    assert not comparator.equal([], [])
+    assert ResultComparator('set', empty_matches=True).equal([], [])
+    assert not comparator.equal([(1,)], [])
+
+
+def test_numbers_are_rounded(comparator):
+    assert comparator.equal([(Decimal('2.001'),)], [(2.0,)])
+    assert not comparator.equal([(2.01,)], [(2.0,)])
+    assert ResultComparator('set', abs_tol=0.05).equal([(2.01,)], [(2.0,)])
+
+
+def test_integers_compare_exactly(comparator):
+    assert not comparator.equal([(10 ** 20,)], [(10 ** 20 + 1,)])
+    assert comparator.equal([(10 ** 20,)], [(10 ** 20,)])
+    assert comparator.equal([(10,)], [(Decimal('10.001'),)])
+
+
+def test_numeric_text_is_coerced(comparator):
+    assert comparator.equal([('2.50',)], [(2.5,)])
+    assert comparator.equal([('10',)], [(10,)])
+    assert not comparator.equal([('10.5',)], [(10,)])
+    assert not comparator.equal([('x',)], [(2,)])
+
+
+def test_booleans_are_not_numbers(comparator):
+    assert not comparator.equal([(True,)], [(1,)])
+    assert comparator.equal([(True,)], [(True,)])
+
+
+def test_only_full_iso_dates_are_coerced(comparator):
+    assert comparator.equal([('2020-01-01',)], [(datetime.date(2020, 1, 1),)])
+    assert comparator.equal([('2020-01-01 10:00:00',)], [(datetime.datetime(2020, 1, 1, 3),)])
+    assert not comparator.equal([('2020',)], [(datetime.date(2020, 1, 1),)])
+    assert not comparator.equal([('2020-01',)], [(datetime.date(2020, 1, 1),)])
+
+
+def test_timezones_are_normalized(comparator):
+    utc = datetime.datetime(2020, 1, 1, 23, tzinfo=datetime.timezone.utc)
+    local = datetime.datetime(2020, 1, 2, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+    assert comparator.equal([(utc,)], [(local,)])
+
+
+def test_nulls_only_match_nulls(comparator):
+    assert comparator.equal([(None, 1), (3, None)], [(3, None), (None, 1)])
+    assert not comparator.equal([(None,)], [(0,)])
+
+
+def test_arrays_are_sorted(comparator):
+    assert comparator.equal([([3, 1, 2],)], [([1, 2, 3],)])
+    assert not ResultComparator('set', sort_arrays=False).equal([([3, 1, 2],)], [([1, 2, 3],)])
+
+
+def test_width_mismatch(comparator):
+    assert not comparator.equal([(1, 2)], [(1,)])
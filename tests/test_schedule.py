@@ -0,0 +1,66 @@
+from schedule import ConflictScheduler, TableAccess
+
+
+def sample(instance_id, preprocess=(), error=(), db='d'):
+    return {'instance_id': instance_id, 'preprocess_sql': list(preprocess), 'error_sql': list(error),
+            'clean_up_sql': [], 'db': db}
+
+
+def ids(waves):
+    return [[s['instance_id'] for s in wave] for wave in waves]
+
+
+def waves(scheduler, samples, isolated=lambda s: False):
+    return scheduler.waves(samples, db_of=lambda s: s['db'], held=lambda s: bool(s['preprocess_sql']),
+                           isolated=isolated)
+
+
+def test_table_access_conflicts():
+    writer = TableAccess.of('d', ["UPDATE t SET a = 1"])
+    reader = TableAccess.of('d', ["SELECT * FROM t"])
+    other = TableAccess.of('d', ["SELECT * FROM u"])
+    assert writer.conflicts(reader) and reader.conflicts(writer)
+    assert not reader.conflicts(TableAccess.of('d', ["SELECT * FROM t"]))
+    assert not writer.conflicts(other)
+    assert not writer.conflicts(TableAccess.of('e', ["SELECT * FROM t"]))
+    assert not writer.conflicts(TableAccess.of('d', ["SELECT * FROM t"], isolated=True))
+    assert TableAccess.of('d', ["CALL p()"]).conflicts(other)
+
+
+def test_conflicting_instances_go_to_later_waves():
+    samples = [
+        sample(0, error=["SELECT * FROM t"]),
+        sample(1, preprocess=["UPDATE t SET a = 1"]),
+        sample(2, error=["SELECT * FROM u"]),
+        sample(3, preprocess=["DELETE FROM t"]),
+        sample(4, preprocess=["UPDATE t SET a = 1"], db='e'),
+    ]
+    assert ids(waves(ConflictScheduler(), samples)) == [[0, 2, 4], [1], [3]]
+
+
+def test_solution_sql_counts():
+    samples = [sample(0, error=["SELECT * FROM t"]), sample(1, error=["SELECT * FROM u"])]
+    scheduler = ConflictScheduler(gt_sql={1: ["INSERT INTO t SELECT * FROM u"]})
+    assert ids(waves(scheduler, samples)) == [[0], [1]]
+
+
+def test_wave_limits():
+    samples = [sample(i, preprocess=[f"UPDATE t{i} SET a = 1"]) for i in range(5)]
+    assert ids(waves(ConflictScheduler(max_held=2), samples)) == [[0, 1], [2, 3], [4]]
+    cloned = [sample(i, preprocess=["VACUUM t"]) for i in range(3)]
+    assert ids(waves(ConflictScheduler(max_isolated=2), cloned, isolated=lambda s: True)) == [[0, 1], [2]]
+
+
+def test_report_and_critical_path():
+    samples = [sample(0, preprocess=["UPDATE t SET a = 1"]), sample(1, preprocess=["DELETE FROM t"]),
+               sample(2, error=["SELECT * FROM u"])]
+    scheduler = ConflictScheduler()
+    waves(scheduler, samples)
+    for instance_id, seconds in ((0, 1.0), (1, 2.0), (2, 0.5)):
+        scheduler.record(instance_id, seconds)
+    scheduler.record_wave(1.0)
+    scheduler.record_wave(2.0)
+    assert scheduler.critical_path() == (3.0, [0, 1])
+    report = scheduler.report()
+    assert report['waves'] == 2 and report['max_wave'] == 2 and report['conflicts'] == 1
+    assert report['parallelism'] == 3.5 / 3.0
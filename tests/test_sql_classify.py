@@ -0,0 +1,74 @@
+import pytest
+
+from util_scripts.sql_classify import SQLClassifier
+
+
+def kind(sql):
+    statement = SQLClassifier.classify(sql)
+    return statement.kind, statement.transactional
+
+
+def test_split_skips_quoted_semicolons():
+    sql = "SELECT ';' AS a; -- x; y\nDO $$ BEGIN PERFORM 1; END $$; ;"
+    assert SQLClassifier.split(sql) == ["SELECT ';' AS a", "-- x; y\nDO $$ BEGIN PERFORM 1; END $$"]
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ("SELECT * FROM t", ('read', True)),
+    ("WITH d AS (DELETE FROM t RETURNING *) SELECT * FROM d", ('write', True)),
+    ("SELECT * FROM t FOR UPDATE", ('lock', True)),
+    ("SELECT a INTO b FROM t", ('ddl', True)),
+    ("UPDATE t SET a = 1", ('write', True)),
+    ("EXPLAIN ANALYZE DELETE FROM t", ('write', True)),
+    ("EXPLAIN DELETE FROM t", ('read', True)),
+    ("CREATE INDEX CONCURRENTLY i ON t (a)", ('ddl', False)),
+    ("VACUUM t", ('maintenance', False)),
+    ("ANALYZE t", ('maintenance', True)),
+    ("BEGIN", ('transaction', False)),
+    ("SET search_path = x", ('session', True)),
+    ("SELECT nextval('s')", ('write', False)),
+])
+def test_classify(sql, expected):
+    assert kind(sql) == expected
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ("SELECT pg_terminate_backend(pid) FROM pg_stat_activity", ('write', False)),
+    ("SELECT pg_cancel_backend(1)", ('write', False)),
+    ("SELECT dblink_exec('conn', 'DELETE FROM t')", ('write', False)),
+    ("SELECT set_config('app.user', 'x', false)", ('write', True)),
+    ("SELECT lo_unlink(1234)", ('write', True)),
+    ("SELECT lower(a) FROM t", ('read', True)),
+])
+def test_side_effecting_functions_are_writes(sql, expected):
+    assert kind(sql) == expected
+
+
+@pytest.mark.parametrize('sql, reads, writes', [
+    ("SELECT * FROM a JOIN public.b ON a.id = b.id, c", {'a', 'b', 'c'}, set()),
+    ("UPDATE t SET a = 1 FROM u WHERE t.id = u.id", {'u'}, {'t'}),
+    ("DELETE FROM t USING u WHERE t.id = u.id", {'u'}, {'t'}),
+    ("INSERT INTO t SELECT * FROM u", {'u'}, {'t'}),
+    ("WITH x AS (SELECT * FROM t) SELECT * FROM x", {'t'}, set()),
+    ("SELECT EXTRACT(YEAR FROM d) FROM t", {'t'}, set()),
+    ("CREATE TEMP TABLE tmp AS SELECT * FROM t", {'t'}, set()),
+    ("VACUUM ANALYZE t", set(), {'t'}),
+    ("VACUUM FULL VERBOSE ANALYZE a, b", set(), {'a', 'b'}),
+    ("REINDEX TABLE CONCURRENTLY t", set(), {'t'}),
+    ("VACUUM", set(), {SQLClassifier.ANY_TABLE}),
+    ("CREATE TRIGGER tr AFTER UPDATE OF status ON t FOR EACH ROW EXECUTE FUNCTION f()", set(), {'tr', 't'}),
+    ("CREATE RULE r AS ON UPDATE TO t DO INSTEAD NOTHING", set(), {'r', 't'}),
+    ("CALL p()", set(), {SQLClassifier.ANY_TABLE}),
+    ("SELECT pg_terminate_backend(pid) FROM pg_stat_activity", {'pg_stat_activity'}, {SQLClassifier.ANY_TABLE}),
+    ("SELECT lo_unlink(1)", set(), {'pg_largeobject'}),
+    ("SET statement_timeout = 0", set(), set()),
+])
+def test_tables(sql, reads, writes):
+    assert SQLClassifier.tables(sql) == (reads, writes)
+
+
+def test_read_only_and_transactional():
+    assert SQLClassifier.read_only(["SELECT 1", "SELECT * FROM t; TABLE u"])
+    assert not SQLClassifier.read_only(["SELECT 1", "DELETE FROM t"])
+    assert SQLClassifier.transactional(["CREATE TABLE t (a int)", "DROP TABLE t"])
+    assert not SQLClassifier.transactional(["UPDATE t SET a = 1", "VACUUM t"])